@@ -7,6 +7,7 @@ import os
 from os import listdir
 from os.path import isfile, join
 from lorentizansFit import multipleLorentziansFitter
+from recording import RecordingWriter
 from scipy.fft import rfft, rfftfreq, irfft  # from signal cleanup
 
 
@@ -37,6 +38,7 @@ class DPO7254Visa():
         self.ID = self.ask("*IDN?")
         self.dataString = ''
         self.wvfm = [[]] * 5  # assuming channels 1-4
+        self.recording = None  # see recordData
         if 'TEKTRONIX,DPO7254' not in self.ID:
             printError('Could not identify instrument. Check connection, try again.')
             return
@@ -89,6 +91,24 @@ class DPO7254Visa():
         if show:
             plt.show()
 
+    def recordData(self, chns=(1, 2, 3, 4), comment=''):
+        # Append the last acquired @chns to one recording per session (functions/recording.py), instead of an .npz per acquisition
+        lengths = set(len(self.wvfm[ch]) for ch in chns)
+        if len(lengths) != 1 or 0 in lengths:
+            printError('Channels %s are not all of the same length (or not acquired); saving an .npz instead' % str(chns))
+            self.saveData()
+            return
+        frame = np.array([self.wvfm[ch] for ch in chns])
+        if self.recording is None or self.recording.shape != frame.shape:
+            if self.recording is not None:
+                self.recording.close()
+            now = datetime.now()
+            path = os.path.join("U:\\", "Lab_2021-2022", "DATA", "DPO7254", now.strftime("%B-%d-%Y"), now.strftime("%H-%M-%S") + " session.rec")
+            self.recording = RecordingWriter(path, channels=['Ch_%d_Data' % ch for ch in chns], metadata={'time': self.timeData})
+            print("Recording to %s" % path)
+        self.recording.append(frame, time.time(), {'comment': comment})
+        self.recording.flush()  # acquisitions are minutes apart; write each one right away
+
     def saveData(self, filename=''):
         if filename != '':
             filename = str(filename) + ' - '
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Recording and replay of Red Pitaya scope sessions.
+
+WebsocketRecorder saves the websocket messages RedPitayaWebsocket.Redpitaya receives (signals and parameters, still
+gzip'ed, as sent by the RP) with their arrival times:
+    b'RPWSREC1', then per message: float64 time | uint32 length | message
+ReplaySource plays such a file back through the same decoding path and got_data_callback, so a scope tab (any Scope_GUI)
+can use it instead of a live board:
+    'original' - at the recorded pace (scaled by speed)
+    'max'      - as fast as the consumer takes the frames; frames/s is then a benchmark of the analysis and plot path
+    'step'     - one signal frame per step() call
+"""
+
+import struct
+import threading
+import time
+
+from functions.RedPitayaWebsocket import Redpitaya
+
+MAGIC = b'RPWSREC1'
+_RECORD = struct.Struct('<dI')
+MODES = ('original', 'max', 'step')
+
+
+class WebsocketRecorder:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.f = open(path, 'wb')
+        self.f.write(MAGIC)
+        self.messages, self.bytes = 0, 0
+
+    def write(self, message, timestamp=None):
+        with self.lock:
+            if self.f is None:
+                return
+            self.f.write(_RECORD.pack(time.time() if timestamp is None else timestamp, len(message)))
+            self.f.write(message)
+            self.messages += 1
+            self.bytes += len(message)
+
+    def close(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+
+def readRecording(path):
+    """Yields (time, message) of a WebsocketRecorder file. A truncated last message is ignored."""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a Red Pitaya websocket recording' % path)
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            t, n = _RECORD.unpack(header)
+            message = f.read(n)
+            if len(message) < n:
+                return
+            yield t, message
+
+
+class ReplaySource(Redpitaya):
+    """
+    Stands in for RedPitayaWebsocket.Redpitaya: same callbacks and set_* methods (settings are ignored, as there is
+    no board to send them to).
+    @mode: 'original', 'max' or 'step' (see above)
+    @speed: playback speed factor, in 'original' mode
+    @loop: start over at the end of the recording
+    @ready: optional callable; in 'max' mode the replay waits while it returns False (e.g. while the consumer's queue
+    is full), so that no frame is dropped
+    """
+
+    def __init__(self, path, got_data_callback=None, mode='original', speed=1.0, loop=False, ready=None,
+                 dialogue_print_callback=None, debugging=False, decoder_buffers=3, drop_duplicates=True):
+        if mode not in MODES:
+            raise ValueError('Replay mode must be one of %s' % str(MODES))
+        self.time = time.time()
+        self.host = path
+        self.timeout = None
+        self.initState(got_data_callback, 'EXT', dialogue_print_callback, debugging, decoder_buffers, drop_duplicates, None)
+        # on_message hands frames to onFrame, which paces them and passes them on
+        self.deliver, self.got_data_callback = self.got_data_callback, self.onFrame
+        self.path = path
+        self.mode = mode
+        self.speed = float(speed)
+        self.loop = loop
+        self.ready = ready
+        self.stopEvent = threading.Event()
+        self.steps = threading.Semaphore(0)
+        self.framesReplayed = 0
+        self.replayTime = 0
+        with open(path, 'rb') as f:
+            self.connected = f.read(len(MAGIC)) == MAGIC
+        if not self.connected:
+            self.print('%s is not a Red Pitaya websocket recording.' % path, color='red')
+
+    def updateParameters(self):
+        self.new_parameters = {}  # nothing to send them to
+
+    def step(self, n=1):
+        """In 'step' mode, let @n more signal frames through."""
+        for i in range(n):
+            self.steps.release()
+
+    def run(self):
+        """Replays the recording; blocks until it ends or close() is called."""
+        start = time.perf_counter()
+        while not self.stopEvent.is_set():
+            self.replayOnce()
+            if not self.loop:
+                break
+            self.last_digests = {'signals': None, 'parameters': None}  # first frame of the next round is no duplicate
+        self.replayTime = time.perf_counter() - start
+        self.print('Replay of %s ended: %d frames in %.1f s (%.1f frames/s)' %
+                   (self.path, self.framesReplayed, self.replayTime, self.framesReplayed / max(self.replayTime, 1e-9)))
+
+    def replayOnce(self):
+        t0, start = None, time.perf_counter()
+        for t, message in readRecording(self.path):
+            if self.stopEvent.is_set():
+                return
+            t0 = t if t0 is None else t0
+            if self.mode == 'original':
+                delay = (t - t0) / self.speed - (time.perf_counter() - start)
+                if delay > 0 and self.stopEvent.wait(delay):
+                    return
+            self.on_message(None, message)
+
+    def onFrame(self, data, parameters):
+        # got_data_callback of Redpitaya.on_message: signal frames only, duplicates already dropped
+        if self.mode == 'step':
+            while not self.steps.acquire(timeout=0.1):
+                if self.stopEvent.is_set():
+                    return
+        elif self.mode == 'max' and self.ready is not None:
+            while not self.ready():
+                if self.stopEvent.wait(1e-3):
+                    return
+        self.framesReplayed += 1
+        self.deliver(data=data, parameters=parameters)
+
+    def close(self):
+        self.stopEvent.set()
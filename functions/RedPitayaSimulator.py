@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for a Red Pitaya, to run the scope/OD/cavity-lock/STIRAP tabs, benchmarks and regression checks
+without hardware.
+
+It serves the subset of the RP protocols that this repo uses:
+- HTTP GET /bazaar?start=<app> and the scope app websocket on /wss (same port): gzip'ed JSON frames with 'signals'
+  (ch1/ch2 values) and 'parameters' (OSC_* values, OSC_TRIG_INFO), and the parameter updates the client sends.
+- SCPI (default port 5000) - the commands used by functions/od/scpi.py and functions/cavity_lock/scpi.py.
+
+Each channel shows one of the synthetic WAVEFORMS (Rb saturated-absorption lines, cavity Lorentzian, OD pulses).
+Run it directly:
+    python -m functions.RedPitayaSimulator
+and connect with RedPitayaWebsocket.Redpitaya('127.0.0.1:8080') or scpi.Redpitaya('127.0.0.1', port=5000).
+"""
+
+import socket, socketserver, threading, json, gzip, hashlib, base64, struct, time
+from urllib.parse import urlparse
+
+import numpy as np
+
+_BUFFER_SIZE = 16384  # samples in an RP acquisition buffer
+_WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+# ---- Synthetic waveforms ----
+# Each takes x in [0, 1) (position along the trace) and a numpy random Generator, and returns volts.
+
+def lorentzian(x, x0, fwhm):
+    return 1 / (1 + ((x - x0) / (fwhm / 2)) ** 2)
+
+
+def rb_lines(x, rng, centers=(0.22, 0.3, 0.38, 0.6, 0.66, 0.72), widths=0.008, depths=(0.15, 0.25, 0.1, 0.2, 0.3, 0.12),
+             doppler_center=0.47, doppler_width=0.3, doppler_depth=0.6, offset=0.8, noise=0.003):
+    """Saturated absorption spectroscopy: Doppler broadened absorption with narrow (Lamb dip) lines on top."""
+    doppler = doppler_depth * np.exp(-((x - doppler_center) / doppler_width) ** 2)
+    dips = sum(d * lorentzian(x, c, widths) for c, d in zip(centers, depths))
+    return offset - doppler + dips + rng.normal(0, noise, len(x))
+
+
+def cavity_lorentzian(x, rng, centers=(0.35, 0.65), fwhm=0.02, amplitude=0.5, jitter=0.003, noise=0.003):
+    """Cavity transmission while scanning: Lorentzian peaks, with shot-to-shot jitter of their positions."""
+    shift = rng.normal(0, jitter)
+    return sum(amplitude * lorentzian(x, c + shift, fwhm) for c in centers) + rng.normal(0, noise, len(x))
+
+
+def od_pulses(x, rng, starts=(0.2, 0.6), length=0.1, amplitude=0.5, absorption=0.4, absorption_jitter=0.05, noise=0.003):
+    """OD measurement: two probe pulses; the first one is absorbed by the atoms, the second is the reference."""
+    res = rng.normal(0, noise, len(x))
+    transmission = np.clip(1 - absorption + rng.normal(0, absorption_jitter), 0, 1)
+    for i, start in enumerate(starts):
+        res[(x >= start) & (x < start + length)] += amplitude * (transmission if i == 0 else 1)
+    return res
+
+
+def noise(x, rng, sigma=0.01):
+    return rng.normal(0, sigma, len(x))
+
+
+WAVEFORMS = {'rb': rb_lines, 'cavity': cavity_lorentzian, 'od': od_pulses, 'noise': noise}
+
+
+DEFAULT_PARAMETERS = {'OSC_DATA_SIZE': 1024, 'OSC_TIME_SCALE': '1.0000000', 'OSC_TIME_OFFSET': 0,
+                      'OSC_CH1_SCALE': 1, 'OSC_CH2_SCALE': 1, 'OSC_CH1_OFFSET': 0, 'OSC_CH2_OFFSET': 0,
+                      'OSC_TRIG_SOURCE': 2, 'OSC_TRIG_SWEEP': 1, 'OSC_TRIG_LEVEL': 100, 'OSC_TRIG_INFO': 2,
+                      'OSC_RUN': True, 'CH1_SHOW_INVERTED': False, 'CH2_SHOW_INVERTED': False}
+
+
+class RedPitayaSimulator:
+    """
+    channels    - waveform name (see WAVEFORMS) or callable f(x, rng) of CH1 and CH2.
+    rate        - triggers (new traces) per second; None - as fast as possible.
+    repeat      - how many times each websocket frame is sent; the real RP resends the last data while untriggered.
+    pool_size   - websocket frames are generated (and compressed) in advance, and sent in rotation; this way the
+                  server is not the bottleneck in throughput benchmarks.
+    http_port, scpi_port - 0 picks free ports (see the attributes of the same name once started).
+    """
+
+    def __init__(self, channels=('rb', 'cavity'), rate=20, repeat=1, pool_size=8, host='127.0.0.1', http_port=8080,
+                 scpi_port=5000, seed=None, waveform_kwargs=None):
+        self.channels = [WAVEFORMS[ch] if isinstance(ch, str) else ch for ch in channels]
+        self.waveform_kwargs = waveform_kwargs if waveform_kwargs is not None else [{}, {}]
+        self.rate = rate
+        self.repeat = max(1, int(repeat))
+        self.pool_size = pool_size
+        self.host = host
+        self.http_port = http_port
+        self.scpi_port = scpi_port
+        self.rng = np.random.default_rng(seed)
+        self.lock = threading.Lock()
+        self.parameters = dict(DEFAULT_PARAMETERS)
+        self.servers = []
+        self.frames_sent = 0
+
+    @property
+    def websocket_host(self):
+        # RedPitayaWebsocket builds its URLs as http://<host>/bazaar and ws://<host>/wss
+        return '%s:%d' % (self.host, self.http_port)
+
+    def traces(self, n):
+        """One shot: (2, n) float32 array of both channels."""
+        x = np.arange(n) / n
+        with self.lock:
+            return np.array([f(x, self.rng, **kw) for f, kw in zip(self.channels, self.waveform_kwargs)], dtype=np.float32)
+
+    # ---- Websocket frames ----
+    def parametersFrame(self):
+        with self.lock:
+            parameters = {key: {'value': value} for key, value in self.parameters.items()}
+        return gzip.compress(json.dumps({'parameters': parameters}).encode('utf-8'))
+
+    def signalsFrame(self):
+        n = int(self.parameters['OSC_DATA_SIZE'])
+        data = self.traces(n)
+        signals = {ch: {'size': n, 'value': np.round(data[i], 6).tolist()} for i, ch in enumerate(('ch1', 'ch2'))}
+        return gzip.compress(json.dumps({'signals': signals}, separators=(',', ':')).encode('utf-8'), compresslevel=6)
+
+    def framePool(self):
+        return [self.signalsFrame() for i in range(self.pool_size)]
+
+    def updateParameters(self, parameters):
+        with self.lock:
+            for key, value in parameters.items():
+                if key in ('in_command',) or not isinstance(value, dict) or 'value' not in value:
+                    continue
+                self.parameters[key] = value['value']
+            self.parameters['OSC_DATA_SIZE'] = int(np.clip(int(self.parameters['OSC_DATA_SIZE']), 1, _BUFFER_SIZE))
+
+    # ---- Servers ----
+    def start(self):
+        simulator = self
+
+        class Server(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        class WebsocketHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                WebsocketConnection(simulator, self).serve()
+
+        class ScpiHandler(socketserver.StreamRequestHandler):
+            def handle(self):
+                ScpiConnection(simulator, self).serve()
+
+        for attr, handler in (('http_port', WebsocketHandler), ('scpi_port', ScpiHandler)):
+            server = Server((self.host, getattr(self, attr)), handler)
+            setattr(self, attr, server.server_address[1])
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.servers.append(server)
+        return self
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class WebsocketConnection:
+    """One HTTP connection: either a /bazaar request, or the /wss websocket of the scope app."""
+
+    def __init__(self, simulator, handler):
+        self.simulator = simulator
+        self.rfile, self.wfile, self.sock = handler.rfile, handler.wfile, handler.request
+        self.sendLock = threading.Lock()
+        self.closed = threading.Event()
+        self.poolValid = False
+
+    def serve(self):
+        request = self.rfile.readline().decode('latin-1').split()
+        headers = {}
+        while True:
+            line = self.rfile.readline().decode('latin-1').strip()
+            if not line:
+                break
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        if len(request) < 2:
+            return
+        path = urlparse(request[1]).path
+        if path == '/bazaar':
+            body = json.dumps({'status': 'OK'}).encode('utf-8')
+            self.wfile.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: %d\r\n'
+                             b'Connection: close\r\n\r\n' % len(body) + body)
+        elif path == '/wss' and headers.get('upgrade', '').lower() == 'websocket':
+            accept = base64.b64encode(hashlib.sha1((headers['sec-websocket-key'] + _WEBSOCKET_GUID).encode()).digest())
+            self.wfile.write(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                             b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+            self.wfile.flush()
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.send(self.simulator.parametersFrame())
+            threading.Thread(target=self.sendSignals, daemon=True).start()
+            try:
+                self.receive()
+            finally:
+                self.closed.set()
+        else:
+            self.wfile.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+
+    def send(self, payload, opcode=0x2):
+        n = len(payload)
+        if n < 126:
+            header = struct.pack('!BB', 0x80 | opcode, n)
+        elif n < 1 << 16:
+            header = struct.pack('!BBH', 0x80 | opcode, 126, n)
+        else:
+            header = struct.pack('!BBQ', 0x80 | opcode, 127, n)
+        with self.sendLock:
+            self.sock.sendall(header + payload)
+
+    def readFrame(self):
+        head = self.rfile.read(2)
+        if len(head) < 2:
+            return None, None
+        opcode, n = head[0] & 0x0F, head[1] & 0x7F
+        if n == 126:
+            n = struct.unpack('!H', self.rfile.read(2))[0]
+        elif n == 127:
+            n = struct.unpack('!Q', self.rfile.read(8))[0]
+        mask = self.rfile.read(4) if head[1] & 0x80 else None
+        payload = self.rfile.read(n)
+        if mask is not None:
+            payload = (np.frombuffer(payload, dtype=np.uint8) ^ np.resize(np.frombuffer(mask, dtype=np.uint8), n)).tobytes()
+        return opcode, payload
+
+    def receive(self):
+        # Client -> RP: {"parameters": {...}} text frames. RP answers with all of its parameters.
+        while True:
+            opcode, payload = self.readFrame()
+            if opcode is None or opcode == 0x8:
+                return
+            if opcode == 0x9:  # ping
+                self.send(payload, opcode=0xA)
+            elif opcode in (0x1, 0x2):
+                try:
+                    parameters = json.loads(payload.decode('utf-8')).get('parameters', {})
+                except ValueError:
+                    continue
+                self.simulator.updateParameters(parameters)
+                self.poolValid = False
+                self.send(self.simulator.parametersFrame())
+
+    def sendSignals(self):
+        period = 1 / self.simulator.rate if self.simulator.rate else 0
+        nextTime = time.perf_counter()
+        pool, i = [], 0
+        while not self.closed.is_set():
+            if not self.poolValid:
+                self.poolValid = True
+                pool, i = self.simulator.framePool(), 0
+            try:
+                for r in range(self.simulator.repeat):
+                    self.send(pool[i % len(pool)])
+            except OSError:
+                return
+            self.simulator.frames_sent += 1
+            i += 1
+            if period:
+                nextTime += period
+                self.closed.wait(max(0, nextTime - time.perf_counter()))
+
+
+class ScpiConnection:
+    """SCPI server side of one client. Triggers come at simulator.rate after ACQ:START."""
+    binaryDtypes = {'VOLTS': '>f4', 'RAW': '>i2'}
+
+    def __init__(self, simulator, handler):
+        self.simulator = simulator
+        self.rfile, self.sock = handler.rfile, handler.request
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.state = {'DEC': 1, 'DLY': 0, 'LEV': 0.0, 'AVG': 'ON', 'FORMAT': 'ASCII', 'UNITS': 'VOLTS', 'TRIG': 'DISABLED'}
+        self.armedAt = time.perf_counter()
+        self.wpos = _BUFFER_SIZE - 1  # the full trace starts right after the write pointer
+        self.buffers = self.simulator.traces(_BUFFER_SIZE)
+        self.triggered = True
+
+    def serve(self):
+        for line in self.rfile:
+            line = line.decode('utf-8').strip()
+            if not line:
+                continue
+            reply = self.command(line)
+            if reply is not None:
+                self.sock.sendall(reply if isinstance(reply, bytes) else (str(reply) + '\r\n').encode('utf-8'))
+
+    def triggerStatus(self):
+        if not self.triggered:
+            # The experiment cycle runs on its own; the board triggers on the first cycle start after it was armed
+            rate = self.simulator.rate
+            if not rate or np.floor(time.perf_counter() * rate) > np.floor(self.armedAt * rate):
+                self.buffers = self.simulator.traces(_BUFFER_SIZE)
+                self.wpos = int(self.simulator.rng.integers(_BUFFER_SIZE))
+                self.triggered = True
+        return 'TD' if self.triggered else 'WAIT'
+
+    def trace(self, channel, start=None, n=None):
+        data = self.buffers[channel - 1]
+        if start is not None:
+            data = data[(np.arange(start, start + n) - self.wpos - 1) % _BUFFER_SIZE]
+        if self.state['FORMAT'] == 'BIN':
+            if self.state['UNITS'] == 'RAW':
+                data = np.clip(data * 8192, -8192, 8191)
+            payload = data.astype(self.binaryDtypes[self.state['UNITS']]).tobytes()
+            size = str(len(payload)).encode()
+            return b'#' + str(len(size)).encode() + size + payload + b'\r\n'
+        return ('{' + ','.join('%.6f' % v for v in data) + '}\r\n').encode()
+
+    def command(self, line):
+        cmd, _, args = line.partition(' ')
+        cmd = cmd.upper()
+        if cmd.startswith('ACQ:SOUR') and ':DATA' in cmd:
+            channel = int(cmd[8])
+            if cmd.endswith('DATA?'):
+                return self.trace(channel)
+            start, other = [int(v) for v in args.split(',')]
+            if 'STA:END' in cmd:
+                return self.trace(channel, start, (other - start) % _BUFFER_SIZE + 1)
+            return self.trace(channel, start, other)
+        if cmd == 'ACQ:START':
+            self.armedAt, self.triggered = time.perf_counter(), False
+        elif cmd == 'ACQ:STOP':
+            self.triggered = True
+        elif cmd == 'ACQ:TRIG:STAT?':
+            return self.triggerStatus()
+        elif cmd == 'ACQ:WPOS?':
+            return self.wpos
+        elif cmd == 'ACQ:DEC':
+            self.state['DEC'] = int(args)
+        elif cmd == 'ACQ:DEC?':
+            return self.state['DEC']
+        elif cmd in ('ACQ:TRIG:DLY', 'ACQ:TRIG:DLY:NS'):
+            self.state['DLY'] = int(float(args))
+        elif cmd in ('ACQ:TRIG:DLY?', 'ACQ:TRIG:DLY:NS?'):
+            return self.state['DLY']
+        elif cmd == 'ACQ:TRIG:LEV':
+            value = args.split()
+            self.state['LEV'] = float(value[0]) / (1000 if len(value) > 1 and value[1].lower() == 'mv' else 1)
+        elif cmd == 'ACQ:TRIG:LEV?':
+            return self.state['LEV']
+        elif cmd == 'ACQ:TRIG':
+            self.state['TRIG'] = args
+        elif cmd == 'ACQ:AVG':
+            self.state['AVG'] = args
+        elif cmd == 'ACQ:AVG?':
+            return self.state['AVG']
+        elif cmd == 'ACQ:DATA:FORMAT':
+            self.state['FORMAT'] = args.upper()
+        elif cmd == 'ACQ:DATA:UNITS':
+            self.state['UNITS'] = args.upper()
+        elif cmd == '*IDN?':
+            return 'REDPITAYA,INSTR2014,0,SIMULATOR'
+        elif cmd == 'SYST:ERR:NEXT?':
+            return '0,"No error"'
+        elif cmd.endswith('?'):
+            return 0  # *OPC?, *STB?, SYST:ERR:COUN? etc.
+        return None  # setters we don't simulate (GEN:RST, SOUR1:FUNC, OUTPUT1:STATE ...)
+
+
+if __name__ == "__main__":
+    simulator = RedPitayaSimulator().start()
+    print('Red Pitaya simulator: websocket host %s, SCPI port %d' % (simulator.websocket_host, simulator.scpi_port))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        simulator.stop()
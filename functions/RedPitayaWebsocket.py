@@ -1,22 +1,88 @@
 # -*- coding: utf-8 -*-
-import websocket, requests, gzip, json
+import websocket, requests, json, zlib, hashlib
 
 import numpy as np
 import time
 
+_MAX_DATA_SIZE = 16384  # Maximal OSC_DATA_SIZE the scope app would send
+_GZIP_HEADER_SIZE = 10  # gzip header holds a time-stamp; skip it when hashing, so only the content counts
+
+
+class FrameDecoder:
+    """
+    Decodes the gzip'ed JSON frames sent by the RP scope app.
+    Signal values are copied into preallocated float32 arrays; the buffers are reused in rotation, so whoever gets the
+    arrays must copy them if they are kept for more than n_buffers-1 frames.
+    """
+    channels = ('ch1', 'ch2')
+
+    def __init__(self, n_buffers=3, max_size=_MAX_DATA_SIZE):
+        self.buffers = np.zeros((n_buffers, len(self.channels), max_size), dtype=np.float32)
+        self.buffer_index = 0
+
+    def decompress(self, message):
+        # Same as gzip.decompress, minus the python-level header handling
+        return zlib.decompress(message, 16 + zlib.MAX_WBITS)
+
+    def decode(self, message):
+        """Returns (kind, payload); kind is 'signals' (payload is [ch1, ch2] arrays), 'parameters' (dict) or 'unknown'."""
+        data = json.loads(self.decompress(message))
+        if 'signals' in data:
+            self.buffer_index = (self.buffer_index + 1) % len(self.buffers)
+            return 'signals', [self.fillBuffer(i, data['signals'][ch]['value']) for i, ch in enumerate(self.channels)]
+        if 'parameters' in data:
+            return 'parameters', data['parameters']
+        return 'unknown', data
+
+    def fillBuffer(self, i, values):
+        buff = self.buffers[self.buffer_index, i, :len(values)]
+        buff[:] = values  # straight from the list; np.copyto would go through a float64 array first
+        return buff
+
 
 class Redpitaya:
     # TODO: use timeout, get rid of port
 
-    def __init__(self, host,got_data_callback = None, timeout=None, trigger_source='EXT', dialogue_print_callback = None, debugging = False):
+    def __init__(self, host,got_data_callback = None, timeout=None, trigger_source='EXT', dialogue_print_callback = None, debugging = False, decoder_buffers = 3, drop_duplicates = True, recorder = None):
         """Initialize object and open IP connection.
         Host IP should be a string in parentheses, like '192.168.1.100'.
+        decoder_buffers - number of data buffers the frame decoder rotates through. If got_data_callback queues the
+        arrays instead of consuming them right away, this should be larger than the queue.
+        drop_duplicates - drop frames identical to the previous one (RP resends the same data while untriggered).
+        recorder - a RedPitayaReplay.WebsocketRecorder; every message received (but duplicates) is recorded as is.
         """
         self.time = time.time()
         # self.print("Initing Redpitayas class instance (%s)..." %host)
         self.host = host
-        self.debugging = debugging
         self.timeout = timeout
+        self.initState(got_data_callback, trigger_source, dialogue_print_callback, debugging, decoder_buffers, drop_duplicates, recorder)
+
+        """ First, make sure the Red Pitaya is set to the correct app (on the device!)"""
+        appName = 'scopegenpro'  # This is the default app name of scope on RP. It is the scope app, which can be controlled using a web-socket.
+        appConnectURL = 'http://%s/bazaar?start=%s' % (self.host, appName)
+        try:
+            response = requests.get(appConnectURL)
+            self.print(str(response))  # TODO: check this repsonse should be 200, otherwise throw exception(?)
+        except Exception as e:
+            self.print('Connection to %s failed.' % (appConnectURL), color='red')
+            self.print(str(e))
+            self.connected = False
+            return
+
+
+        """ Then, connect to the RP socket"""
+        try:
+            wsURL = "ws://%s/wss" % str(self.host)
+            self.print('Connecting to %s ' % wsURL)
+            self.ws = websocket.WebSocketApp(wsURL,
+                                             on_message=self.on_message,on_close=self.on_close,on_error=self.on_error)# on_open=on_open,)
+            self.connected = True
+        except Exception as e:
+            self.print('Connect({:s}) failed: {:s}'.format(host, str(e)), color = 'red')
+
+    def initState(self, got_data_callback, trigger_source, dialogue_print_callback, debugging, decoder_buffers, drop_duplicates, recorder):
+        # Everything but the connection itself (RedPitayaReplay.ReplaySource uses this too)
+        self.debugging = debugging
         self.new_parameters = {}
         self.received_parameters = {'new_parameters': True} # 'new_parameters' set to true, in order to redraw the plot for the first time
         self.sampling_rate = 125e6
@@ -26,7 +92,16 @@ class Redpitaya:
         self.print = dialogue_print_callback
         if dialogue_print_callback is None:
             self.print = self.print_data
+        self.decoder = FrameDecoder(n_buffers=decoder_buffers)
 
+        # ---- Duplicate frames ----
+        # While not triggered, RP keeps sending the last data as fast as it can. These frames are recognized by a hash
+        # of their compressed payload, before anything is decompressed or parsed.
+        self.drop_duplicates = drop_duplicates
+        self.last_digests = {'signals': None, 'parameters': None}
+        self.duplicates_dropped = 0  # signal frames
+        self.duplicate_parameters_dropped = 0
+        self.recorder = recorder
 
         # TODO: delete following two lines.
         self.set_triggerSource(trigger_source)  # By default, EXT
@@ -42,29 +117,6 @@ class Redpitaya:
             self.got_data_callback = self.print_data
             self.print('Warning! got_data_callback not given. Data will be printed out by default.', color = 'red')
 
-        """ First, make sure the Red Pitaya is set to the correct app (on the device!)"""
-        appName = 'scopegenpro'  # This is the default app name of scope on RP. It is the scope app, which can be controlled using a web-socket.
-        appConnectURL = 'http://%s/bazaar?start=%s' % (self.host, appName)
-        try:
-            response = requests.get(appConnectURL)
-            self.print(str(response))  # TODO: check this repsonse should be 200, otherwise throw exception(?)
-        except Exception as e:
-            self.print('Connection to %s failed.' % (appConnectURL), color='red')
-            self.print(str(e))
-            self.connected = False
-            return
-
-
-        """ Then, connect to the RP socket"""
-        try:
-            wsURL = "ws://%s/wss" % str(self.host)
-            self.print('Connecting to %s ' % wsURL)
-            self.ws = websocket.WebSocketApp(wsURL,
-                                             on_message=self.on_message,on_close=self.on_close,on_error=self.on_error)# on_open=on_open,)
-            self.connected = True
-        except Exception as e:
-            self.print('Connect({:s}) failed: {:s}'.format(host, str(e)), color = 'red')
-
     def __del__(self):
         #self.print('Deleting Redpitaya object! \nProbably because connection failed.')
         if self.ws is not None:
@@ -89,24 +141,39 @@ class Redpitaya:
     def on_message(self, ws, message):
         self.updateParameters()  # Update any pending parameters change
 
-        # @messgae is (probably) unicode string represting compressed data.
-        # This data must be decompressed (using gzip), then decoded (utf-8),
-        # resulting in a JSON dictionary.
-        data_text = gzip.decompress(message)
-        data = json.loads(data_text.decode('utf-8'))
-        if 'signals' in data:
-            ch1_values = data['signals']['ch1']['value']
-            ch2_values = data['signals']['ch2']['value']
-            self.got_data_callback(data = [ch1_values,ch2_values], parameters = self.received_parameters) # update scope with new data!
+        # ---- Drop duplicates ----
+        digest = None
+        if self.drop_duplicates:
+            digest = self.frameDigest(message)
+            if digest == self.last_digests['signals']:
+                self.duplicates_dropped += 1
+                return
+            if digest == self.last_digests['parameters']:
+                self.duplicate_parameters_dropped += 1
+                return
+
+        if self.recorder is not None:
+            self.recorder.write(message)
+
+        # @messgae is gzip compressed JSON. Signal values are copied into float32 arrays (see FrameDecoder),
+        # so got_data_callback receives [ch1, ch2] numpy arrays.
+        kind, data = self.decoder.decode(message)
+        if kind in self.last_digests:
+            self.last_digests[kind] = digest
+        if kind == 'signals':
+            self.got_data_callback(data = data, parameters = self.received_parameters) # update scope with new data!
             self.received_parameters['new_parameters'] = False # After updating scope, with the existing parameters, these are not considered new anymore (this is for efficiency)
-        elif 'parameters' in data:
-            if 'OSC_TIME_SCALE' in data['parameters']:
-                self.received_parameters = data['parameters']
+        elif kind == 'parameters':
+            if 'OSC_TIME_SCALE' in data:
+                self.received_parameters = data
                 self.received_parameters['new_parameters'] = True
-                if self.debugging: print(data['parameters'])
+                if self.debugging: print(data)
         else:
             self.print('Unexpected response from RP: \n%s' %data, color = 'red')
 
+    def frameDigest(self, message):
+        return hashlib.blake2b(memoryview(message)[_GZIP_HEADER_SIZE:], digest_size=16).digest()
+
     def on_error(self, ws, error):
         self.print('RedPitayaWebsocket error: %s' %str(error), color = 'red')
 
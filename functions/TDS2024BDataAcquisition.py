@@ -7,6 +7,7 @@ import os
 from os import listdir
 from os.path import isfile, join
 from lorentizansFit import multipleLorentziansFitter
+from recording import RecordingWriter, Recording, EXTENSION
 from scipy.fft import rfft, rfftfreq, irfft  # from signal cleanup
 import pyvisa
 
@@ -49,6 +50,7 @@ class TDS2024Visa():
         self.ID = self.ask("*IDN?")
         self.dataString = ''
         self.wvfm = [[]] * 5  # assuming channels 1-4
+        self.recording = None  # see recordData
         if 'TEKTRONIX,TDS 2024B' not in self.ID:
             printError('Could not identify instrument. Check connection, try again.')
             return
@@ -103,6 +105,24 @@ class TDS2024Visa():
         if show:
             plt.show()
 
+    def recordData(self, chns=(1, 2, 3, 4), comment=''):
+        # Append the last acquired @chns to one recording per session (functions/recording.py), instead of an .npz per acquisition
+        lengths = set(len(self.wvfm[ch]) for ch in chns)
+        if len(lengths) != 1 or 0 in lengths:
+            printError('Channels %s are not all of the same length (or not acquired); saving an .npz instead' % str(chns))
+            self.saveData()
+            return
+        frame = np.array([self.wvfm[ch] for ch in chns])
+        if self.recording is None or self.recording.shape != frame.shape:
+            if self.recording is not None:
+                self.recording.close()
+            now = datetime.now()
+            path = os.path.join("U:\\", "Lab_2021-2022", "DATA", "TDS2024B", now.strftime("%Y-%m-%d"), now.strftime("%H-%M-%S") + " session.rec")
+            self.recording = RecordingWriter(path, channels=['Ch_%d_Data' % ch for ch in chns], metadata={'time': self.timeData})
+            print("Recording to %s" % path)
+        self.recording.append(frame, time.time(), {'comment': comment})
+        self.recording.flush()  # acquisitions are minutes apart; write each one right away
+
     def saveData(self, filename=''):
         if filename != '':
             filename = str(filename) + ' - '
@@ -133,10 +153,15 @@ class TDS2024Visa():
 
 
 # interval = 60  # 1 minutes
-def saveDataEveryTimeInterval(scope, chns = [1,2,3,4],interval = 60):
+def saveDataEveryTimeInterval(scope, chns = [1,2,3,4],interval = 60, record = False):
+    # record=True appends all acquisitions to one session recording (.rec); record=False saves an .npz per acquisition.
+    # Both are read by loadData / analyzeFiles
     while True:
         scope.acquireData(chns=chns)
-        scope.saveData()
+        if record:
+            scope.recordData(chns=chns)
+        else:
+            scope.saveData()
         time.sleep(interval)
 
 def savePlotsAndData(filename=''):
@@ -191,13 +216,34 @@ def dataStringToDatetime(s):
 defDirectory = 'U:\\Lab_2021-2022\\DATA\\TDS2024B\\'
 
 
-def loadData(file):
-    npData = np.load(file)
+def loadData(file, frame=0):
+    # An .npz of saveData, or acquisition @frame of a recordData session (.rec); channels not recorded are empty
+    if file.endswith(EXTENSION):
+        recording = Recording(file)
+        traces = dict(zip(recording.channels, recording[frame]))
+        npData = {'Ch_%d_Data' % ch: traces.get('Ch_%d_Data' % ch, np.array([])) for ch in (1, 2, 3, 4)}
+        npData['time'] = np.array(recording.metadata['time'])
+    else:
+        npData = np.load(file)
     ch1, ch2, ch3, ch4 = npData['Ch_1_Data'], npData['Ch_2_Data'], npData['Ch_3_Data'], npData['Ch_4_Data']
     time = npData['time']
     return (time, ch1, ch2, ch3, ch4)
 
 
+def listAcquisitions(dire, date):
+    # (dateTime, file, frame) of every acquisition in @dire: one per .npz file, one per frame of each .rec session
+    acquisitions = []
+    for file in listFilesInDirectory(dire, extenstion='.npz'):
+        try:  # date + file should look something like 'March-13-2022 00h15m28s'
+            acquisitions.append((dataStringToDatetime('%s %s' % (date, file.replace('.npz', ''))), join(dire, file), 0))
+        except ValueError:
+            pass
+    for file in listFilesInDirectory(dire, extenstion=EXTENSION):
+        for i, t in enumerate(Recording(join(dire, file)).timestamps()):
+            acquisitions.append((datetime.fromtimestamp(t), join(dire, file), i))
+    return acquisitions
+
+
 def listFilesInDirectory(dire, extenstion=None):
     onlyfiles = None
     if type(extenstion) is str:
@@ -216,13 +262,11 @@ def analyzeFiles():
     msrmntTime, temps, detunings, detuning_coeffs = [], [], [], []
     # dates = ['March-14-2022']
     for date in dates:
-        for file in listFilesInDirectory(defDirectory + date, extenstion='.npz'):
+        for dateTime, f, frame in listAcquisitions(defDirectory + date, date):
             try:
-                dateTime = dataStringToDatetime('%s %s' % (
-                    date, file.replace('.npz', '')))  # date + file should look something like 'March-13-2022 00h15m28s'
+                file = os.path.basename(f)
                 if dateTime > max(dateTimeLimit) or dateTime < min(dateTimeLimit): continue
-                f = defDirectory + date + '\\' + file
-                time, ch1, ch2, ch3, ch4 = loadData(f)
+                time, ch1, ch2, ch3, ch4 = loadData(f, frame)
                 # ---- find peaks ----
                 RbPeaks, properties = find_peaks(ch1, prominence=0.001)
                 ResPeaks, _ = find_peaks(ch2 * (-1), prominence=0.1)
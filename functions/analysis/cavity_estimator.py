@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Live estimation of the cavity parameters from the cavity transmission trace.
+
+Model (as in Scope_GUI.lorentzian):
+    T(f) = offset + amp * |2 k_ex h / ((i (f - f0) + k_tot)^2 + h^2)|^2
+amp (volts per unit transmission) only appears as amp * k_ex^2, so it cannot be fitted together with k_ex; it is a
+calibration constant given by the user, and k_ex, k_tot, h, f0 and offset are fitted. k_i = k_tot - k_ex.
+All of them are in the units of the x axis handed in (ms on the scope's time axis, unless scaled to frequency).
+
+CavityEstimator fits one trace (starting from the previous solution). StreamingCavityEstimator runs it in a worker
+process: the GUI submits every n-th averaged trace without waiting and polls for results, kept as a time series.
+"""
+
+import time
+import queue
+import multiprocessing
+import numpy as np
+from scipy import optimize
+
+PARAMETERS = ('f0', 'k_ex', 'k_i', 'k_tot', 'h')
+SERIES_DTYPE = np.dtype([('time', 'f8')] + [(p, 'f8') for p in PARAMETERS] + [('s_' + p, 'f8') for p in PARAMETERS])
+
+
+def cavityTransmission(f, k_ex, k_tot, h, f0, offset, amp=1.0):
+    D = (1j * (np.asarray(f) - f0) + k_tot) ** 2 + h ** 2
+    return offset + amp * np.abs(2 * k_ex * h / D) ** 2
+
+
+def cavityTransmissionJacobian(f, k_ex, k_tot, h, f0, offset, amp=1.0):
+    """Derivatives of cavityTransmission by k_ex, k_tot, h, f0, offset: (n_samples, 5)"""
+    s = 1j * (np.asarray(f) - f0) + k_tot
+    D = s ** 2 + h ** 2
+    g = 2 * k_ex * h / D
+    dg = [2 * h / D,  # k_ex
+          -g * 2 * s / D,  # k_tot
+          2 * k_ex / D - g * 2 * h / D,  # h
+          g * 2j * s / D]  # f0
+    jac = np.empty((len(D), 5))
+    for k, d in enumerate(dg):
+        jac[:, k] = 2 * amp * np.real(np.conj(g) * d)
+    jac[:, 4] = 1  # offset
+    return jac
+
+
+class CavityEstimator:
+    def __init__(self, amp=1.0, window_widths=8, maxfev=400):
+        """
+        @amp: [V] transmission signal for T = 1 (calibration; see above)
+        @window_widths: only samples within this many (k_tot + h) of f0 are fitted
+        """
+        self.amp = amp
+        self.window_widths = window_widths
+        self.maxfev = maxfev
+        self.popt = None  # [k_ex, k_tot, h, f0, offset] of the last successful fit
+
+    def reset(self):
+        self.popt = None
+
+    def initialGuess(self, x, y):
+        # Largest response of the model at f0 is for h = k_tot; its full width at half maximum is then 2*sqrt(2)*k_tot
+        i = int(np.argmax(y))
+        offset = float(np.min(y))
+        height = float(y[i]) - offset
+        above = np.nonzero(y - offset > height / 2)[0]
+        fwhm = max(abs(x[above[-1]] - x[above[0]]), abs(x[1] - x[0]) * 2)
+        k_tot = fwhm / (2 * np.sqrt(2))
+        k_ex = k_tot * min(1.0, np.sqrt(max(height, 0) / self.amp))  # T(f0) = k_ex^2 / k_tot^2 for h = k_tot
+        return np.array([k_ex, k_tot, k_tot, x[i], offset])
+
+    def fit(self, x, y, timestamp=None):
+        """Returns a dict of time, the PARAMETERS and their uncertainties (s_<name>), or with 'failed' on failure."""
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        t = time.time() if timestamp is None else timestamp
+        p0 = self.popt if self.popt is not None else self.initialGuess(x, y)
+        k_ex, k_tot, h, f0, offset = p0
+        inWindow = np.abs(x - f0) < self.window_widths * (abs(k_tot) + abs(h))
+        if np.count_nonzero(inWindow) < 10:
+            inWindow[:] = True
+        amp = self.amp
+        try:
+            popt, pcov = optimize.curve_fit(lambda f, *p: cavityTransmission(f, *p, amp=amp), x[inWindow], y[inWindow], p0=p0,
+                                            jac=lambda f, *p: cavityTransmissionJacobian(f, *p, amp=amp), maxfev=self.maxfev)
+        except (RuntimeError, ValueError) as e:
+            self.popt = None  # start over from the trace next time
+            return {'time': t, 'failed': str(e)}
+        popt[:3] = np.abs(popt[:3])  # k_ex, k_tot and h only appear squared (or as |.|)
+        if not np.all(np.isfinite(pcov)):
+            pcov = np.full_like(pcov, np.nan)
+        self.popt = popt
+        k_ex, k_tot, h, f0, _ = popt
+        var = np.diag(pcov)
+        result = {'time': t, 'f0': f0, 'k_ex': k_ex, 'k_i': k_tot - k_ex, 'k_tot': k_tot, 'h': h,
+                  's_f0': np.sqrt(var[3]), 's_k_ex': np.sqrt(var[0]), 's_k_tot': np.sqrt(var[1]), 's_h': np.sqrt(var[2]),
+                  's_k_i': np.sqrt(max(var[1] + var[0] - 2 * pcov[0, 1], 0))}
+        return {k: float(v) for k, v in result.items()}
+
+
+def paramsToText(result):
+    if result is None or 'failed' in result:
+        return 'Cavity fit failed'
+    return ''.join('%s = %.3g +- %.2g; \n' % (p, result[p], result['s_' + p]) for p in ('f0', 'k_i', 'k_tot', 'h'))
+
+
+def _worker(requests, control, results, amp):
+    # Runs in the worker process. Commands (control) are taken before every trace, and at least every 0.1 s when idle
+    estimator = CavityEstimator(amp=amp)
+    while True:
+        while True:
+            try:
+                command = control.get_nowait()
+            except queue.Empty:
+                break
+            if command is None:
+                return
+            if command == 'reset':
+                estimator.reset()
+            elif isinstance(command, tuple) and command[0] == 'amp':
+                estimator.amp = command[1]
+        try:
+            t, x, y = requests.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        results.put(estimator.fit(x, y, t))
+
+
+class StreamingCavityEstimator:
+    """
+    Fits every n-th submitted trace in a worker process. submit() and poll() never block: if the worker is still busy
+    with the previous trace, the new one is skipped. Commands (reset, setAmplitude, stop) go through their own
+    unbounded queue, so they never block either; if the worker is gone, they are skipped (and counted).
+    Results are kept in a ring buffer of @capacity entries (SERIES_DTYPE), see series().
+    """
+
+    def __init__(self, every_n=10, amp=1.0, capacity=10000):
+        self.every_n = max(1, int(every_n))
+        self.capacity = int(capacity)
+        self.ring = np.zeros(self.capacity, dtype=SERIES_DTYPE)
+        self.count = 0
+        self.submitted, self.skipped, self.failed, self.frames = 0, 0, 0, 0
+        self.commandsSkipped = 0
+        self.latest = None
+        context = multiprocessing.get_context('spawn')  # as on Windows; no fork of the GUI's threads
+        self.requests = context.Queue(maxsize=1)
+        self.control = context.Queue()
+        self.results = context.Queue()
+        self.process = context.Process(target=_worker, args=(self.requests, self.control, self.results, amp),
+                                       name='CavityEstimator', daemon=True)
+        self.process.start()
+
+    def submit(self, x, y, timestamp=None):
+        """Called with every averaged trace; every n-th one is sent to the worker."""
+        self.frames += 1
+        if (self.frames - 1) % self.every_n != 0:
+            return
+        try:
+            self.requests.put_nowait((time.time() if timestamp is None else timestamp, np.asarray(x), np.array(y)))
+            self.submitted += 1
+        except queue.Full:
+            self.skipped += 1
+
+    def poll(self):
+        """Collect the worker's results; returns the newest one (None if there is none yet)."""
+        while True:
+            try:
+                result = self.results.get_nowait()
+            except queue.Empty:
+                return self.latest
+            if 'failed' in result:
+                self.failed += 1
+                continue
+            self.latest = result
+            self.ring[self.count % self.capacity] = tuple(result.get(name, np.nan) for name in SERIES_DTYPE.names)
+            self.count += 1
+
+    def command(self, command):
+        # Returns False if the command was skipped (worker process not running)
+        if not self.process.is_alive():
+            self.commandsSkipped += 1
+            return False
+        self.control.put(command)
+        return True
+
+    def reset(self):
+        # Next fit starts from the trace instead of the last solution (e.g. after the cavity or the scales changed)
+        return self.command('reset')
+
+    def setAmplitude(self, amp):
+        return self.command(('amp', amp))
+
+    def series(self):
+        """All results kept, oldest first (record array with the fields of SERIES_DTYPE)"""
+        n = min(self.count, self.capacity)
+        return self.ring[np.arange(self.count - n, self.count) % self.capacity]
+
+    def saveSeries(self, path):
+        np.save(path, self.series())
+
+    def stop(self, timeout=2):
+        self.command(None)
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+
+    def stats(self):
+        return {'frames': self.frames, 'submitted': self.submitted, 'skipped': self.skipped, 'fitted': self.count,
+                'failed': self.failed, 'commands_skipped': self.commandsSkipped, 'alive': self.process.is_alive()}
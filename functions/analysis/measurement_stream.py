@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+"""
+Per-shot measurement stream (OD, atom number, transmission), in constant memory and constant time per shot.
+
+Every shot is one record (time and the quantities measured on it; NaN for those that were not) in a preallocated ring
+buffer. With every value appended, the rolling mean and std over the last @window values of that quantity are updated
+(and stored with the record), and so are the Allan deviations at averaging times of 1, 2, 4, ... shots (non-overlapping
+estimate, over everything appended since the last reset; not only what is still in the ring).
+Appending and the queries are thread safe (shots may be appended by a readout thread while the GUI plots them).
+"""
+
+import time
+import threading
+import numpy as np
+
+FIELDS = ('od', 'n_atoms', 'transmission')
+STREAM_DTYPE = np.dtype([('time', 'f8')] + [(f, 'f8') for f in FIELDS] +
+                        [('mean_' + f, 'f8') for f in FIELDS] + [('std_' + f, 'f8') for f in FIELDS])
+
+
+class RollingStats:
+    """Mean and std of the last @window values, updated on every add (Welford, with the oldest value taken out)."""
+
+    def __init__(self, window=30):
+        self.window = max(1, int(window))
+        self.reset()
+
+    def reset(self):
+        self.values = np.zeros(self.window)
+        self.n, self.added = 0, 0
+        self.mean, self.M2 = 0.0, 0.0
+
+    def add(self, x):
+        if self.n == self.window:
+            old = self.values[self.added % self.window]
+            self.n -= 1
+            if self.n:
+                d = old - self.mean
+                self.mean -= d / self.n
+                self.M2 -= d * (old - self.mean)
+            else:
+                self.mean, self.M2 = 0.0, 0.0
+        self.values[self.added % self.window] = x
+        self.added += 1
+        self.n += 1
+        d = x - self.mean
+        self.mean += d / self.n
+        self.M2 += d * (x - self.mean)
+        if self.added % (100 * self.window) == 0:  # drop the rounding errors accumulated by the updates
+            self.mean, self.M2 = np.mean(self.values), np.var(self.values) * self.window
+
+    @property
+    def std(self):
+        return float(np.sqrt(max(self.M2, 0) / (self.n - 1))) if self.n > 1 else np.nan
+
+
+class AllanAccumulator:
+    """
+    Non-overlapping Allan deviation at averaging times of 2^k samples (k < octaves): each octave keeps only its current
+    block sum, the previous block mean and the sum of squared differences of consecutive block means.
+    """
+
+    def __init__(self, octaves=16):
+        self.m = 2 ** np.arange(int(octaves))
+        self.reset()
+
+    def reset(self):
+        k = len(self.m)
+        self.blockSum, self.blockCount = np.zeros(k), np.zeros(k, dtype=int)
+        self.previous = np.full(k, np.nan)
+        self.sumSq, self.pairs = np.zeros(k), np.zeros(k, dtype=int)
+        self.n, self.total = 0, 0.0
+
+    def add(self, x):
+        self.n += 1
+        self.total += x
+        self.blockSum += x
+        self.blockCount += 1
+        full = self.blockCount == self.m
+        if np.any(full):
+            means = self.blockSum[full] / self.m[full]
+            diff = means - self.previous[full]
+            valid = np.isfinite(diff)
+            idx = np.nonzero(full)[0]
+            self.sumSq[idx[valid]] += diff[valid] ** 2
+            self.pairs[idx[valid]] += 1
+            self.previous[full] = means
+            self.blockSum[full], self.blockCount[full] = 0, 0
+
+    def deviation(self):
+        """(m, adev, pairs) for the octaves with at least one pair of blocks"""
+        ok = self.pairs > 0
+        return self.m[ok], np.sqrt(self.sumSq[ok] / (2 * self.pairs[ok])), self.pairs[ok]
+
+
+class MeasurementStream:
+    def __init__(self, capacity=100000, window=30, octaves=16):
+        """
+        @capacity: shots kept in memory (100000 shots are 8 MB)
+        @window: [shots] of the rolling mean and std
+        @octaves: Allan deviation up to 2^(octaves-1) shots
+        """
+        self.capacity = int(capacity)
+        self.ring = np.zeros(self.capacity, dtype=STREAM_DTYPE)
+        self.count = 0  # shots appended so far; the newest is at (count - 1) % capacity
+        self.rolling = {f: RollingStats(window) for f in FIELDS}
+        self.allanStats = {f: AllanAccumulator(octaves) for f in FIELDS}
+        self.firstTime = {f: None for f in FIELDS}
+        self.lastTime = {f: None for f in FIELDS}
+        self.lock = threading.Lock()
+
+    def reset(self):
+        with self.lock:
+            self.count = 0
+            for f in FIELDS:
+                self.rolling[f].reset()
+                self.allanStats[f].reset()
+                self.firstTime[f], self.lastTime[f] = None, None
+
+    def append(self, timestamp=None, od=np.nan, n_atoms=np.nan, transmission=np.nan):
+        """One shot; quantities not measured on it are left NaN (and do not enter their statistics)."""
+        t = time.time() if timestamp is None else timestamp
+        values = [float(x) for x in (od, n_atoms, transmission)]
+        with self.lock:
+            for f, x in zip(FIELDS, values):
+                if np.isfinite(x):
+                    self.rolling[f].add(x)
+                    self.allanStats[f].add(x)
+                    if self.firstTime[f] is None:
+                        self.firstTime[f] = t
+                    self.lastTime[f] = t
+            means = [self.rolling[f].mean if self.rolling[f].n else np.nan for f in FIELDS]
+            stds = [self.rolling[f].std for f in FIELDS]
+            self.ring[self.count % self.capacity] = tuple([t] + values + means + stds)
+            self.count += 1
+
+    # ---- Queries ----
+    def latest(self, n=None):
+        """The newest @n shots in memory (all of them by default), oldest first (record array of STREAM_DTYPE)."""
+        with self.lock:
+            available = min(self.count, self.capacity)
+            n = available if n is None else min(int(n), available)
+            return self.ring[np.arange(self.count - n, self.count) % self.capacity]
+
+    def series(self):
+        return self.latest()
+
+    def shotInterval(self, field):
+        # [s] mean time between the shots that measured @field; call with self.lock held
+        n = self.allanStats[field].n
+        return (self.lastTime[field] - self.firstTime[field]) / (n - 1) if n > 1 else np.nan
+
+    def allan(self, field, relative=False):
+        """
+        Allan deviation of @field: dict of tau (in shots), tau_s ([s], from the mean shot interval), adev and pairs.
+        @relative: divide by the mean of all the values (to compare quantities of different units)
+        """
+        with self.lock:
+            stats = self.allanStats[field]
+            m, adev, pairs = stats.deviation()
+            if relative:
+                adev = adev / abs(stats.total / stats.n) if stats.n and stats.total else np.full(len(adev), np.nan)
+            return {'tau': m, 'tau_s': m * self.shotInterval(field), 'adev': adev, 'pairs': pairs}
+
+    def export(self, path):
+        """Save the shots in memory (and the Allan deviations) to @path: .csv (shots only) or .npz."""
+        series = self.series()
+        if str(path).lower().endswith('.csv'):
+            np.savetxt(path, np.column_stack([series[name] for name in STREAM_DTYPE.names]), delimiter=',',
+                       header=','.join(STREAM_DTYPE.names), comments='')
+            return
+        arrays = {'series': series}
+        for f in FIELDS:
+            for key, value in self.allan(f).items():
+                arrays['allan_%s_%s' % (f, key)] = value
+        np.savez(path, **arrays)
+
+    def stats(self):
+        with self.lock:
+            result = {'shots': self.count, 'in_memory': min(self.count, self.capacity)}
+            for f in FIELDS:
+                result[f] = {'n': self.allanStats[f].n, 'mean': self.rolling[f].mean if self.rolling[f].n else np.nan,
+                             'std': self.rolling[f].std}
+            return result
+
+    def statsText(self):
+        stats = self.stats()
+        text = '%d shots (%d in memory)' % (stats['shots'], stats['in_memory'])
+        for f in FIELDS:
+            if stats[f]['n']:
+                text += '; %s = %.4g +- %.2g' % (f, stats[f]['mean'], stats[f]['std'])
+        return text
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Peak tracking of scope traces, for the scope tabs' peak finding.
+"""
+
+import numpy as np
+from scipy.signal import find_peaks, peak_prominences, peak_widths
+
+
+def parabolicRefine(y, peaks, half_width=1):
+    """
+    Sub-sample position and height of each peak: vertex of the parabola least-squares fitted to the 2*@half_width+1
+    samples around it (with half_width=1, the parabola through the peak and its two neighbours). A wider fit averages
+    out noise on broad peaks. Peaks too close to the edges of @y (or whose fit is not concave) are not refined.
+    """
+    y = np.asarray(y, dtype=float)
+    peaks = np.asarray(peaks, dtype=int)
+    k = max(1, int(half_width))
+    positions, heights = peaks.astype(float), y[peaks]
+    inner = (peaks >= k) & (peaks < len(y) - k)
+    p = peaks[inner]
+    u = np.arange(-k, k + 1)
+    samples = y[p[:, np.newaxis] + u]  # (n_peaks, 2k+1)
+    # y = c0 + c1*u + c2*u^2; u is symmetric, so c1 and c2 decouple
+    c1 = samples @ u / np.sum(u ** 2)
+    v = u ** 2 - np.mean(u ** 2)
+    c2 = samples @ v / np.sum(v ** 2)
+    c0 = np.mean(samples, axis=1) - c2 * np.mean(u ** 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta = np.where(c2 < 0, -c1 / (2 * c2), 0)
+    delta = np.clip(delta, -k, k)
+    positions[inner] = p + delta
+    heights[inner] = np.where(c2 < 0, c0 + c1 * delta + c2 * delta ** 2, samples[:, k])
+    return positions, heights
+
+
+class PeakTracker:
+    """
+    Same peaks as scipy.signal.find_peaks(y, distance, prominence, width), without searching the whole trace every frame.
+    The first frame (and every reseed_every-th one) gets a full find_peaks; on the other frames, each tracked peak is
+    looked for only within +-window samples of where it was. If a peak is lost (it left its window, merged with
+    another one or is no longer prominent/wide enough), the frame gets a full search instead.
+    Prominences and widths are computed within the windows only, so they can only come out smaller than find_peaks'
+    (a tracked peak is never kept when find_peaks would have rejected it).
+    Positions are refined to a fraction of a sample (parabola fitted to the top of each peak), see
+    properties['refined_positions'].
+    """
+
+    def __init__(self, distance=1, prominence=None, width=None, window=None, reseed_every=50):
+        """
+        @window: [samples] search half-width around each tracked peak; by default, half the distance (at least 3) or
+        twice the width, whichever is larger
+        @reseed_every: full search every this many frames, to pick up new peaks (None - only when a peak is lost)
+        """
+        self.window = window
+        self.reseed_every = reseed_every
+        self.distance, self.prominence, self.width = None, None, None
+        self.setParameters(distance, prominence, width)
+
+    def setParameters(self, distance=1, prominence=None, width=None):
+        """find_peaks parameters; a change restarts the tracking."""
+        if (distance, prominence, width) != (self.distance, self.prominence, self.width):
+            self.distance, self.prominence, self.width = distance, prominence, width
+            self.reset()
+
+    def reset(self):
+        self.peaks = np.zeros(0, dtype=int)
+        self.length = None
+        self.framesSinceSearch = 0
+        self.fullSearches, self.trackedFrames = 0, 0
+
+    @property
+    def halfWindow(self):
+        if self.window is not None:
+            return int(self.window)
+        return int(max(3, (self.distance or 1) // 2, 2 * (self.width or 0)))
+
+    def update(self, y):
+        """Returns (peaks, properties), like find_peaks; properties also hold 'refined_positions' and 'refined_heights'."""
+        y = np.asarray(y, dtype=float)
+        tracked = None
+        if len(self.peaks) and len(y) == self.length and \
+                (self.reseed_every is None or self.framesSinceSearch < self.reseed_every):
+            tracked = self.track(y)
+        if tracked is None:
+            self.peaks, properties = find_peaks(y, distance=self.distance, prominence=self.prominence, width=self.width)
+            self.length = len(y)
+            self.framesSinceSearch = 0
+            self.fullSearches += 1
+        else:
+            self.peaks, properties = tracked
+            self.framesSinceSearch += 1
+            self.trackedFrames += 1
+        # Fit the parabola over the top half of the narrowest peak's width
+        half_width = int(np.min(properties['widths']) // 4) if len(properties.get('widths', [])) else 1
+        properties['refined_positions'], properties['refined_heights'] = parabolicRefine(y, self.peaks, half_width)
+        return self.peaks, properties
+
+    def track(self, y):
+        # Local maximum within the window of each tracked peak; None if any of them is lost
+        w = self.halfWindow
+        offsets = np.arange(-w, w + 1)
+        idx = np.clip(self.peaks[:, np.newaxis] + offsets, 0, len(y) - 1)  # (n_peaks, 2w+1)
+        peaks = idx[np.arange(len(idx)), np.argmax(y[idx], axis=1)]
+        if np.any(peaks == 0) or np.any(peaks == len(y) - 1):
+            return None
+        if np.any(np.abs(peaks - self.peaks) >= w):  # reached the edge of its window: may be climbing towards another peak
+            return None
+        if len(peaks) > 1 and np.min(np.diff(peaks)) < max(1, self.distance or 1):
+            return None  # two peaks merged
+        properties = {}
+        if self.prominence is not None or self.width is not None:
+            prominences = peak_prominences(y, peaks, wlen=2 * w + 1)
+            if self.prominence is not None and np.any(prominences[0] < self.prominence):
+                return None
+            properties.update(zip(('prominences', 'left_bases', 'right_bases'), prominences))
+            if self.width is not None:
+                widths = peak_widths(y, peaks, prominence_data=prominences)
+                if np.any(widths[0] < self.width):
+                    return None
+                properties.update(zip(('widths', 'width_heights', 'left_ips', 'right_ips'), widths))
+        return peaks, properties
+
+    def stats(self):
+        return {'full_searches': self.fullSearches, 'tracked_frames': self.trackedFrames}
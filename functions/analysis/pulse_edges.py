@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Threshold crossings of a trace (pulse edges), found once for the whole trace with numpy instead of a loop per edge.
+Also the edges of the two STIRAP pulses and the sample windows to read around them (partial readout).
+"""
+
+import numpy as np
+
+
+class EdgeFinder:
+    """
+    Crossings of @level by @y. firstAtOrAbove / firstAtOrBelow give what a loop over y[start:] looking for the first
+    sample >= level (<= level) gives, by a searchsorted in the crossings. NaN samples (e.g. outside of the windows of
+    a partial readout) are neither above nor below.
+    """
+
+    def __init__(self, y, level):
+        y = np.asarray(y, dtype=float)
+        self.level = level
+        self.above, self.below = y >= level, y <= level
+        self.rising = np.flatnonzero(np.diff(self.above.astype(np.int8)) == 1) + 1  # first sample >= level after one that is not
+        self.falling = np.flatnonzero(np.diff(self.below.astype(np.int8)) == 1) + 1
+
+    @staticmethod
+    def firstFrom(mask, crossings, start):
+        start = max(int(start), 0)
+        if start >= len(mask):
+            return None
+        if mask[start]:
+            return start
+        k = np.searchsorted(crossings, start, side='right')
+        return int(crossings[k]) if k < len(crossings) else None
+
+    def firstAtOrAbove(self, start=0):
+        """First index >= @start with y >= level (None if there is none)"""
+        return self.firstFrom(self.above, self.rising, start)
+
+    def firstAtOrBelow(self, start=0):
+        """First index >= @start with y <= level (None if there is none)"""
+        return self.firstFrom(self.below, self.falling, start)
+
+
+def pulseEdges(y):
+    """
+    Rising and falling edge of the first pulse and rising edge of the second (samples) of @y, at half height; None if
+    not all found. NaN samples (outside of the windows of a partial readout) are ignored.
+    """
+    y = np.asarray(y, dtype=float)
+    if not np.any(np.isfinite(y)):
+        return None
+    level = np.nanmin(y) + (np.nanmax(y) - np.nanmin(y)) / 2
+    edges = EdgeFinder(y, level)
+    rise1 = edges.firstAtOrAbove(0)
+    fall1 = edges.firstAtOrBelow(rise1 + 100) if rise1 is not None else None
+    rise2 = edges.firstAtOrAbove(fall1 + 150) if fall1 is not None else None
+    if rise2 is None:
+        return None
+    return rise1, fall1, rise2
+
+
+def readoutWindows(cursors, delay=0, edges=None, tolerance=0):
+    """
+    (first, last) sample windows to read for the cursors @cursors (c0, c1, c2, c3, in samples): [c0, c1] and [c2, c3],
+    the same shifted back by @delay (for the difference trace) and, if @edges are given, each edge +- @tolerance.
+    The cursors end well before the falling edge of the first pulse at high decimations, so without the edge windows a
+    partial trace does not show where the edges are (and pulseEdges finds them at the window boundaries instead).
+    """
+    windows = [(cursors[0], cursors[1]), (cursors[2], cursors[3])]
+    windows += [(first - delay, last - delay) for first, last in windows]
+    if edges is not None:
+        windows += [(e - tolerance, e + tolerance) for e in edges]
+    return windows
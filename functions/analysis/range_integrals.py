@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Sums and means of traces over x ranges (OD/depump ranges, STIRAP cursors).
+
+The ranges are turned into index slices once (the x axes are sorted, so this is a searchsorted rather than a mask
+over the whole axis), and again only when the ranges or the x axis (time scale, data size) change. Per frame, the
+sums of all the channels over each range are then plain slice sums (a cumulative sum over the whole trace costs
+several times more for the few ranges used here).
+"""
+
+import numpy as np
+
+
+def prefixSums(y):
+    """prefix[k] = sum of y[:k], for k = 0..len(y); the sum of y[i:j] is then prefix[j] - prefix[i] for any i, j."""
+    return np.concatenate(([0.0], np.cumsum(y, dtype=float)))
+
+
+def lastIndicesBefore(times, t):
+    """
+    Index of the last sample of @times before each of @t; same as np.where(times < t)[0][-1], for sorted @times.
+    Raises IndexError if there is no sample before one of @t (as the np.where version does).
+    """
+    idx = np.searchsorted(times, t, side='left') - 1
+    if np.any(idx < 0):
+        raise IndexError('Cursor before the first sample')
+    return idx
+
+
+def openRangeSlice(x, start, stop):
+    """Slice of the samples with start < x < stop, for sorted @x (start/stop may be -np.inf/np.inf)."""
+    return slice(int(np.searchsorted(x, start, side='right')), int(np.searchsorted(x, stop, side='left')))
+
+
+class RangeIntegrator:
+    def __init__(self):
+        self.key = None
+        self.starts, self.stops = np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        self.updates = 0  # times the slices were recomputed
+
+    def setSlices(self, key, slices):
+        self.key = key
+        self.starts = np.array([s.start for s in slices], dtype=int)
+        self.stops = np.maximum(np.array([s.stop for s in slices], dtype=int), self.starts)  # empty rather than negative
+        self.updates += 1
+
+    @staticmethod
+    def axisKey(x):
+        # The scope's x axes are linspaces: their length and ends identify them
+        return len(x), float(x[0]), float(x[-1])
+
+    def setRanges(self, x, ranges):
+        """@ranges: (start, stop) pairs; samples with start < x < stop. Recomputes the slices only if something changed."""
+        key = ('ranges', tuple((float(a), float(b)) for a, b in ranges), self.axisKey(x))
+        if key != self.key:
+            self.setSlices(key, [openRangeSlice(x, a, b) for a, b in ranges])
+
+    def setCursors(self, times, cursor_times):
+        """
+        @cursor_times: c0, c1, c2, c3...; ranges are [last sample before c0, last sample before c1), and so on in pairs,
+        as in NAtoms / OD_exp.
+        """
+        key = ('cursors', tuple(float(c) for c in cursor_times), self.axisKey(times))
+        if key != self.key:
+            idx = lastIndicesBefore(times, cursor_times)
+            self.setSlices(key, [slice(int(idx[k]), int(idx[k + 1])) for k in range(0, len(idx) - 1, 2)])
+
+    @property
+    def counts(self):
+        return self.stops - self.starts
+
+    def sums(self, data):
+        """Sums of @data (n_samples,) or (n_channels, n_samples) over each range: (n_ranges,) or (n_channels, n_ranges)"""
+        data = np.asarray(data)
+        return np.stack([data[..., a:b].sum(axis=-1) for a, b in zip(self.starts, self.stops)], axis=-1)
+
+    def means(self, data):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sums(data) / self.counts
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""
+Running average of scope traces, for the scope tabs' averaging.
+"""
+
+import numpy as np
+
+
+class RunningAverage:
+    """
+    Average of the last n_avg frames.
+    Frames are kept in a ring buffer together with their running sum, so adding a frame costs O(frame length)
+    regardless of n_avg. Until n_avg frames were added, the average is over the frames received so far (rather than
+    over zero-filled placeholders).
+    With exponential=True an exponential moving average with alpha = 2 / (n_avg + 1) is kept instead; during warm-up
+    alpha is max(1/count, alpha), so the first frames are not biased towards zero either.
+    """
+
+    def __init__(self, n_avg=1, length=1024, exponential=False):
+        self.reset(n_avg, length, exponential)
+
+    def reset(self, n_avg=None, length=None, exponential=None):
+        self.n_avg = max(1, int(n_avg)) if n_avg is not None else self.n_avg
+        self.length = int(length) if length is not None else self.length
+        self.exponential = bool(exponential) if exponential is not None else self.exponential
+        self.alpha = 2.0 / (self.n_avg + 1)
+        n_rows = 1 if self.exponential else self.n_avg
+        self.buffer = np.zeros((n_rows, self.length), dtype=np.float32)
+        self.sum = np.zeros(self.length, dtype=np.float64)  # running sum; in exponential mode, the average itself
+        self.index = 0  # next row to overwrite
+        self.count = 0  # number of frames currently averaged (warm-up)
+
+    def add(self, frame):
+        """Add a frame and return the updated average. A frame of a different length restarts the average."""
+        frame = np.asarray(frame)
+        if frame.shape[-1] != self.length:
+            self.reset(length=frame.shape[-1])
+        if self.exponential:
+            self.count = min(self.count + 1, self.n_avg)
+            alpha = max(1.0 / self.count, self.alpha)
+            self.sum += alpha * (frame - self.sum)
+            self.buffer[0] = frame
+            return self.average
+        if self.count == self.n_avg:
+            self.sum -= self.buffer[self.index]
+        else:
+            self.count += 1
+        self.buffer[self.index] = frame
+        self.sum += self.buffer[self.index]
+        self.index = (self.index + 1) % self.n_avg
+        if self.index == 0:
+            # Once per round, re-sum from scratch so that rounding errors of the running sum do not accumulate
+            np.sum(self.buffer, axis=0, dtype=np.float64, out=self.sum)
+        return self.average
+
+    @property
+    def average(self):
+        if self.count == 0:
+            return np.zeros(self.length)
+        if self.exponential:
+            return self.sum.copy()
+        return self.sum / self.count
+
+    def last(self):
+        """Most recently added frame (None if empty)."""
+        if self.count == 0:
+            return None
+        return self.buffer[0] if self.exponential else self.buffer[(self.index - 1) % self.n_avg]
+
+    def __len__(self):
+        return self.count
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+Micro-benchmarks (and checks) for the acquisition path. Run directly:
+    python -m functions.benchmarks
+"""
+
+import gzip, json, time, threading
+import numpy as np
+
+from functions.RedPitayaWebsocket import FrameDecoder, Redpitaya
+from functions.RedPitayaSimulator import RedPitayaSimulator
+from functions.analysis.pulse_edges import pulseEdges, readoutWindows
+from functions.od.scpi import mergeWindows
+
+
+def make_signals_frame(ch1, ch2):
+    """Build a frame that looks like the ones the RP scope app sends (gzip'ed JSON)."""
+    signals = {'ch1': {'size': len(ch1), 'value': np.round(ch1, 6).tolist()},
+               'ch2': {'size': len(ch2), 'value': np.round(ch2, 6).tolist()}}
+    return gzip.compress(json.dumps({'signals': signals}, separators=(',', ':')).encode('utf-8'))
+
+
+def legacy_decode(message):
+    # This is what RedPitayaWebsocket.on_message used to do, for reference
+    data = json.loads(gzip.decompress(message).decode('utf-8'))
+    return [data['signals']['ch1']['value'], data['signals']['ch2']['value']]
+
+
+def legacy_decode_to_arrays(message):
+    # ... plus the list->array conversion the scope widgets ended up doing on every frame anyway
+    return [np.array(values, dtype=np.float32) for values in legacy_decode(message)]
+
+
+def frames_per_second(decode, frames, n_frames):
+    start = time.perf_counter()
+    for i in range(n_frames):
+        decode(frames[i % len(frames)])
+    return n_frames / (time.perf_counter() - start)
+
+
+def benchmark_websocket_decode(sizes=(1024, 4096, 16384), n_frames=200, n_distinct=10):
+    """
+    Measure decoded frames/s for each OSC_DATA_SIZE: json -> lists (old on_message), json -> lists -> arrays (what the
+    scope widgets effectively paid) and FrameDecoder -> float32 arrays. Parsing the JSON is most of the cost, so the
+    last two are about the same: the arrays save the widgets the conversion, not the decoding.
+    """
+    results = {}
+    for size in sizes:
+        x = np.linspace(0, 1, size)
+        frames = [make_signals_frame(np.sin(2 * np.pi * (x + i / n_distinct)), np.random.rand(size)) for i in range(n_distinct)]
+        decoder = FrameDecoder()
+        fps = (frames_per_second(legacy_decode, frames, n_frames),
+               frames_per_second(legacy_decode_to_arrays, frames, n_frames),
+               frames_per_second(decoder.decode, frames, n_frames))
+        results[size] = fps
+        print('OSC_DATA_SIZE = %5d: json->lists %7.1f; json->arrays %7.1f; FrameDecoder %7.1f frames/s' % ((size,) + fps))
+    return results
+
+
+def benchmark_simulator_throughput(sizes=(1024, 4096, 16384), duration=3, repeat=1):
+    """
+    Frames/s that RedPitayaWebsocket.Redpitaya delivers to its callback, end to end (websocket, duplicate check,
+    decoding), from a RedPitayaSimulator sending as fast as it can. @repeat > 1 sends every frame several times, like
+    an untriggered RP does.
+    """
+    results = {}
+    for size in sizes:
+        with RedPitayaSimulator(rate=None, repeat=repeat, http_port=0, scpi_port=0) as simulator:
+            frames = []
+            rp = Redpitaya(simulator.websocket_host, got_data_callback=lambda data, parameters: frames.append(len(data[0])),
+                           dialogue_print_callback=lambda s, color=None: None)
+            rp.set_dataSize(size)
+            threading.Thread(target=rp.run, daemon=True).start()
+            deadline = time.perf_counter() + 10
+            while size not in frames[-1:]:  # wait for the new data size to take effect
+                if time.perf_counter() > deadline:
+                    raise RuntimeError('No frames of size %d from the simulator' % size)
+                time.sleep(0.05)
+            n_start, start = len(frames), time.perf_counter()
+            time.sleep(duration)
+            fps = (len(frames) - n_start) / (time.perf_counter() - start)
+            rp.close()
+        results[size] = fps
+        print('OSC_DATA_SIZE = %5d: %7.1f frames/s (%d duplicates dropped)' % (size, fps, rp.duplicates_dropped))
+    return results
+
+
+def check_partial_edge_drift(decimations=(1, 8, 64, 1024, 8192, 65536), edges=(3000, 5000, 9000), n=16384,
+                             tolerance=10, margin=200, search_radius=300):
+    """
+    STIRAP's partial readout: for an unchanged shot, the pulse edges found on the partial trace (NaN outside of the read
+    windows) must be those of the full trace, at every decimation, or the cursors would be re-placed on every other shot.
+    The cursors are placed from the edges as STIRAPWidget.positionCursors does; the second window anywhere in its search
+    range. Prints and returns the largest drift [samples] for each decimation, with and without the edge windows.
+    """
+    rise1, fall1, rise2 = edges
+    trace = np.zeros(n, dtype=np.float32)
+    trace[rise1:fall1] = 1
+    trace[rise2:rise2 + fall1 - rise1] = 1
+    trace += 0.01 * np.random.rand(n).astype(np.float32)
+    found = np.array(pulseEdges(trace))
+    results = {}
+    for decimation in decimations:
+        added = 5e-6 * 125e6 / decimation  # positionCursors adds 5 us to the end of both windows
+        a = found[0] - 150
+        d = found[1] - (a + 250)
+        b = found[2] - 150
+        drifts = []
+        for withEdges in (False, True):
+            drift = 0
+            for b_opt in (b - search_radius, b, b + search_radius):
+                cursors = [a, a + d + added, b_opt, b_opt + d + added]
+                windows = mergeWindows(readoutWindows(cursors, 0, found if withEdges else None, tolerance), margin, n)
+                partial = np.full(n, np.nan, dtype=np.float32)
+                for first, last in windows:
+                    partial[first:last + 1] = trace[first:last + 1]
+                edgesPartial = pulseEdges(partial)
+                drift = max(drift, np.max(np.abs(np.array(edgesPartial) - found)) if edgesPartial is not None else n)
+            drifts.append(int(drift))
+        results[decimation] = tuple(drifts)
+        print('decimation = %5d: edge drift on a partial trace %5d samples (%d without the edge windows)'
+              % (decimation, drifts[1], drifts[0]))
+        assert drifts[1] == 0, 'Pulse edges of an unchanged shot move on its partial trace at decimation %d' % decimation
+    return results
+
+
+if __name__ == "__main__":
+    check_partial_edge_drift()
+    benchmark_websocket_decode()
+    benchmark_simulator_throughput()
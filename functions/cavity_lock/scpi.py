@@ -26,6 +26,9 @@ class Scpi (object):
         self.host = host
         self.port = port
         self.timeout = timeout
+        # Receive buffer, reused for every reply. Bytes [rxStart:rxEnd] were received but not consumed yet
+        self.rxBuffer = bytearray(65536)
+        self.rxStart, self.rxEnd = 0, 0
 
         try:
             self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -48,38 +51,72 @@ class Scpi (object):
         """Close IP connection."""
         self.__del__()
 
+    def rx_more(self, chunksize=4096):
+        """Receive into the free end of self.rxBuffer (compacting or growing it to have >= @chunksize bytes free)."""
+        if len(self.rxBuffer) - self.rxEnd < chunksize:
+            pending = self.rxEnd - self.rxStart
+            if self.rxStart > 0:
+                self.rxBuffer[:pending] = self.rxBuffer[self.rxStart:self.rxEnd]
+                self.rxStart, self.rxEnd = 0, pending
+            if len(self.rxBuffer) - self.rxEnd < chunksize:
+                self.rxBuffer.extend(bytearray(max(chunksize, len(self.rxBuffer))))
+        n = self._socket.recv_into(memoryview(self.rxBuffer)[self.rxEnd:])
+        if n == 0:
+            raise ConnectionError('SCPI >> connection to %s closed' % self.host)
+        self.rxEnd += n
+        return n
+
     def rx_txt(self, chunksize=4096):
         """Receive text string and return it after removing the delimiter."""
-        msg = ''
+        searchFrom = self.rxStart
         while 1:
-            chunk = self._socket.recv(chunksize + len(self.delimiter)).decode('utf-8')  # Receive chunk size of 2^n preferably
-            msg += chunk
-            if (len(chunk) and chunk[-2:] == self.delimiter):
+            # Look for the '\n' of the delimiter (a single byte search is much faster), only in bytes not searched yet
+            end = self.rxBuffer.find(b'\n', searchFrom, self.rxEnd)
+            if end < 0:
+                searchFrom = self.rxEnd - self.rxStart
+                self.rx_more(chunksize)
+                searchFrom += self.rxStart
+                continue
+            if end > self.rxStart and self.rxBuffer[end - 1] == 13:  # preceded by '\r'
                 break
-        return msg[:-2]
+            searchFrom = end + 1
+        msg = self.rxBuffer[self.rxStart:end - 1].decode('utf-8')
+        self.consume(end + 1 - self.rxStart)
+        return msg
+
+    def consume(self, n):
+        self.rxStart += n
+        if self.rxStart == self.rxEnd:
+            self.rxStart, self.rxEnd = 0, 0
+
+    def rx_into(self, view):
+        """Receive exactly len(view) bytes into @view (a writable memoryview); buffered bytes are used first."""
+        received = min(len(view), self.rxEnd - self.rxStart)
+        if received:
+            view[:received] = self.rxBuffer[self.rxStart:self.rxStart + received]
+            self.consume(received)
+        while received < len(view):
+            n = self._socket.recv_into(view[received:])
+            if n == 0:
+                raise ConnectionError('SCPI >> connection to %s closed' % self.host)
+            received += n
+        return received
 
     def rx_arb(self):
-        numOfBytes = 0
         """ Recieve binary data from scpi server"""
-        str=''
-        while (len(str) != 1):
-            str = (self._socket.recv(1))
-        if not (str == '#'):
+        byte = bytearray(1)
+        self.rx_into(memoryview(byte))
+        if not (byte == b'#'):
             return False
-        str=''
-        while (len(str) != 1):
-            str = (self._socket.recv(1))
-        numOfNumBytes = int(str)
+        self.rx_into(memoryview(byte))
+        numOfNumBytes = int(byte)
         if not (numOfNumBytes > 0):
             return False
-        str=''
-        while (len(str) != numOfNumBytes):
-            str += (self._socket.recv(1))
-        numOfBytes = int(str)
-        str=''
-        while (len(str) != numOfBytes):
-            str += (self._socket.recv(1))
-        return str
+        numOfBytes = bytearray(numOfNumBytes)
+        self.rx_into(memoryview(numOfBytes))
+        data = bytearray(int(numOfBytes))
+        self.rx_into(memoryview(data))
+        return bytes(data)
 
     def tx_txt(self, msg):
         """Send text string ending and append delimiter."""
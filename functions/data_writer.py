@@ -0,0 +1,278 @@
+# -*- coding: utf-8 -*-
+"""
+Saving data files off the acquisition thread.
+
+AsyncWriter.save() only puts the arrays on a bounded queue and returns; a dedicated thread takes whatever is queued
+(up to batch_size items at once) and writes each item as a compressed .npz file under primary_dir. Folders are created
+once, not on every file.
+AsyncWriter.record() appends frames to a session recording (functions.recording) instead; the recording is kept open
+by the writer thread and written a chunk at a time.
+If primary_dir (typically a network share) fails or a write takes longer than slow_write seconds, files go to the
+local spill_dir instead, and primary_dir is tried again after retry_interval seconds; once it works again, the
+spilled files are moved back to it (spilled recording frames are appended back to the recording on primary_dir).
+If the queue is full, the frame is dropped (and counted) rather than blocking.
+"""
+
+import os
+import time
+import queue
+import shutil
+import threading
+import tempfile
+from collections import deque
+import numpy as np
+from functions.recording import RecordingWriter, Recording, EXTENSION
+
+_STOP = None  # put on the queue to stop the writer thread
+
+
+class AsyncWriter:
+    def __init__(self, primary_dir, spill_dir=None, maxsize=256, batch_size=16, slow_write=1.0, retry_interval=30, flush_interval=10):
+        """
+        @primary_dir: where files should end up
+        @spill_dir: local folder used while primary_dir is slow or unavailable
+        @maxsize: max number of files waiting to be written
+        @batch_size: max number of files written per round
+        @slow_write: [s] a write to primary_dir taking longer than this switches to spill_dir
+        @retry_interval: [s] how long to wait before trying primary_dir again
+        @flush_interval: [s] frames of open recordings are flushed to disk after this long without new frames
+        """
+        self.primary_dir = primary_dir
+        self.spill_dir = spill_dir if spill_dir is not None else os.path.join(tempfile.gettempdir(), 'GUI-Experiment spill')
+        self.batch_size = int(batch_size)
+        self.slow_write = slow_write
+        self.retry_interval = retry_interval
+        self.flush_interval = flush_interval
+        self.recordings = {}  # path -> RecordingWriter; only used by the writer thread
+        self.lastItemTime = time.time()
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.createdDirs = set()
+        self.primaryOk = True
+        self.retryPrimaryAt = 0
+        self.lastError = None
+        self.written, self.spilled, self.dropped, self.unspilled, self.failed = 0, 0, 0, 0, 0
+        self.bytesWritten = 0
+        self.recentWrites = deque()  # (time, bytes) of the last minute, for the write rate
+        self.thread = threading.Thread(target=self.run, name='AsyncWriter', daemon=True)
+        self.thread.start()
+
+    # ---- Producer side ----
+    def save(self, relpath, **arrays):
+        """
+        Queue @arrays to be saved as <primary_dir>/<relpath>.npz (np.savez_compressed keywords). Never blocks.
+        Arrays must not be modified after this call. Returns False if the frame was dropped because the queue is full.
+        """
+        try:
+            self.queue.put_nowait(('npz', relpath, arrays))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def record(self, relpath, frame, timestamp=None, parameters=None, **recording):
+        """
+        Queue @frame (n_channels, n_samples) to be appended to the recording <primary_dir>/<relpath>.rec. Never blocks.
+        @parameters: dict of this frame's parameters (saved as its metadata)
+        @recording: RecordingWriter keywords, used when the recording is created (channels, metadata, chunk_frames)
+        Returns False if the frame was dropped because the queue is full.
+        """
+        try:
+            self.queue.put_nowait(('rec', relpath, (frame, time.time() if timestamp is None else timestamp, parameters, recording)))
+            return True
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+    def close(self, timeout=10):
+        """Write everything still queued, then stop the writer thread."""
+        if self.thread.is_alive():
+            self.queue.put(_STOP)
+            self.thread.join(timeout)
+
+    # ---- Writer thread ----
+    def run(self):
+        while True:
+            try:
+                # While spilled files or unflushed recording frames are waiting, wake up now and then
+                waiting = self.spilled > self.unspilled or any(r.buffered for r in self.recordings.values())
+                batch = [self.queue.get(timeout=1 if waiting else None)]
+            except queue.Empty:
+                if time.time() - self.lastItemTime > self.flush_interval:
+                    self.flushRecordings()
+                self.writeBatch([])
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            self.lastItemTime = time.time()
+            stop = _STOP in batch
+            self.writeBatch([item for item in batch if item is not _STOP])
+            if stop:
+                self.closeRecordings()
+                return
+
+    def writeBatch(self, batch):
+        if not self.primaryOk and time.time() >= self.retryPrimaryAt:
+            self.primaryOk = True  # try primary again
+            self.closeRecordings(self.spill_dir)
+            self.unspill(recordings_only=True)  # spilled recording frames go back before the new ones
+        for kind, relpath, payload in batch:
+            write = self.write if kind == 'npz' else self.writeRecording
+            if self.primaryOk:
+                start = time.time()
+                try:
+                    write(self.primary_dir, relpath, payload)
+                    if time.time() - start > self.slow_write:
+                        self.usePrimaryLater('writing to %s took %.1f s' % (self.primary_dir, time.time() - start))
+                    continue
+                except OSError as e:
+                    self.usePrimaryLater(str(e))
+                except ValueError as e:  # e.g. a frame that does not fit its recording
+                    self.lastError = str(e)
+                    self.failed += 1
+                    continue
+            try:
+                write(self.spill_dir, relpath, payload)
+                self.spilled += 1
+            except (OSError, ValueError) as e:
+                self.lastError = str(e)
+                self.failed += 1
+        if self.primaryOk and self.queue.empty():
+            self.unspill()
+
+    def usePrimaryLater(self, reason):
+        self.primaryOk = False
+        self.createdDirs.clear()  # the share may come back without them
+        # Frames not yet written to the recordings on primary_dir go to spill_dir
+        for path, writer in list(self.recordings.items()):
+            if path.startswith(self.primary_dir):
+                del self.recordings[path]
+                frames, timestamps, metadata = writer.takePending()
+                try:
+                    writer.close()
+                except OSError:
+                    pass
+                relpath = os.path.relpath(path, self.primary_dir)[:-len(EXTENSION)]
+                for args in zip(frames, timestamps, metadata):
+                    try:
+                        self.writeRecording(self.spill_dir, relpath, args + (writer.options(),))
+                        self.spilled += 1
+                    except OSError:
+                        self.failed += 1
+        self.retryPrimaryAt = time.time() + self.retry_interval
+        self.lastError = reason
+
+    def makedirs(self, path):
+        if path not in self.createdDirs:
+            os.makedirs(path, exist_ok=True)
+            self.createdDirs.add(path)
+
+    def write(self, root, relpath, arrays):
+        path = os.path.join(root, relpath + '.npz')
+        self.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+            n = f.tell()
+        self.countWrite(n)
+
+    def writeRecording(self, root, relpath, payload):
+        frame, timestamp, metadata, options = payload
+        path = os.path.join(root, relpath + EXTENSION)
+        if path not in self.recordings:
+            self.makedirs(os.path.dirname(path))
+            self.recordings[path] = RecordingWriter(path, **options)
+        try:
+            self.recordings[path].append(frame, timestamp, metadata)
+        except OSError as e:
+            if root != self.primary_dir:
+                raise
+            self.usePrimaryLater(str(e))  # the frame is one of the recording's pending frames, which go to spill_dir
+            return
+        self.countWrite(np.asarray(frame).nbytes)
+
+    def flushRecordings(self):
+        for path, writer in list(self.recordings.items()):
+            try:
+                writer.flush()
+            except OSError as e:
+                if path.startswith(self.primary_dir):
+                    self.usePrimaryLater(str(e))
+                else:
+                    self.lastError = str(e)
+
+    def closeRecordings(self, root=None):
+        for path, writer in list(self.recordings.items()):
+            if root is None or path.startswith(root):
+                del self.recordings[path]
+                try:
+                    writer.close()
+                except OSError as e:
+                    self.lastError = str(e)
+
+    def countWrite(self, n):
+        self.written += 1
+        self.bytesWritten += n
+        now = time.time()
+        self.recentWrites.append((now, n))
+        while self.recentWrites[0][0] < now - 60:
+            self.recentWrites.popleft()
+
+    def unspill(self, max_files=None, recordings_only=False):
+        """
+        Move (up to @max_files, default batch_size) spilled files to primary_dir. Called when the queue is idle.
+        Spilled recordings are appended to the recording of the same name on primary_dir, whole.
+        """
+        max_files = self.batch_size if max_files is None else max_files
+        if self.spilled == self.unspilled or not os.path.isdir(self.spill_dir):
+            return
+        moved = 0
+        for dirpath, dirnames, filenames in os.walk(self.spill_dir):
+            for filename in filenames:
+                if moved >= max_files:
+                    return
+                src = os.path.join(dirpath, filename)
+                relpath = os.path.relpath(src, self.spill_dir)
+                if src in self.recordings or (recordings_only and not filename.endswith(EXTENSION)):
+                    continue
+                try:
+                    if filename.endswith(EXTENSION):
+                        n = self.unspillRecording(src, relpath[:-len(EXTENSION)])
+                    else:
+                        dst = os.path.join(self.primary_dir, relpath)
+                        self.makedirs(os.path.dirname(dst))
+                        shutil.move(src, dst)
+                        n = 1
+                except OSError as e:
+                    self.usePrimaryLater(str(e))
+                    return
+                self.unspilled += n
+                moved += 1
+
+    def unspillRecording(self, src, relpath):
+        spilled = Recording(src)
+        options = {'channels': spilled.channels, 'metadata': spilled.metadata, 'chunk_frames': spilled.header['chunk_frames']}
+        for start in range(0, len(spilled), spilled.header['chunk_frames']):
+            frames, timestamps, metadata = spilled.read(start, start + spilled.header['chunk_frames'])
+            for args in zip(frames, timestamps, metadata):
+                self.writeRecording(self.primary_dir, relpath, args + (options,))
+        path = os.path.join(self.primary_dir, relpath + EXTENSION)
+        if path in self.recordings:
+            self.recordings[path].flush()
+        os.remove(src)
+        return len(spilled)
+
+    # ---- Stats ----
+    def bytesPerSecond(self, window=10):
+        since = time.time() - window
+        return sum(n for t, n in list(self.recentWrites) if t >= since) / window
+
+    def stats(self):
+        return {'queued': self.queue.qsize(), 'written': self.written, 'spilled': self.spilled,
+                'unspilled': self.unspilled, 'dropped': self.dropped, 'failed': self.failed,
+                'bytes_per_s': self.bytesPerSecond(), 'primary_ok': self.primaryOk, 'last_error': self.lastError}
+
+    def statsText(self):
+        return ('saving: %(queued)d queued, %(written)d written (%(spilled)d spilled to local disk), %(dropped)d dropped, '
+                '%(bytes_per_s).0f B/s' % self.stats())
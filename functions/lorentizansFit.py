@@ -1,6 +1,95 @@
+import numpy as np
 from scipy import optimize,spatial
 from scipy.signal import find_peaks
 
+
+# ---- Model: shift + sum of Lorentzians a * gam^2 / (gam^2 + (x - x0)^2); params = [shift, x0_1, a_1, gam_1, x0_2, ...] ----
+def multiLorentzian(x, *params):
+    shift, (x0, a, gam) = params[0], np.reshape(params[1:], (-1, 3)).T
+    d = np.asarray(x)[:, np.newaxis] - x0  # (n_samples, n_peaks): all peaks at once
+    return shift + np.sum(a * gam ** 2 / (gam ** 2 + d ** 2), axis=1)
+
+
+def multiLorentzianJacobian(x, *params):
+    """Derivatives of multiLorentzian by each of its params: (n_samples, n_params)"""
+    x0, a, gam = np.reshape(params[1:], (-1, 3)).T
+    d = np.asarray(x)[:, np.newaxis] - x0
+    g2 = gam ** 2
+    q = 1 / (g2 + d ** 2)
+    L = g2 * q  # peak shapes, height 1
+    jac = np.empty((len(d), len(params)))
+    jac[:, 0] = 1
+    jac[:, 1::3] = 2 * a * L * d * q  # d/dx0
+    jac[:, 2::3] = L  # d/da
+    jac[:, 3::3] = 2 * a * gam * d ** 2 * q ** 2  # d/dgam
+    return jac
+
+
+def multiLorentzianParamsToText(popt):
+    text = ''
+    params = popt[1:] # first param is a general shift
+    for i in range(0, len(params), 3):
+        text += 'X_0' +' = %.2f; ' % params[i]
+        text += 'I = %.2f; ' % params[i +1]
+        text += 'gamma' + ' = %.2f \n' %  params[i + 2]
+    return (text)
+
+
+class MultiLorentzianFitter:
+    """
+    Multi-Lorentzian fit of a trace, for fitting every frame.
+    Only the samples within window_widths half-widths of the peaks are fitted, and each fit starts from the previous
+    one's result (as long as there are as many peaks and they did not move by more than a half-width); otherwise it
+    starts from the detected peaks.
+    """
+
+    def __init__(self, window_widths=5, maxfev=2000):
+        self.window_widths = window_widths
+        self.maxfev = maxfev
+        self.popt = None
+        self.pcov = None
+        self.fits, self.warmStarts, self.failures = 0, 0, 0
+
+    def startValues(self, xData, yData, peaks_indices, peaks_init_width):
+        # @peaks_init_width: full widths of the peaks, in x units
+        x0 = np.asarray(xData)[peaks_indices]
+        if self.popt is not None and len(self.popt) == 1 + 3 * len(x0):
+            prev_x0, prev_gam = self.popt[1::3], np.abs(self.popt[3::3])
+            if np.all(np.abs(np.sort(prev_x0) - np.sort(x0)) < prev_gam):
+                self.warmStarts += 1
+                return self.popt
+        p0 = np.empty(1 + 3 * len(x0))
+        p0[0] = np.min(yData)
+        p0[1::3] = x0
+        p0[2::3] = np.asarray(yData)[peaks_indices] - p0[0]
+        p0[3::3] = np.asarray(peaks_init_width) / 2
+        return p0
+
+    def fit(self, xData, yData, peaks_indices, peaks_init_width):
+        """Returns popt = [shift, x0_1, a_1, gam_1, ...], or None if there are no peaks or the fit failed."""
+        if len(peaks_indices) == 0:
+            return None
+        xData, yData = np.asarray(xData, dtype=float), np.asarray(yData, dtype=float)
+        p0 = self.startValues(xData, yData, peaks_indices, peaks_init_width)
+        x0, gam = p0[1::3], np.abs(p0[3::3])
+        inWindow = np.any(np.abs(xData[:, np.newaxis] - x0) < self.window_widths * gam, axis=1)
+        if np.count_nonzero(inWindow) <= len(p0):
+            inWindow[:] = True
+        try:
+            popt, pcov = optimize.curve_fit(multiLorentzian, xData[inWindow], yData[inWindow], p0=p0,
+                                            jac=multiLorentzianJacobian, maxfev=self.maxfev)
+        except (RuntimeError, ValueError, optimize.OptimizeWarning):
+            self.failures += 1
+            self.popt = None  # next fit starts from the detected peaks
+            return None
+        popt[3::3] = np.abs(popt[3::3])  # gam only appears squared
+        self.popt, self.pcov = popt, pcov
+        self.fits += 1
+        return popt
+
+    def reset(self):
+        self.popt = None
+
 class multipleLorentziansFitter():
     def __init__(self, xData,yData, valleys = False, peak_distance = 20, peak_prominence = 0.002, peak_width = 5):
         self.xData = xData
@@ -12,16 +101,6 @@ class multipleLorentziansFitter():
 
     def fitMultipleLorentzians(self,xData,yData, peaks_indices ,peaks_init_width):
         # xData, yData = self.xData, self.yData
-        # -- fit functions ---
-        def lorentzian(x, x0, a, gam):
-            return a * gam ** 2 / (gam ** 2 + (x - x0) ** 2)
-
-        def multi_lorentz_curve_fit(x, *params):
-            shift = params[0]  # Scalar shift
-            paramsRest = params[1:]  # These are the atcual parameters.
-            assert not (len(paramsRest) % 3)  # makes sure we have enough params
-            return shift + sum([lorentzian(x, *paramsRest[i: i + 3]) for i in range(0, len(paramsRest), 3)])
-
         # -------- Begin fit: --------------
         pub = [0.5, 1.5]  # peak_uncertain_bounds
         startValues = []
@@ -31,15 +110,9 @@ class multipleLorentziansFitter():
         upper_bounds = [20] + [v * pub[1] for v in startValues]
         bounds = [lower_bounds, upper_bounds]
         startValues = [min(yData)] + startValues  # This is the constant from which we start the Lorentzian fits - ideally, 0
-        self.popt, self.pcov = optimize.curve_fit(multi_lorentz_curve_fit, xData, yData, p0=startValues, maxfev=50000)
+        self.popt, self.pcov = optimize.curve_fit(multiLorentzian, xData, yData, p0=startValues, jac=multiLorentzianJacobian, maxfev=50000)
         #ys = [multi_lorentz_curve_fit(x, popt) for x in xData]
         return (self.popt)
 
     def multipleLorentziansParamsToText(self, popt):
-        text = ''
-        params = popt[1:] # first param is a general shift
-        for i in range(0, len(params), 3):
-            text += 'X_0' +' = %.2f; ' % params[i]
-            text += 'I = %.2f; ' % params[i +1]
-            text += 'gamma' + ' = %.2f \n' %  params[i + 2]
-        return (text)
\ No newline at end of file
+        return multiLorentzianParamsToText(popt)
\ No newline at end of file
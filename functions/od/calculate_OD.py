@@ -1,10 +1,21 @@
 from pgc_macro_with_OD import pgc
 # import Instruments.RedPitaya.RedPitaya
 import numpy as np
+from functions.analysis.range_integrals import RangeIntegrator
 # from matplotlib import pyplot as plt
 
 
 class OD_exp:
+    def __init__(self):
+        self.rangeIntegrator = RangeIntegrator()  # trigger slices, recomputed only when the triggers or times change
+
+    def triggerMeans(self, trigger_times, times, OD_trace):
+        # Means of @OD_trace between the first two and the last two trigger times (from the last sample before each)
+        self.rangeIntegrator.setCursors(times, trigger_times[:4])
+        self.trig1_strt, self.trig2_strt = self.rangeIntegrator.starts
+        self.trig1_end, self.trig2_end = self.rangeIntegrator.stops
+        return self.rangeIntegrator.means(OD_trace)
+
     def calculate_OD(self, beam_radius, times, trigger_times, OD_trace, wvlngth=780):
         """
 
@@ -14,12 +25,7 @@ class OD_exp:
         :param second_pulse_end:
         :return:
         """
-        self.trig1_strt = np.where(times < trigger_times[0])[0][-1]
-        self.trig1_end  = np.where(times < trigger_times[1])[0][-1]
-        self.trig2_strt = np.where(times < trigger_times[2])[0][-1]
-        self.trig2_end  = np.where(times < trigger_times[3])[0][-1]
-        self.frst_plse_avg_pwr = np.mean(OD_trace[self.trig1_strt:self.trig1_end])
-        self.scnd_plse_avg_pwr = np.mean(OD_trace[self.trig2_strt:self.trig2_end])
+        self.frst_plse_avg_pwr, self.scnd_plse_avg_pwr = self.triggerMeans(trigger_times, times, OD_trace)
         self.OD = (2 * (np.pi ** 2) / 3) * ((beam_radius / wvlngth) ** 2) * np.log(self.frst_plse_avg_pwr / self.scnd_plse_avg_pwr)
         return self.OD
 
@@ -27,18 +33,13 @@ class OD_exp:
         if (trigger_times[1]-trigger_times[0] <= 0) or (trigger_times[3]-trigger_times[2] <= 0) or (trigger_times[2]-trigger_times[1] < 0):
             print("Cursors are wrongly positioned")
             return 0
-        self.trig1_strt = np.where(times < trigger_times[0])[0][-1]
-        self.trig1_end = np.where(times < trigger_times[1])[0][-1]
-        self.trig2_strt = np.where(times < trigger_times[2])[0][-1]
-        self.trig2_end = np.where(times < trigger_times[3])[0][-1]
-        d1 = np.array(OD_trace[self.trig1_strt:self.trig1_end])
-        d2 = np.array(OD_trace[self.trig2_strt:self.trig2_end])
+        avg1, avg2 = self.triggerMeans(trigger_times, times, OD_trace)
         s = 7081.1  # sensitivity in V/W
         # s = 75263  # sensitivity in V/W
         h = 6.62607004e-34  # planck's constant
         THz = 1e12
         fl = 384.2304844685 * THz  # Laser frequency
-        res = (np.average(d2)- np.average(d1))/s/2/h/fl * (trigger_times[1] - trigger_times[0])*1e-6
+        res = (avg2 - avg1)/s/2/h/fl * (trigger_times[1] - trigger_times[0])*1e-6
         return res
 
     def tominimizeNat(self, b, a, d, OD_trace):
@@ -54,3 +55,19 @@ class OD_exp:
         res = (np.average(d2) - np.average(d1)) / s / 2 / h / fl * d / 125e6
         return np.abs(res)
 
+    def tominimizeNatAll(self, bs, a, d, prefix):
+        """
+        tominimizeNat for every second window start in @bs at once (O(1) each).
+        :param prefix: prefixSums(OD_trace) (see functions.analysis.range_integrals)
+        """
+        a, d = int(a), int(d)
+        bs = np.asarray(bs, dtype=int)
+        avg1 = (prefix[a + d] - prefix[a]) / d
+        avg2 = (prefix[bs + d] - prefix[bs]) / d
+        s = 75263  # sensitivity in V/W
+        h = 6.62607004e-34  # planck's constant
+        THz = 1e12
+        fl = 384.2304844685 * THz  # Laser frequency
+        res = (avg2 - avg1) / s / 2 / h / fl * d / 125e6
+        return np.abs(res)
+
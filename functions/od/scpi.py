@@ -8,12 +8,33 @@ SCPI access to Red Pitaya.
 """
 
 import socket
+import time
+import threading
 import numpy as np
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import matplotlib.pyplot as plt
 #from functions.od.RSCurrentGenerator.RSCurrentGenerator import RSCurrentGenerator
 
 
+def mergeWindows(windows, margin, n):
+    """
+    (first, last) sample @windows widened by @margin, clipped to a buffer of @n samples, sorted and with the overlapping
+    ones merged (read once). None if none of them is in the buffer.
+    """
+    windows = sorted([(max(0, int(first) - margin), min(n - 1, int(last) + margin)) for first, last in windows])
+    windows = [w for w in windows if w[1] >= w[0]]  # drop windows outside of the buffer
+    if not windows:
+        return None
+    merged = [list(windows[0])]
+    for first, last in windows[1:]:
+        if first <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], last)
+        else:
+            merged.append([first, last])
+    return [tuple(w) for w in merged]
+
+
 class Scpi (object):
     """SCPI class used to access Red Pitaya over an IP network."""
     delimiter = '\r\n'
@@ -25,12 +46,19 @@ class Scpi (object):
         self.host = host
         self.port = port
         self.timeout = timeout
+        self.arbDelimiterPending = False
+        # Receive buffer, reused for every reply. Bytes [rxStart:rxEnd] were received but not consumed yet (e.g. the
+        # beginning of the next reply, when several queries were sent at once)
+        self.rxBuffer = bytearray(65536)
+        self.rxStart, self.rxEnd = 0, 0
 
         try:
             self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
             if timeout is not None:
                 self._socket.settimeout(timeout)
+            # Commands are short and often not followed by a reply; don't let Nagle hold them back
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
             self._socket.connect((host, port))
 
@@ -44,41 +72,104 @@ class Scpi (object):
         self._socket = None
 
     def close(self):
-        """Close IP connection."""
+        """Close IP connection (a read blocked on it, in another thread, fails instead of waiting)."""
+        if self._socket is not None:
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass  # not connected
         self.__del__()
 
+    def rx_more(self, chunksize=4096):
+        """Receive into the free end of self.rxBuffer (compacting or growing it to have >= @chunksize bytes free)."""
+        if len(self.rxBuffer) - self.rxEnd < chunksize:
+            pending = self.rxEnd - self.rxStart
+            if self.rxStart > 0:
+                self.rxBuffer[:pending] = self.rxBuffer[self.rxStart:self.rxEnd]
+                self.rxStart, self.rxEnd = 0, pending
+            if len(self.rxBuffer) - self.rxEnd < chunksize:
+                self.rxBuffer.extend(bytearray(max(chunksize, len(self.rxBuffer))))
+        n = self._socket.recv_into(memoryview(self.rxBuffer)[self.rxEnd:])
+        if n == 0:
+            raise ConnectionError('SCPI >> connection to %s closed' % self.host)
+        self.rxEnd += n
+        return n
+
     def rx_txt(self, chunksize=4096):
         """Receive text string and return it after removing the delimiter."""
-        msg = ''
+        searchFrom = self.rxStart
         while 1:
-            chunk = self._socket.recv(chunksize + len(self.delimiter)).decode('utf-8')  # Receive chunk size of 2^n preferably
-            msg += chunk
-            if (len(chunk) and chunk[-2:] == self.delimiter):
+            # Look for the '\n' of the delimiter (a single byte search is much faster), only in bytes not searched yet
+            end = self.rxBuffer.find(b'\n', searchFrom, self.rxEnd)
+            if end < 0:
+                searchFrom = self.rxEnd - self.rxStart
+                self.rx_more(chunksize)
+                searchFrom += self.rxStart
+                continue
+            if end == self.rxStart or self.rxBuffer[end - 1] != 13:  # not preceded by '\r'
+                searchFrom = end + 1
+                continue
+            end -= 1
+            if end == self.rxStart and self.arbDelimiterPending:
+                # Left over from the last binary block (see rx_arb)
+                self.consume(len(self.delimiter))
+                searchFrom = self.rxStart
+                self.arbDelimiterPending = False
+                continue
+            break
+        msg = self.rxBuffer[self.rxStart:end].decode('utf-8')
+        self.consume(end + len(self.delimiter) - self.rxStart)
+        self.arbDelimiterPending = False
+        return msg
+
+    def consume(self, n):
+        self.rxStart += n
+        if self.rxStart == self.rxEnd:
+            self.rxStart, self.rxEnd = 0, 0
+
+    def rx_into(self, view):
+        """Receive exactly len(view) bytes into @view (a writable memoryview); buffered bytes are used first."""
+        received = min(len(view), self.rxEnd - self.rxStart)
+        if received:
+            view[:received] = self.rxBuffer[self.rxStart:self.rxStart + received]
+            self.consume(received)
+        while received < len(view):
+            n = self._socket.recv_into(view[received:])
+            if n == 0:
+                raise ConnectionError('SCPI >> connection to %s closed' % self.host)
+            received += n
+        return received
+
+    def rx_arb(self, dtype=None):
+        """
+        Receive binary data (an IEEE-488.2 definite length block: #<number of digits><number of bytes><data>).
+        If @dtype is given, the data is read with recv_into straight into a numpy array of that dtype, which is returned;
+        otherwise returns the data as bytes. Returns False if the reply is not a definite length block.
+        """
+        byte = bytearray(1)
+        while 1:
+            self.rx_into(memoryview(byte))
+            if byte not in (b'\r', b'\n'):  # skip a delimiter left over from a previous block
                 break
-        return msg[:-2]
-
-    def rx_arb(self):
-        numOfBytes = 0
-        """ Recieve binary data from scpi server"""
-        str=''
-        while (len(str) != 1):
-            str = (self._socket.recv(1))
-        if not (str == '#'):
+        if not (byte == b'#'):
             return False
-        str=''
-        while (len(str) != 1):
-            str = (self._socket.recv(1))
-        numOfNumBytes = int(str)
+        self.rx_into(memoryview(byte))
+        numOfNumBytes = int(byte)
         if not (numOfNumBytes > 0):
             return False
-        str=''
-        while (len(str) != numOfNumBytes):
-            str += (self._socket.recv(1))
-        numOfBytes = int(str)
-        str=''
-        while (len(str) != numOfBytes):
-            str += (self._socket.recv(1))
-        return str
+        numOfBytes = bytearray(numOfNumBytes)
+        self.rx_into(memoryview(numOfBytes))
+        numOfBytes = int(numOfBytes)
+        if dtype is None:
+            data = bytearray(numOfBytes)
+            self.rx_into(memoryview(data))
+            data = bytes(data)
+        else:
+            data = np.empty(numOfBytes // np.dtype(dtype).itemsize, dtype=dtype)
+            self.rx_into(memoryview(data.view(np.uint8)))
+        # The server terminates the block with the delimiter; it is dropped before the next reply is read
+        self.arbDelimiterPending = True
+        return data
 
     def tx_txt(self, msg):
         """Send text string ending and append delimiter."""
@@ -146,10 +237,77 @@ class Scpi (object):
         return self.txrx_txt('SYST:ERR:NEXT?')
     
 
+class TriggerWaiter(object):
+    """
+    Waits for ACQ:TRIG:STAT? to report 'TD' without flooding the board (and a CPU core) with queries.
+
+    Polling starts every @min_interval [sec] and backs off by @growth up to @max_interval. If the MOT @cycle_period
+    [sec] is known, nothing is polled until @guard [sec] before the next expected trigger. @timeout [sec] (None - wait
+    forever) raises TimeoutError. Setting @cancel_event (or calling cancel()) makes wait() return False.
+    The duration of every wait is kept in stats (last/mean/max) and the number of queries in polls.
+    """
+
+    def __init__(self, min_interval=0.5e-3, max_interval=20e-3, growth=1.5, timeout=None, cycle_period=None, guard=20e-3, cancel_event=None):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.growth = growth
+        self.timeout = timeout
+        self.cycle_period = cycle_period
+        self.guard = guard
+        self.cancel_event = cancel_event if cancel_event is not None else threading.Event()
+        self.last_trigger = None
+        self.polls = 0
+        self.stats = {'last': 0.0, 'mean': 0.0, 'max': 0.0, 'n': 0}
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+    def wait(self, rp):
+        """Block until @rp is triggered. Returns True when triggered, False if cancelled."""
+        start = time.perf_counter()
+        deadline = start + self.timeout if self.timeout is not None else None
+        if self.cycle_period is not None and self.last_trigger is not None:
+            # Skip most of the cycle; still wake up early in case the cycle drifted
+            expected = self.last_trigger + self.cycle_period * np.ceil((start - self.last_trigger) / self.cycle_period)
+            sleep = expected - self.guard - start
+            if deadline is not None:
+                sleep = min(sleep, deadline - start)
+            if sleep > 0 and self.cancel_event.wait(sleep):
+                return False
+        interval = self.min_interval
+        while not self.cancel_event.is_set():
+            rp.tx_txt('ACQ:TRIG:STAT?')
+            self.polls += 1
+            if rp.rx_txt() == 'TD':
+                now = time.perf_counter()
+                self.last_trigger = now
+                self.update_stats(now - start)
+                return True
+            if deadline is not None and time.perf_counter() + interval > deadline:
+                raise TimeoutError('No trigger on %s within %.2f sec' % (rp.host, self.timeout))
+            self.cancel_event.wait(interval)
+            interval = min(interval * self.growth, self.max_interval)
+        return False
+
+    def update_stats(self, dt):
+        self.stats['n'] += 1
+        self.stats['last'] = dt
+        self.stats['mean'] += (dt - self.stats['mean']) / self.stats['n']
+        self.stats['max'] = max(self.stats['max'], dt)
+
+
 class Redpitaya (Scpi):
-    def __init__(self, host, timeout=None, port=5000, decimation=8, trigger_delay=0, trigger_source='EXT_PE'):
+    # dtypes of binary data blocks (big-endian, as sent by the board), by ACQ:DATA:UNITS
+    binaryDtypes = {'VOLTS': '>f4', 'RAW': '>i2'}
+
+    def __init__(self, host, timeout=None, port=5000, decimation=8, trigger_delay=0, trigger_source='EXT_PE', data_format='BIN', data_units='VOLTS'):
         super().__init__(host, timeout, port)
         self.sampling_rate = 125e6
+        self.bufferSize = 16384  # samples
         self.bufferDuration = 16384
         self.decimation = decimation
         self.trigger_delay = trigger_delay
@@ -171,6 +329,50 @@ class Redpitaya (Scpi):
         print("Output 1 is OFF")
         self.tx_txt('OUTPUT2:STATE OFF')
         print("Output 2 is OFF")
+        self.triggerWaiter = TriggerWaiter()
+        self.data_format, self.data_units = 'ASCII', 'VOLTS'
+        self.set_dataFormat(data_format)
+        self.set_dataUnits(data_units)
+        print("Data format is %s (%s)" % (self.data_format, self.data_units))
+
+    def set_dataFormat(self, f):
+        """Set format of acquired data. BIN is much faster to transfer and parse than ASCII."""
+        options = ('ASCII', 'BIN')
+        if f in options:
+            self.data_format = f
+            return self.tx_txt('ACQ:DATA:FORMAT ' + f)
+        else:
+            print("Please choose data format from " + str(options))
+
+    def set_dataUnits(self, u):
+        """Set units of acquired data: VOLTS, or RAW ADC counts."""
+        options = ('VOLTS', 'RAW')
+        if u in options:
+            self.data_units = u
+            return self.tx_txt('ACQ:DATA:UNITS ' + u)
+        else:
+            print("Please choose data units from " + str(options))
+
+    def rx_trace(self):
+        """Receive a trace requested with ACQ:SOURx:DATA? (or similar), in the current data format, as a float32 array."""
+        if self.data_format == 'BIN':
+            buff = self.rx_arb(dtype=self.binaryDtypes[self.data_units])
+            if buff is False:
+                raise ValueError('SCPI >> %s did not reply with a binary block' % self.host)
+            return buff.astype(np.float32)
+        buff_string = self.rx_txt().strip('{}\n\r').replace("  ", "")
+        return np.array(buff_string.split(','), dtype=np.float32)
+
+    def read_channel(self, channel):
+        """Read full buffer of @channel (1 or 2) as a float32 array."""
+        self.tx_txt('ACQ:SOUR%i:DATA?' % (channel))
+        return self.rx_trace()
+
+    def read_channels(self, channels=(1, 2)):
+        """Read full buffers of several channels. All queries are sent at once, then the replies are read in order."""
+        for ch in channels:
+            self.tx_txt('ACQ:SOUR%i:DATA?' % (ch))
+        return [self.rx_trace() for ch in channels]
 
     def set_decimation(self, d):
         """Set decimation factor."""
@@ -230,8 +432,33 @@ class Redpitaya (Scpi):
         """Set trigger level in V."""
         return self.tx_txt('ACQ:TRIG:LEV ' + str(lvl) + ' mV')
 
-    def get_data(self,start, end, source):
-        return self.txrx_txt('ACQ:SOUR%i:GET:DATA:%i:%i?'%(int(source), int(start), int(end)))
+    def get_data(self, start, end, source):
+        """Read samples @start to @end (buffer positions, inclusive) of channel @source."""
+        self.tx_txt('ACQ:SOUR%i:DATA:STA:END? %i,%i' % (int(source), int(start) % self.bufferSize, int(end) % self.bufferSize))
+        return self.rx_trace()
+
+    def get_writePointer(self):
+        """Current position of the write pointer in the (circular) buffer."""
+        return int(self.txrx_txt('ACQ:WPOS?'))
+
+    def read_windows(self, windows, channels=(1, 2)):
+        """
+        Read only parts of the buffers of @channels. @windows is a list of (first, last) sample indices (inclusive) in the
+        full trace, as returned by read_channel. Returns a list of full length float32 arrays (one per channel), NaN
+        outside of the windows, so they share the time axis of a full trace.
+        """
+        # After the acquisition stopped, the full trace starts right after the write pointer (oldest sample)
+        oldest = self.get_writePointer() + 1
+        for ch in channels:
+            for first, last in windows:
+                self.tx_txt('ACQ:SOUR%i:DATA:STA:N? %i,%i' % (ch, (oldest + first) % self.bufferSize, last - first + 1))
+        res = []
+        for ch in channels:
+            trace = np.full(self.bufferSize, np.nan, dtype=np.float32)
+            for first, last in windows:
+                trace[first:last + 1] = self.rx_trace()
+            res.append(trace)
+        return res
     
     def get_fullBuffer(self, s):
         """
@@ -250,46 +477,30 @@ class Redpitaya (Scpi):
         """Stops acquisition."""
         return self.tx_txt('ACQ:STOP')
 
+    def wait_for_trigger(self, waiter=None):
+        """Returns True once triggered, False if the wait was cancelled (see TriggerWaiter)."""
+        waiter = self.triggerWaiter if waiter is None else waiter
+        return waiter.wait(self)
+
     def get_trace(self, channel):
         self.start_acquisition()
         self.set_triggerSource(self.trigger_source)
-        while 1:
-            self.tx_txt('ACQ:TRIG:STAT?')
-            if self.rx_txt() == 'TD':
-                break
+        if not self.wait_for_trigger():
+            return None
 
         #RSCurrentGenerator.Config_Currents(0.2, 0.05, 1)  # assaf added
-        self.tx_txt('ACQ:SOUR%i:DATA?' % (channel))
-        buff_string = self.rx_txt()
-        buff_string = buff_string.strip('{}\n\r').replace("  ", "").split(',')
-        buff = list(map(float, buff_string))
-        return buff
+        return self.read_channel(channel)
 
     def get_traces(self):
+        """Returns a (2, N) array of the two channels."""
         self.start_acquisition()
         self.set_triggerSource(self.trigger_source)
-        while 1:
-            self.tx_txt('ACQ:TRIG:STAT?')
-            if self.rx_txt() == 'TD':
-                break
-        self.tx_txt('ACQ:SOUR%i:DATA?' % (1))
-        # print(str(datetime.now()))
-        buff_string = self.rx_txt()
-        # print(str(datetime.now()))
-        buff_string = buff_string.strip('{}\n\r').replace("  ", "").split(',')
-        buff1 = list(map(float, buff_string))
-
-        self.tx_txt('ACQ:SOUR%i:DATA?' % (2))
-        buff_string = self.rx_txt()
-        buff_string = buff_string.strip('{}\n\r').replace("  ", "").split(',')
-        buff2 = list(map(float, buff_string))
-        return [buff1, buff2]
+        if not self.wait_for_trigger():
+            return None
+        return np.stack([self.read_channel(1), self.read_channel(2)])
 
     def get_fullbufferFormated(self, s):
-        buff_string = self.get_fullBuffer(s)
-        buff_string = buff_string.strip('{}\n\r').replace("  ", "").split(',')
-        buff1 = list(map(float, buff_string))
-        return buff1
+        return self.read_channel(s)
 
     def outputSin(self, ampl=0.9, freq=10000, output=1):
         wave_form = 'sine'
@@ -315,19 +526,38 @@ class Redpitaya (Scpi):
 #         np.savetxt("homodyne_electronics_CH2.txt", data)
 
 class redPitayaCluster:
-    def __init__(self, trigger_delay=-40000, decimation=8):
+    def __init__(self, trigger_delay=-40000, decimation=8, data_format='BIN'):
         print("Connecting to rp-f08a95.local")
         # self.Sigma = Redpitaya("rp-f08a95.local", trigger_delay=trigger_delay, decimation=decimation)  # sigma +/-
-        self.Sigma = Redpitaya("rp-f08c36.local", trigger_delay=trigger_delay, decimation=decimation)  # sigma +/-
+        self.Sigma = Redpitaya("rp-f08c36.local", trigger_delay=trigger_delay, decimation=decimation, data_format=data_format)  # sigma +/-
         print("Connecting to rp-f08c22.local")
-        self.Pi = Redpitaya("rp-f08c22.local", trigger_delay=trigger_delay, decimation=decimation)  # Pi
+        self.Pi = Redpitaya("rp-f08c22.local", trigger_delay=trigger_delay, decimation=decimation, data_format=data_format)  # Pi
         print("Connecting to rp-f0629e.local")
-        self.OD = Redpitaya("rp-f0629e.local", trigger_delay=trigger_delay, decimation=decimation, trigger_source='EXT_NE')  # OD
+        self.OD = Redpitaya("rp-f0629e.local", trigger_delay=trigger_delay, decimation=decimation, trigger_source='EXT_NE', data_format=data_format)  # OD
         self.rplist = [self.OD, self.Sigma, self.Pi]
+        self.rpnames = ['OD', 'Sigma', 'Pi']
         self.triggerDelay = trigger_delay
         self.decimation = decimation
         self.sampling_rate = 125e6
 
+        # ---- Readout ----
+        # Boards are read concurrently (one thread per board; each board has its own socket)
+        self.parallel_readout = True
+        self.executor = ThreadPoolExecutor(max_workers=len(self.rplist), thread_name_prefix='rpReadout')
+        self.readout_stats = {name: {'last': 0.0, 'mean': 0.0, 'max': 0.0, 'n': 0} for name in self.rpnames + ['total']}
+        # All boards share the trigger; only the first one is polled
+        self.triggerWaiter = TriggerWaiter()
+        # Partial readout: when set (see set_windows), only these parts of the buffers are read
+        self.windows = None
+        self.lastWindows = None  # windows of the last shot (None - full traces)
+
+    def close(self):
+        """Stop waiting for the trigger, release the readout threads and close the boards' connections."""
+        self.triggerWaiter.cancel()
+        self.executor.shutdown(wait=False)
+        for rp in self.rplist:
+            rp.close()
+
     def set_triggerDelay(self, t):
         for rp in self.rplist:
             rp.set_triggerDelay(t)
@@ -364,33 +594,62 @@ class redPitayaCluster:
         return data
 
     def get_traces(self, which=[True, True, True]):
+        """
+        Returns a (6, N) float32 array: CH1 and CH2 of the OD, Sigma and Pi boards (zeros for boards not in @which).
+        Returns None if the trigger wait was cancelled (self.triggerWaiter.cancel()).
+        """
         for el in self.rplist:
             el.start_acquisition()
             el.set_triggerSource(el.trigger_source)
-        while 1:
-            self.rplist[0].tx_txt('ACQ:TRIG:STAT?')
-            if self.rplist[0].rx_txt() == 'TD':
-                break
-        data = []
-        for i, el in enumerate(self.rplist):
-            if which[i] is True:
-                el.tx_txt('ACQ:SOUR%i:DATA?' % (1))
-                buff_string = el.rx_txt()
-                buff_string = buff_string.strip('{}\n\r').replace("  ", "").split(',')
-                buff1 = list(map(float, buff_string))
-                data.append(buff1)
-                el.tx_txt('ACQ:SOUR%i:DATA?' % (2))
-                buff_string = el.rx_txt()
-                buff_string = buff_string.strip('{}\n\r').replace("  ", "").split(',')
-                buff2 = list(map(float, buff_string))
-                data.append(buff2)
-            else:
-                data.append(np.zeros(16384))
-                data.append(np.zeros(16384))
+        if not self.rplist[0].wait_for_trigger(self.triggerWaiter):
+            return None  # cancelled
+        start = time.perf_counter()
+        self.lastWindows = self.windows
+        data = [None] * (2 * len(self.rplist))
+        boards = [i for i in range(len(self.rplist)) if which[i] is True]
+        if self.parallel_readout:
+            futures = {self.executor.submit(self.timed_read, i, self.lastWindows): i for i in boards}
+            for future in as_completed(futures):  # assemble as they arrive
+                i = futures[future]
+                data[2 * i], data[2 * i + 1] = future.result()
+        else:
+            for i in boards:
+                data[2 * i], data[2 * i + 1] = self.timed_read(i, self.lastWindows)
+        self.update_readout_stats('total', time.perf_counter() - start)
+        n = max([len(d) for d in data if d is not None], default=16384)
+        data = np.stack([d if d is not None else np.zeros(n, dtype=np.float32) for d in data])
 
         self.bufferDuration = (len(data[0]) / self.sampling_rate) * self.rplist[0].decimation
         return data
 
+    def set_windows(self, windows, margin=0):
+        """
+        Read only @windows - a list of (first, last) sample indices - of each trace, widened by @margin samples.
+        Samples outside of the windows are NaN. None goes back to reading the full buffers.
+        """
+        self.windows = None if windows is None else mergeWindows(windows, margin, self.rplist[0].bufferSize)
+
+    def timed_read(self, i, windows=None):
+        start = time.perf_counter()
+        if windows is None:
+            res = self.rplist[i].read_channels((1, 2))
+        else:
+            res = self.rplist[i].read_windows(windows, (1, 2))
+        self.update_readout_stats(self.rpnames[i], time.perf_counter() - start)
+        return res
+
+    def update_readout_stats(self, name, dt):
+        """Keep readout time [sec] of each board (and of the whole shot): last, running mean and max."""
+        st = self.readout_stats[name]
+        st['n'] += 1
+        st['last'] = dt
+        st['mean'] += (dt - st['mean']) / st['n']
+        st['max'] = max(st['max'], dt)
+
+    def readout_stats_text(self):
+        return '; '.join(['%s: %.1f ms (mean %.1f, max %.1f)' % (name, st['last'] * 1e3, st['mean'] * 1e3, st['max'] * 1e3)
+                          for name, st in self.readout_stats.items()])
+
 
 def get_frequency_shift():
     pass
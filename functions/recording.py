@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+Session recordings: one append-only file per recording session instead of one .npz per frame.
+
+File layout (all little endian):
+    b'GUIREC01' | uint64 header length | header JSON (n_channels, n_samples, dtype, chunk_frames, channels, metadata)
+    then chunks, each:
+    b'CHNK' | uint32 n_frames | uint64 metadata length | frames (n_frames, n_channels, n_samples) | timestamps float64 (n_frames) | metadata JSON
+
+Frames are buffered and written chunk_frames at a time; flush() (and close()) writes what is buffered as a shorter chunk.
+Chunks are never rewritten, so a crash loses at most the frames not flushed yet; a partially written last chunk is
+ignored by Recording and cut off when the file is appended to again.
+Per-frame metadata (scope parameters, trigger settings, comment...) is stored per chunk; identical dicts are kept once.
+"""
+
+import os
+import glob
+import json
+import struct
+import numpy as np
+
+MAGIC = b'GUIREC01'
+CHUNK_MAGIC = b'CHNK'
+_HEADER = struct.Struct('<8sQ')
+_CHUNK_HEADER = struct.Struct('<4sIQ')
+EXTENSION = '.rec'
+
+
+def _toJson(o):
+    # numpy scalars and arrays in metadata
+    if isinstance(o, np.generic):
+        return o.item()
+    if isinstance(o, np.ndarray):
+        return o.tolist()
+    return str(o)
+
+
+class RecordingWriter:
+    def __init__(self, path, chunk_frames=256, dtype='float32', channels=None, metadata=None):
+        """
+        @path: file to record to; if it exists, frames are appended to it (and must have the same shape)
+        @chunk_frames: frames per chunk
+        @channels: names of the channels (e.g. ['CH1', 'CH2']), saved in the header
+        @metadata: dict saved once in the header (e.g. the time axis, a comment)
+        The number of channels and samples is taken from the first frame.
+        """
+        self.path = path
+        self.chunk_frames = int(chunk_frames)
+        self.dtype = np.dtype(dtype)
+        self.channels = list(channels) if channels is not None else None
+        self.metadata = metadata if metadata is not None else {}
+        self.shape = None  # (n_channels, n_samples)
+        self.f = None
+        self.buffer = None
+        self.timestamps = np.zeros(self.chunk_frames)
+        self.frameMetadata = []
+        self.buffered = 0
+        self.n_frames = 0
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            self.openExisting()
+
+    def openExisting(self):
+        recording = Recording(self.path)
+        header = recording.header
+        self.shape = (header['n_channels'], header['n_samples'])
+        self.dtype = np.dtype(header['dtype'])
+        self.chunk_frames = header['chunk_frames']
+        self.channels = header['channels']
+        self.metadata = header['metadata']
+        self.n_frames = len(recording)
+        self.timestamps = np.zeros(self.chunk_frames)
+        self.f = open(self.path, 'r+b')
+        self.f.truncate(recording.end)  # drop a chunk that was not written completely
+        self.f.seek(recording.end)
+        self.buffer = np.zeros((self.chunk_frames,) + self.shape, dtype=self.dtype)
+
+    def create(self, shape):
+        self.shape = tuple(int(n) for n in shape)
+        header = json.dumps({'n_channels': self.shape[0], 'n_samples': self.shape[1], 'dtype': self.dtype.str,
+                             'chunk_frames': self.chunk_frames, 'channels': self.channels, 'metadata': self.metadata},
+                            default=_toJson).encode('utf-8')
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.f = open(self.path, 'wb')
+        self.f.write(_HEADER.pack(MAGIC, len(header)) + header)
+        self.f.flush()
+        self.buffer = np.zeros((self.chunk_frames,) + self.shape, dtype=self.dtype)
+
+    def append(self, frame, timestamp, metadata=None):
+        """
+        @frame: (n_channels, n_samples), or a list of the channels' traces
+        @timestamp: seconds since the epoch (time.time())
+        @metadata: dict of this frame's parameters
+        """
+        frame = np.asarray(frame)
+        if frame.ndim == 1:
+            frame = frame[np.newaxis]
+        if self.f is None:
+            self.create(frame.shape)
+        if frame.shape != self.shape:
+            raise ValueError('Frame shape %s does not match the recording shape %s' % (str(frame.shape), str(self.shape)))
+        self.buffer[self.buffered] = frame
+        self.timestamps[self.buffered] = timestamp
+        self.frameMetadata.append(metadata if metadata is not None else {})
+        self.buffered += 1
+        self.n_frames += 1
+        if self.buffered == self.chunk_frames:
+            self.flush()
+
+    def flush(self):
+        if self.buffered == 0:
+            return
+        # Identical metadata dicts (the usual case) are stored once
+        unique, index, keys = [], [], {}
+        for m in self.frameMetadata:
+            key = json.dumps(m, sort_keys=True, default=_toJson)
+            if key not in keys:
+                keys[key] = len(unique)
+                unique.append(key)
+            index.append(keys[key])
+        meta = ('{"unique":[%s],"index":%s}' % (','.join(unique), json.dumps(index))).encode('utf-8')
+        n = self.buffered
+        start = self.f.tell()
+        try:
+            self.f.write(_CHUNK_HEADER.pack(CHUNK_MAGIC, n, len(meta)))
+            self.f.write(self.buffer[:n].tobytes())
+            self.f.write(self.timestamps[:n].astype('<f8').tobytes())
+            self.f.write(meta)
+            self.f.flush()
+        except OSError:
+            try:  # do not leave half a chunk behind; the frames are still buffered
+                self.f.seek(start)
+                self.f.truncate()
+            except OSError:
+                pass
+            raise
+        self.buffered = 0
+        self.frameMetadata = []
+
+    def options(self):
+        """Keywords to create a recording like this one"""
+        return {'chunk_frames': self.chunk_frames, 'dtype': self.dtype.str, 'channels': self.channels, 'metadata': self.metadata}
+
+    def takePending(self):
+        """Remove and return the frames not written yet: (frames, timestamps, metadata)"""
+        n = self.buffered
+        pending = (self.buffer[:n].copy() if n else [], self.timestamps[:n].copy(), self.frameMetadata)
+        self.n_frames -= n
+        self.buffered = 0
+        self.frameMetadata = []
+        return pending
+
+    def close(self):
+        if self.f is not None:
+            self.flush()
+            self.f.close()
+            self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Recording:
+    """Reads a recording file. Frames are read on demand (read, [i]) or memory-mapped per chunk (memmap)."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            magic, length = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != MAGIC:
+                raise ValueError('%s is not a recording' % path)
+            self.header = json.loads(f.read(length).decode('utf-8'))
+            self.shape = (self.header['n_channels'], self.header['n_samples'])
+            self.dtype = np.dtype(self.header['dtype'])
+            self.frameBytes = self.shape[0] * self.shape[1] * self.dtype.itemsize
+            self.chunks = []  # (offset of frames, n_frames, metadata length)
+            self.end = _HEADER.size + length  # end of the last complete chunk
+            size = os.fstat(f.fileno()).st_size
+            while self.end + _CHUNK_HEADER.size <= size:
+                f.seek(self.end)
+                magic, n, metaLength = _CHUNK_HEADER.unpack(f.read(_CHUNK_HEADER.size))
+                chunkEnd = self.end + _CHUNK_HEADER.size + n * (self.frameBytes + 8) + metaLength
+                if magic != CHUNK_MAGIC or chunkEnd > size:
+                    break  # incomplete last chunk
+                self.chunks.append((self.end + _CHUNK_HEADER.size, n, metaLength))
+                self.end = chunkEnd
+        self.starts = np.cumsum([0] + [n for _, n, _ in self.chunks])  # index of the first frame of each chunk
+        self.metaCache = {}
+
+    @property
+    def channels(self):
+        return self.header['channels']
+
+    @property
+    def metadata(self):
+        return self.header['metadata']
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        return self.read(i, i + 1)[0][0]
+
+    def locate(self, i):
+        c = int(np.searchsorted(self.starts, i, side='right')) - 1
+        return c, i - int(self.starts[c])
+
+    def read(self, start, stop=None):
+        """Frames @start..@stop-1: (frames (n, n_channels, n_samples), timestamps (n,), list of metadata dicts)"""
+        stop = len(self) if stop is None else min(stop, len(self))
+        frames = np.empty((max(0, stop - start),) + self.shape, dtype=self.dtype)
+        timestamps = np.empty(len(frames))
+        metadata = []
+        i = start
+        with open(self.path, 'rb') as f:
+            while i < stop:
+                c, j = self.locate(i)
+                offset, n, _ = self.chunks[c]
+                k = min(n - j, stop - i)  # frames to take from this chunk
+                f.seek(offset + j * self.frameBytes)
+                f.readinto(memoryview(frames[i - start:i - start + k]).cast('B'))
+                f.seek(offset + n * self.frameBytes + j * 8)
+                timestamps[i - start:i - start + k] = np.frombuffer(f.read(8 * k), dtype='<f8')
+                metadata += self.chunkMetadata(c, f)[j:j + k]
+                i += k
+        return frames, timestamps, metadata
+
+    def chunkMetadata(self, c, f=None):
+        if c not in self.metaCache:
+            offset, n, metaLength = self.chunks[c]
+            if f is None:
+                with open(self.path, 'rb') as f:
+                    return self.chunkMetadata(c, f)
+            f.seek(offset + n * (self.frameBytes + 8))
+            meta = json.loads(f.read(metaLength).decode('utf-8'))
+            self.metaCache[c] = [meta['unique'][k] for k in meta['index']]
+        return self.metaCache[c]
+
+    def timestamps(self):
+        return np.concatenate([self.read(int(self.starts[c]), int(self.starts[c + 1]))[1] for c in range(len(self.chunks))]) \
+            if self.chunks else np.zeros(0)
+
+    def memmap(self, c):
+        """Chunk @c as a read-only memory-mapped (n_frames, n_channels, n_samples) array"""
+        offset, n, _ = self.chunks[c]
+        return np.memmap(self.path, dtype=self.dtype, mode='r', offset=offset, shape=(n,) + self.shape)
+
+    def memmapChunks(self):
+        return [self.memmap(c) for c in range(len(self.chunks))]
+
+
+def convertNpzFolder(folder, path, channels=None, time_key=None, chunk_frames=256):
+    """
+    Convert a folder of per-frame .npz files (as saved by the scope tabs and the DPO/TDS scripts) into one recording.
+    @channels: keys of the traces; by default, all 1D arrays of the first file that have the most common length
+    (empty, i.e. not acquired, channels are skipped)
+    @time_key: key of the time axis, saved once in the header ('time' or 'times' by default)
+    Other values of each file (meta, comment...) go to the frame's metadata. Timestamps are the files' modification times.
+    Returns the number of frames converted.
+    """
+    files = sorted(glob.glob(os.path.join(folder, '*.npz')))
+    if not files:
+        return 0
+    with np.load(files[0]) as first:
+        if time_key is None:
+            time_key = next((k for k in ('time', 'times') if k in first.files), None)
+        if channels is None:
+            arrays = {k: first[k] for k in first.files if k != time_key and first[k].ndim == 1 and first[k].size > 0
+                      and np.issubdtype(first[k].dtype, np.number)}
+            lengths = [len(a) for a in arrays.values()]
+            length = max(set(lengths), key=lengths.count)
+            channels = [k for k, a in arrays.items() if len(a) == length]
+        metadata = {'source': os.path.abspath(folder)}
+        if time_key is not None:
+            metadata['time'] = first[time_key]
+    n = 0
+    with RecordingWriter(path, chunk_frames=chunk_frames, channels=channels, metadata=metadata) as writer:
+        for file in files:
+            with np.load(file) as data:
+                frameMetadata = {k: data[k].item() if data[k].ndim == 0 else data[k] for k in data.files
+                                 if k not in channels and k != time_key}
+                frameMetadata['file'] = os.path.basename(file)
+                writer.append([data[k] for k in channels], os.path.getmtime(file), frameMetadata)
+            n += 1
+    return n
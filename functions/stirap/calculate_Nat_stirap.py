@@ -1,8 +1,19 @@
 import numpy as np
 from scipy.signal import find_peaks
+from functions.analysis.range_integrals import RangeIntegrator
 
 
 class NAtoms:
+    def __init__(self):
+        self.rangeIntegrator = RangeIntegrator()  # cursor slices, recomputed only when the cursors or times change
+
+    def cursorMeans(self, cursor_times, times, trace):
+        # Means of @trace between the first two and the last two cursors (from the last sample before each cursor)
+        self.rangeIntegrator.setCursors(times, cursor_times[:4])
+        self.trig1_strt, self.trig2_strt = self.rangeIntegrator.starts
+        self.trig1_end, self.trig2_end = self.rangeIntegrator.stops
+        return self.rangeIntegrator.means(trace)
+
     def calculate_Nat(self, cursor_times, times, trace, avg_photons=2, sensitivity=7081.1):
         """
         :param cursor_times: position of the cursors within which to estimate the number of atoms. Same units as 'times'
@@ -15,18 +26,13 @@ class NAtoms:
         if (cursor_times[1]-cursor_times[0] <= 0) or (cursor_times[3]-cursor_times[2] <= 0) or (cursor_times[2]-cursor_times[1] < 0):
             print("Cursors are wrongly positioned")
             return 0
-        self.trig1_strt = np.where(times < cursor_times[0])[0][-1]
-        self.trig1_end = np.where(times < cursor_times[1])[0][-1]
-        self.trig2_strt = np.where(times < cursor_times[2])[0][-1]
-        self.trig2_end = np.where(times < cursor_times[3])[0][-1]
-        d1 = np.array(trace[self.trig1_strt:self.trig1_end])
-        d2 = np.array(trace[self.trig2_strt:self.trig2_end])
+        avg1, avg2 = self.cursorMeans(cursor_times, times, trace)
 
         # sensitivity = 75263  # sensitivity in V/W
         h = 6.62607004e-34  # planck's constant
         THz = 1e12
         fl = 384.2304844685 * THz  # Laser frequency
-        res = (np.average(d2)-np.average(d1))/sensitivity/avg_photons/h/fl * (cursor_times[1]-cursor_times[0])*1e-6
+        res = (avg2 - avg1)/sensitivity/avg_photons/h/fl * (cursor_times[1]-cursor_times[0])*1e-6
         return res
 
     def calculateTransmission(self, cursor_times, times, trace):
@@ -41,14 +47,9 @@ class NAtoms:
         if (cursor_times[1]-cursor_times[0] <= 0) or (cursor_times[3]-cursor_times[2] <= 0) or (cursor_times[2]-cursor_times[1] < 0):
             print("Cursors are wrongly positioned")
             return 0
-        self.trig1_strt = np.where(times < cursor_times[0])[0][-1]
-        self.trig1_end = np.where(times < cursor_times[1])[0][-1]
-        self.trig2_strt = np.where(times < cursor_times[2])[0][-1]
-        self.trig2_end = np.where(times < cursor_times[3])[0][-1]
-        d1 = np.array(trace[self.trig1_strt:self.trig1_end])
-        d2 = np.array(trace[self.trig2_strt:self.trig2_end])
-
-        res = (np.average(d2)/np.average(d1))
+        avg1, avg2 = self.cursorMeans(cursor_times, times, trace)
+
+        res = (avg2 / avg1)
         return res
     
     def get_delay(self, data):
@@ -39,7 +39,7 @@ class Experiment_gui(QMainWindow):
         self.mainframe.setLayout(layout)
         self.mainframe.setContentsMargins(0,0,0,0)
         self.tabwidget = QTabWidget()
-        self.tabwidget.setTabsClosable(False)
+        self.tabwidget.setTabsClosable(True)
         self.tabwidget.setMovable(True)
         self.tabwidget.tabCloseRequested.connect(self.removeTab)
         # self.tabwidget.currentChanged.connect(self.tabchanged)
@@ -112,9 +112,15 @@ class Experiment_gui(QMainWindow):
             self.conf_tab.threadpool = self.threadpool
             self.tabwidget.addTab(self.conf_tab, "Configure")
 
+    def closeEvent(self, event):
+        for i in range(self.tabwidget.count()):
+            self.tabwidget.widget(i).close()
+        super().closeEvent(event)
+
     def removeTab(self, index):
         widget = self.tabwidget.widget(index)
         if widget is not None:
+            widget.close()  # lets the tab stop its acquisition loops (closeEvent)
             widget.deleteLater()
             if widget.objectName() == 'Temperature':
                 del self.temperature_tab
@@ -7,17 +7,22 @@ Created on Sun Jan 10 12:17:08 2021
 
 from PyQt5 import uic
 import time
+import threading
 from functions.od import scpi
-from scipy import optimize
 import os
 import sys
 import numpy as np
 from PyQt5.QtWidgets import QApplication
 import matplotlib
-from PyQt5.QtCore import QThreadPool
+from PyQt5.QtCore import QThreadPool, pyqtSignal
 from datetime import date, datetime
 from widgets.worker import Worker
 from functions.stirap.calculate_Nat_stirap import NAtoms
+from functions.data_writer import AsyncWriter
+from functions.analysis.measurement_stream import MeasurementStream
+from functions.analysis.range_integrals import prefixSums
+from functions.analysis.pulse_edges import pulseEdges, readoutWindows
+from widgets.scopeWidget.trend_plot import TrendWindow
 try:
     from functions.od.calculate_OD import OD_exp
 except:
@@ -29,6 +34,7 @@ from widgets.quantumWidget import QuantumWidget
 
 
 class STIRAP_gui (QuantumWidget):
+    natMeasured = pyqtSignal()  # emitted by display_traces (readout thread); the trend window is redrawn on the GUI thread
     def __init__(self, Parent=None, ui=None, simulation=True):
         if Parent is not None:
             self.Parent = Parent
@@ -50,6 +56,8 @@ class STIRAP_gui (QuantumWidget):
         self.pushButton_updateTriggerDelay.clicked.connect(self.updateTriggerDelay)
         self.checkBox_sequence.clicked.connect(self.showHideSequence)
         self.pushButton_saveCurrentData.clicked.connect(self.saveCurrentDataClicked)
+        self.pushButton_trend.clicked.connect(self.showTrend)
+        self.natMeasured.connect(self.refreshTrend)
         self.enable_interface(False)
         self.frame_STIRAP_sequence.hide()
         
@@ -75,7 +83,20 @@ class STIRAP_gui (QuantumWidget):
         # self.cursors = list(np.array([145, 312, 535, 705]))
         self.cursors = []
         self.pulsesDelay = 0
-        self.nathistory = []
+        self.measurements = MeasurementStream()  # every Nat calculated, with rolling statistics; see showTrend
+        self.trendWindow = None
+        self.rp = None
+        self.stopTraces = threading.Event()  # set when the tab is closed (or on reconnect); stops display_traces_loop
+        self.triggerTimeout = 5  # [sec]; report a missing trigger instead of waiting silently
+        self.partialReadout = True  # once cursors are placed, read only around them
+        self.windowMargin = 200  # [samples] read on each side of the cursors
+        self.cursorsPending = None  # cursors to be placed on the next full trace (see positionCursorsList)
+        self.cursorsSource = None  # trace (comboBox_cursors text) the cursors were placed on
+        self.cursorEdges = None  # pulse edges (samples) the cursors were placed from; see checkCursorDrift
+        self.cursorContrast = None  # max - min of the trace the cursors were placed on
+        self.autoCursors = True  # re-place the cursors when the pulse edges drift
+        self.edgeDriftTolerance = 10  # [samples]
+        self.cursorSearchRadius = 300  # [samples] second window is searched within this of its detected position
 
         self.last_data1_OD, self.last_data2_OD = [], []
         self.last_data1_Sigma, self.last_data2_Sigma = [], []
@@ -85,9 +106,14 @@ class STIRAP_gui (QuantumWidget):
         self.rptimes = []
         self.cursors_data = []
         self.datafile = None
+        # Continuous saving (checkBox_saveData) appends the traces to one recording per session, from a background thread
+        self.dataWriter = AsyncWriter(primary_dir=os.path.join("C:\\", "Pycharm", "Expriements", "DATA", "STIRAP"))
+        self.recordingName, self.recordingShape = None, None
+        self.checkBox_saveData.clicked.connect(self.newRecording)
         # self.enable_interface(True)
 
         self.odexp = OD_exp()
+        self.natoms = NAtoms()  # kept, so its cursor slices are only recomputed when the cursors or times change
         
     def update_pulse_length(self):
         duration = self.frame_STIRAP_sequence.spinBox_pulse_length.value()
@@ -164,14 +190,33 @@ class STIRAP_gui (QuantumWidget):
     def updateDecimation(self):
         dec = int(self.comboBox_decimation.currentText())
         self.rp.set_decimation(dec)
+        self.rp.set_windows(None)  # pulses move within the buffer; read full traces until cursors are placed again
         self.lineEdit_triggerDelay.setText(str(int(self.rp.triggerDelay)*1e-3))
         self.print_to_dialogue("Decimation changed to %i" % dec)
 
     def updateTriggerDelay(self):
         t = int(float(self.lineEdit_triggerDelay.text())*1e3)
         self.rp.set_triggerDelay(t)
+        self.rp.set_windows(None)
         self.print_to_dialogue("Trigger delay changed to %i ns" % t)
 
+    def newRecording(self):
+        self.recordingName = None  # the next recorded traces start a new session file
+
+    def recordCurrentData(self):
+        # Append the last traces to this session's recording, DATA/STIRAP/<today>/<start time> session.rec
+        frame = np.array([self.last_data1_OD, self.last_data2_OD, self.last_data1_Sigma, self.last_data2_Sigma,
+                          self.last_data1_Pi, self.last_data_repump], dtype=np.float32)
+        if self.recordingName is None or self.recordingShape != frame.shape:
+            now = datetime.now()
+            self.recordingName = os.path.join(now.strftime("%B-%d-%Y"), now.strftime("%Hh%Mm%Ss") + " session")
+            self.recordingShape = frame.shape
+            self.print_to_dialogue("Recording to DATA/STIRAP/%s.rec" % self.recordingName)
+        parameters = {'decimation': self.comboBox_decimation.currentText(), 'trigger_delay': self.lineEdit_triggerDelay.text(),
+                      'cursors': [int(c) for c in self.cursors]}
+        self.dataWriter.record(self.recordingName, frame, parameters=parameters, metadata={'times': self.rptimes},
+                               channels=['CH1_OD', 'CH2_Depump', 'CH1_Sigma', 'CH2_Sigma', 'CH1_Pi_Pi', 'CH2_Pi_repump'])
+
     def saveCurrentDataClicked(self):
         now = datetime.now()
         today = date.today()
@@ -205,42 +250,80 @@ class STIRAP_gui (QuantumWidget):
         self.alert_box(
             "Turn of the B-field gradient and make sure that the pulses are properly contained within the plot.")
         boxText = str(self.comboBox_cursors.currentText())
-        self.print_to_dialogue("Placing cursors around %s" % boxText)
+        if self.rp.windows is not None:
+            # Cursors need full traces; they are placed by display_traces once the next full shot is in
+            self.rp.set_windows(None)
+            self.cursorsPending = boxText
+            self.print_to_dialogue("Reading full traces; cursors will be placed on the next shot")
+            return
+        self.placeCursors(boxText)
+
+    def cursorTrace(self, boxText):
         if boxText == "Sigma":
-            dat = np.array(self.last_data_CH1CH2Sum)
+            return np.array(self.last_data_CH1CH2Sum)
         if boxText == "Pi":
-            dat = np.array(self.last_data_Pi)
+            return np.array(self.last_data_Pi)
         if boxText == "Depump":
-            dat = np.array(self.last_data2_OD)
+            return np.array(self.last_data2_OD)
         if boxText == "OD":
-            dat = np.array(self.last_data1_OD)
+            return np.array(self.last_data1_OD)
+
+    def placeCursors(self, boxText):
+        self.print_to_dialogue("Placing cursors around %s" % boxText)
+        dat = self.cursorTrace(boxText)
+        self.cursorsSource = boxText
         self.cursors = self.positionCursors(dat)
         Nat = NAtoms()
         self.pulsesDelay = Nat.get_delay(dat)
+        self.updateReadoutWindows()
+
+    def checkCursorDrift(self):
+        """Re-place the cursors if the pulse edges moved by more than self.edgeDriftTolerance since they were placed."""
+        nat = self.cursorTrace(self.cursorsSource)
+        if not np.any(np.isfinite(nat)) or np.nanmax(nat) - np.nanmin(nat) < self.cursorContrast / 2:
+            return  # no pulses in this shot (e.g. no atoms / beams off): hold the cursors
+        edges = pulseEdges(nat)
+        drift = np.max(np.abs(np.array(edges) - self.cursorEdges)) if edges is not None else 0
+        if drift <= self.edgeDriftTolerance:
+            return
+        self.print_to_dialogue("Pulse edges moved by %d samples; re-placing cursors" % drift)
+        if self.rp.lastWindows is not None:
+            # As positionCursorsList: placed on the next full trace
+            self.rp.set_windows(None)
+            self.cursorsPending = self.cursorsSource
+        else:
+            self.placeCursors(self.cursorsSource)
+
+    def updateReadoutWindows(self):
+        """Read only the cursor windows (plus self.windowMargin); the difference trace also needs them shifted by pulsesDelay."""
+        if not self.partialReadout or len(self.cursors) != 4:
+            self.rp.set_windows(None)
+            return
+        samples = np.array(self.cursors) * 1e-6 * self.rp.sampling_rate / self.rp.decimation  # cursors are in us
+        # With autoCursors, the pulse edges are read too, so that checkCursorDrift sees them on the partial traces
+        edges = self.cursorEdges if self.autoCursors else None
+        self.rp.set_windows(readoutWindows(samples, self.pulsesDelay, edges, self.edgeDriftTolerance),
+                            margin=self.windowMargin)
 
     def positionCursors(self, dat):
-        nat = np.array(dat)
-        dy = nat.max() - nat.min()
-        tresholdlevel = nat.min()+dy/2
+        nat = np.array(dat, dtype=float)
         d_threshold = 150  # position before the threshold position on which we want to place the cursor
-        a, b, d = 0, 0, 0
-        for i, el in enumerate(nat):
-            if el>=tresholdlevel:
-                a = int(i-d_threshold)
-                break
-        for i, el in enumerate(nat[a+100+d_threshold:]):
-            if el<=tresholdlevel:
-                d = int(i)
-                break
-        for i, el in enumerate(nat[a+d+400:]):
-            if el>=tresholdlevel:
-                b = int(i+a+d+400 - d_threshold)
-                break
-        res = optimize.minimize(self.odexp.tominimizeNat, np.array([b]), args=(a, d, nat))
-        print(res)
-        b_opt = res.x[0]
+        edges = pulseEdges(nat)
+        if edges is None or edges[0] < d_threshold:
+            self.print_to_dialogue("Could not find the two pulses; cursors not moved", color='red')
+            return self.cursors
+        self.cursorEdges = np.array(edges)
+        self.cursorContrast = np.nanmax(nat) - np.nanmin(nat)
+        rise1, fall1, rise2 = edges
+        a = rise1 - d_threshold
+        d = fall1 - (a + 100 + d_threshold)
+        b = rise2 - d_threshold
+        # Exhaustive search of the second window start around b (Nat is piecewise constant in it; no gradient to follow)
+        candidates = np.arange(max(0, b - self.cursorSearchRadius), min(len(nat) - d, b + self.cursorSearchRadius) + 1)
+        nats = self.odexp.tominimizeNatAll(candidates, a, d, prefixSums(nat))
+        b_opt = int(candidates[np.argmin(nats)])
         print([a, a + d, b_opt, b_opt + d])
-        self.print_to_dialogue("Minimized down to Nat = %.0f * 1e3"%(res.fun/1e3))
+        self.print_to_dialogue("Minimized down to Nat = %.0f * 1e3"%(np.min(nats)/1e3))
         added_interval = 5
         cursors = np.array([a, a + d, b_opt, b_opt + d])/self.rp.sampling_rate*self.rp.decimation*1e6
         cursors[1] += added_interval
@@ -263,11 +346,21 @@ class STIRAP_gui (QuantumWidget):
         self.threadpool.start(worker)
 
     def display_traces_loop(self, progress_callback):
-        while True:
-            self.display_traces()
+        stop = self.stopTraces  # this connection's; utils_connect replaces self.stopTraces on reconnect
+        while not stop.is_set():
+            try:
+                self.display_traces()
+            except TimeoutError:
+                self.print_to_dialogue("No trigger in the last %d sec" % self.triggerTimeout, color='red')
+            except OSError:
+                if stop.is_set():
+                    return  # boards were closed in the middle of a read
+                raise
 
     def display_traces(self):
         data = self.rp.get_traces()
+        if data is None:  # trigger wait was cancelled
+            return
         dataPlot = [data[i] for i in range(len(data))]
         dataPlot[5] = data[4]
         dataPlot[4] = np.array(data[2]) + np.array(data[3])
@@ -289,7 +382,12 @@ class STIRAP_gui (QuantumWidget):
                       self.checkBox_Diff.isChecked(),
                       ]
         if self.checkBox_saveData.isChecked():
-            self.saveCurrentDataClicked()
+            self.recordCurrentData()
+        if self.cursorsPending is not None and self.rp.lastWindows is None:
+            boxText, self.cursorsPending = self.cursorsPending, None
+            self.placeCursors(boxText)
+        elif self.autoCursors and self.cursorsPending is None and self.cursorEdges is not None:
+            self.checkCursorDrift()
         boxText = str(self.comboBox_cursors.currentText())
         if boxText == "Sigma":
             self.cursors_data = np.array(self.last_data_CH1CH2Sum)
@@ -309,19 +407,27 @@ class STIRAP_gui (QuantumWidget):
             sensitivity = 75e3  # This is a h'irtut
         if self.checkBox_displayNat.isChecked():
             try:
-                natoms = NAtoms()
-                Nat = natoms.calculate_Nat(self.cursors, self.rptimes, trace=self.cursors_data, avg_photons=avg_photons, sensitivity=sensitivity)
+                Nat = self.natoms.calculate_Nat(self.cursors, self.rptimes, trace=self.cursors_data, avg_photons=avg_photons, sensitivity=sensitivity)
                 self.print_to_dialogue("Number of atoms = %.1f *1e6" % (Nat / 1e6))
-                self.nathistory.append(Nat)
-                if len(self.nathistory) > 30:
-                    self.nathistory.pop(0)
+                self.measurements.append(n_atoms=Nat)
+                self.natMeasured.emit()
             except IndexError:
                 self.print_to_dialogue("Display Nat: List index out of range")
         dataPlot.append(self.cursors_data - np.roll(self.cursors_data, self.pulsesDelay))
         labels = ["OD", "Depump", "CH1", "CH2", "CH1+CH2", "Pi", "Repump", "Difference"]
         self.widgetPlot.plot_traces(dataPlot, self.rptimes, truthiness, labels, self.cursors,
                                     autoscale=self.checkBox_plotAutoscale.isChecked(), sensitivity=sensitivity,
-                                    nathistory=self.nathistory)
+                                    nathistory=self.measurements.latest(30)['n_atoms'])
+
+    def showTrend(self):
+        if self.trendWindow is None:
+            self.trendWindow = TrendWindow(self.measurements, fields=('n_atoms',), title='STIRAP Nat trend')
+        self.trendWindow.show()
+        self.trendWindow.raise_()
+
+    def refreshTrend(self):
+        if self.trendWindow is not None:
+            self.trendWindow.refresh()
 
     def utils_connect_worker(self):
         worker = Worker(self.utils_connect)
@@ -369,7 +475,13 @@ class STIRAP_gui (QuantumWidget):
         self.print_to_dialogue("Connecting to RedPitayas...")
         trigger_delay = int(self.lineEdit_triggerDelay.text())*1000
         decimation = int(self.comboBox_decimation.currentText())
+        if self.rp is not None:
+            # Reconnecting: stop the previous connection's traces loop, then release its boards and readout threads
+            self.stopTraces.set()
+            self.rp.close()
+            self.stopTraces = threading.Event()
         self.rp = scpi.redPitayaCluster(trigger_delay=trigger_delay, decimation=decimation)
+        self.rp.triggerWaiter = scpi.TriggerWaiter(timeout=self.triggerTimeout, cancel_event=self.stopTraces)
         self.print_to_dialogue("RedPitayas are connected.")
         time.sleep(0.1)
         self.connectOPX()
@@ -377,6 +489,13 @@ class STIRAP_gui (QuantumWidget):
         self.updateDecimation()
         self.updateTriggerDelay()
 
+    def closeEvent(self, event):
+        self.stopTraces.set()
+        if self.rp is not None:
+            self.rp.close()
+        self.dataWriter.close()
+        super().closeEvent(event)
+
 
 if __name__ == "__main__":
     app = QApplication([])
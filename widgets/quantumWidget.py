@@ -28,12 +28,12 @@ from pyqtconsole.console import PythonConsole
 
 
 class QuantumWidget (QWidget):
-    def __init__(self, ui=None, simulation=True):
+    def __init__(self, ui=None, simulation=True, plotBackend='matplotlib'):
         super(QuantumWidget, self).__init__()
         ui = os.path.join(os.path.dirname(__file__), "gui.ui") if ui is None else ui
         uic.loadUi(ui, self)
 
-        self.widgetPlot = dataplot.PlotWindow()
+        self.widgetPlot = dataplot.createPlotWindow(plotBackend)
         
         try:
             self.verticalLayout_mpl.addWidget(self.widgetPlot.widgetPlot)
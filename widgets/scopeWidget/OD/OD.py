@@ -20,10 +20,13 @@ if matplotlib.get_backend() != 'Qt5Agg':
     matplotlib.use('Qt5Agg')
 
 from widgets.scopeWidget.scope import Scope_GUI
+from functions.analysis.range_integrals import RangeIntegrator
+from functions.analysis.measurement_stream import MeasurementStream
+from widgets.scopeWidget.trend_plot import TrendWindow
 
 
 class OD_GUI(Scope_GUI):
-    def __init__(self, Parent=None, ui=None, simulation=True, RedPitayaHost = None, debugging = False, sensitivity = (2.41e5,2.41e5)):
+    def __init__(self, Parent=None, ui=None, simulation=True, RedPitayaHost = None, debugging = False, sensitivity = (2.41e5,2.41e5), plotBackend = 'matplotlib', replay = None, replayMode = 'original'):
        # 2.24541949e+04 From second msrmnt
        # 2.8e4 From first msrmnt
        # I settle for 2.5
@@ -35,13 +38,16 @@ class OD_GUI(Scope_GUI):
         self.listenForMouseClickCID = None
         self.listenForMouseMoveCID = None
         self.selectedXRanges = None # containing pairs of (x_start, x_end) (in data units) defining ranges on scope
+        self.rangeIntegrator = RangeIntegrator() # index slices of the ranges; recomputed only when the ranges or time scale change
         self.vLineMarker = None
+        self.measurements = MeasurementStream() # every OD/depump measured, with rolling statistics; see showTrend
+        self.trendWindow = None
 
         if __name__ == "__main__":
             self.threadpool = QThreadPool()
             print("Multithreading with maximum %d threads" % self.threadpool.maxThreadCount())
 
-        super().__init__(Parent=Parent, ui=ui, simulation=simulation, RedPitayaHost = RedPitayaHost, debugging=debugging)
+        super().__init__(Parent=Parent, ui=ui, simulation=simulation, RedPitayaHost = RedPitayaHost, debugging=debugging, plotBackend=plotBackend, replay=replay, replayMode=replayMode)
 
         # Add outputs control UI
         self.ODControl=self.frame_4
@@ -60,6 +66,13 @@ class OD_GUI(Scope_GUI):
         self.ODControl.pushButton_selectRanges.clicked.connect(self.scopeListenForMouseEvents)
         self.ODControl.pushButton_autoSelectRanges.clicked.connect(self.scopeListenForMouseEvents)
         self.ODControl.pushButton_updateRanges.clicked.connect(self.updateSelectedRangesFromSpinboxes)
+        self.ODControl.pushButton_trend.clicked.connect(self.showTrend)
+
+    def showTrend(self):
+        if self.trendWindow is None:
+            self.trendWindow = TrendWindow(self.measurements, fields=('od', 'n_atoms'), title='OD / depump trend')
+        self.trendWindow.show()
+        self.trendWindow.raise_()
 
     def updateSelectedRangesFromSpinboxes(self):
         # Update @self.selectedXRanges accoridng to spinboxes, then redraw.
@@ -88,6 +101,7 @@ class OD_GUI(Scope_GUI):
                 # Add vertical line to graph
                 ax = event.inaxes  # the axes instance
                 ax.axvline(event.xdata, linestyle='-', alpha = 0.5)
+                self.widgetPlot.canvas.draw_idle()
                 if len(self.selectedXRanges) == self.nRangesToSelect * 2:
                     # If clicked on canvas, and already has two peaks selected, stop listening for click
                     self.widgetPlot.canvas.mpl_disconnect(self.listenForMouseClickCID)
@@ -106,6 +120,7 @@ class OD_GUI(Scope_GUI):
                     self.vLineMarker = ax.axvline(event.xdata,linestyle = '--', alpha = 0.5)
                 else:
                     self.vLineMarker.set_xdata(event.xdata)
+                self.widgetPlot.canvas.draw_idle()
 
         self.selectedXRanges = []
         self.vLineMarker = None
@@ -121,7 +136,7 @@ class OD_GUI(Scope_GUI):
             self.listenForMouseClickCID = None
 
 
-    # Never call this method. this is called by RedPitaya
+    # Never call this method. this is called (on the GUI thread) by self.frameQueue, with frames from RedPitaya
     def update_scope(self, data, parameters):
         if self.rp.firstRun:
             # Set default from display...
@@ -132,15 +147,8 @@ class OD_GUI(Scope_GUI):
             self.chns_update()
             self.rp.firstRun = False
 
-        # ---------------- Handle duplicate data ----------------
-        # It seems RedPitaya tends to send the same data more than once. That is, although it has not been triggered,
-        # scope will send current data as fast as it can.
-        # Following lines aim to prevent unnecessary work
-        previousDataIndex = (self.Avg_indx - 1) % self.Avg_num[0]
-        # print(data[0])
-        # print(self.Rb_lines_Data[previousDataIndex])
-        if not self.rp.firstRun and np.array_equal(self.Rb_lines_Data[previousDataIndex], data[0]) and np.array_equal(self.Cavity_Transmission_Data[previousDataIndex], data[1]):
-            return
+        # Note: RedPitaya tends to send the same data more than once (although it has not been triggered, scope will send
+        # current data as fast as it can). These duplicates are dropped by RedPitaya itself; see self.rp.duplicates_dropped
         # ---------------- Handle Redraws and data reading ----------------
         # This is true only when some parameters were changed on RP, prompting a total redraw of the plot (in other cases, updating the data suffices)
         redraw = (parameters['new_parameters'] or self.CHsUpdated)
@@ -148,18 +156,14 @@ class OD_GUI(Scope_GUI):
             self.scope_parameters.update(parameters)  # keep all the parameters. we need them.
             self.CHsUpdated = False
 
-        self.Rb_lines_Data[self.Avg_indx % self.Avg_num[0]] = data[0]  # Insert new data
-        self.Cavity_Transmission_Data[self.Avg_indx % self.Avg_num[1]] = data[1]  # Insert new data
-        self.Avg_indx = self.Avg_indx + 1
-
         # ---------------- Average data  ----------------
-        # Calculate avarage data and find peaks position (indx) and properties:
+        # Insert new data and get the updated averages
+        self.Rb_lines_Avg_Data = self.Rb_lines_Data.add(data[0])
+        self.Cavity_Transmission_Avg_Data = self.Cavity_Transmission_Data.add(data[1])
         Avg_data = []
         if self.checkBox_Rb_lines.isChecked():
-            self.Rb_lines_Avg_Data = np.average(self.Rb_lines_Data, axis=0)
             Avg_data = Avg_data + [self.Rb_lines_Avg_Data]
         if self.checkBox_Cavity_transm.isChecked():
-            self.Cavity_Transmission_Avg_Data = np.average(self.Cavity_Transmission_Data, axis=0)
             Avg_data = Avg_data + [self.Cavity_Transmission_Avg_Data]
 
         # ------- Scales -------
@@ -186,10 +190,14 @@ class OD_GUI(Scope_GUI):
         if self.selectedXRanges and len(self.selectedXRanges) == 6: # that is, if there are two ranges selected
             if self.ODControl.radioButton_OD.isChecked():
                 OD = self.calculateOD(data=Avg_data, x_axis=x_axis, channel=2)
+                self.measurements.append(od=OD)
                 text = 'OD = %.2f' % OD
             elif self.ODControl.radioButton_Depump.isChecked():
                 depump = self.calculateDepump(data=Avg_data, x_axis=x_axis, channel=1)
+                self.measurements.append(n_atoms=depump)
                 text = 'Depump = %.2f' % (depump / 1e6)
+            if self.trendWindow is not None:
+                self.trendWindow.refresh()
 
         # ----------- text box -----------
         # to be printed in lower right corner
@@ -198,40 +206,45 @@ class OD_GUI(Scope_GUI):
         # --------- plot ---------
         # Prepare data for display:
         labels = ["CH1 - Depump", "CH2 - OD"]
-        self.widgetPlot.plot_Scope(x_axis, Avg_data, autoscale=self.checkBox_plotAutoscale.isChecked(), redraw=redraw, labels = labels, x_ticks = x_ticks, y_ticks= y_ticks,
-                                   text_box = text_box_string, aux_plotting_func=self.widgetPlot.plotVerticalLines, verticalXs = self.selectedXRanges, vLineStyle = self.rangeSelectionLineStyle)
+        self.renderScheduler.submit(x_axis, Avg_data, autoscale=self.checkBox_plotAutoscale.isChecked(), redraw=redraw, labels = labels, x_ticks = x_ticks, y_ticks= y_ticks,
+                                    text_box = text_box_string, aux_plotting_func=self.widgetPlot.plotVerticalLines, verticalXs = self.selectedXRanges, vLineStyle = self.rangeSelectionLineStyle)
 
         # -------- Save Data  --------
         #TODO fix this. Seperate common scope actions and speciality features... this should not be copied from the scope.py method
         if self.checkBox_saveData.isChecked() or self.isSavingNDataFiles:
             self.saveCurrentData(text_box_string)
 
+    def integrationRanges(self):
+        # measurement, reference, and before/after them (dark count), as (x_start, x_end) pairs
+        r = self.selectedXRanges
+        return [(r[0], r[1]), (r[2], r[3]), (-np.inf, r[0]), (r[3], np.inf)]
+
     def calculateDepump(self, data, x_axis, channel = 1):
         i = channel - 1
         if i not in (0,1): self.print_to_dialogue('Error in calculateOD, check channel.', color='red')
-        d = np.array(data[i])
         s = self.sensitivity[i]
         # h is planck's constant; see import at the top; in [J] * [sec]
         f = 384.230e12 - 2.563e9 + 266.650e6 # frequency of depump transition
         #dT = (self.selectedXRanges[1] - self.selectedXRanges[0]) / len(d[np.where(np.logical_and(x_axis > self.selectedXRanges[0], x_axis < self.selectedXRanges[1]))])
         dT = x_axis[1] - x_axis[0]
-        d = d * dT * 1e-3 # Time is in ms
-        integral1 = np.sum(d[np.where(np.logical_and(x_axis > self.selectedXRanges[0], x_axis < self.selectedXRanges[1]))])
-        integral2 = np.sum(d[np.where(np.logical_and(x_axis > self.selectedXRanges[2], x_axis < self.selectedXRanges[3]))])
+        self.rangeIntegrator.setRanges(x_axis, self.integrationRanges())
+        sums = self.rangeIntegrator.sums(data)[i] * dT * 1e-3 # Time is in ms
+        integral1, integral2 = sums[0], sums[1]
         N = (integral2 - integral1) / (2 * s * h * f)
         return N
 
     def calculateOD(self, data, x_axis, channel = 1):
         i = channel - 1
         if i not in (0,1): self.print_to_dialogue('Error in calculateOD, check channel.', color='red')
-        d = np.array(data[i])
         # h is planck's constant; see import at the top
         f = 384.230e12 - 2.563e9  # frequency of OD transition
         # darkCount = np.mean(d[np.where(np.logical_and(x_axis > (self.selectedXRanges[3] + self.selectedXRanges[2] - self.selectedXRanges[1]), x_axis < (self.selectedXRanges[3] + self.selectedXRanges[2] - self.selectedXRanges[0])))])
-        ODMsmnt = np.mean(d[np.where(np.logical_and(x_axis > self.selectedXRanges[0], x_axis < self.selectedXRanges[1]))])
-        refMsmnt = np.mean(d[np.where(np.logical_and(x_axis > self.selectedXRanges[2], x_axis < self.selectedXRanges[3]))])
+        self.rangeIntegrator.setRanges(x_axis, self.integrationRanges())
+        sums, counts = self.rangeIntegrator.sums(data)[i], self.rangeIntegrator.counts
+        ODMsmnt = sums[0] / counts[0]
+        refMsmnt = sums[1] / counts[1]
         # darkCount = np.mean(d[np.where(np.logical_and(x_axis > self.selectedXRanges[4], x_axis < self.selectedXRanges[5]))])
-        darkCount = np.mean(d[np.where(np.logical_or(x_axis < self.selectedXRanges[0], x_axis > self.selectedXRanges[3]))])
+        darkCount = (sums[2] + sums[3]) / (counts[2] + counts[3]) # everything before and after the two ranges
         N = np.log(np.abs(refMsmnt - darkCount) / np.abs(ODMsmnt - darkCount))
         return N
 
@@ -1,7 +1,6 @@
 
 from PyQt5 import uic
-from scipy import optimize, spatial
-from scipy.signal import find_peaks
+from scipy import optimize
 # import vxi11 # https://github.com/python-ivi/python-vxi11
 import os
 import sys
@@ -11,7 +10,9 @@ import matplotlib
 from PID import PID
 from PyQt5.QtCore import QThreadPool
 from functions.HMP4040Control import HMP4040Visa
+from functions.lorentizansFit import MultiLorentzianFitter, multiLorentzianParamsToText
 import time
+import threading
 
 _CONNECTION_ATTMPTS = 2
 _HALOGEN_VOLTAGE_LIMIT = 12 # [VOLTS], 3.3 for red laser
@@ -27,27 +28,31 @@ if matplotlib.get_backend() != 'Qt5Agg':
     matplotlib.use('Qt5Agg')
 
 from widgets.scopeWidget.scope import Scope_GUI
+from widgets.scopeWidget.cavity_lock.lock_engine import LockEngine
+from widgets.scopeWidget.cavity_lock.lock_telemetry import LockTelemetry, EXTENSION as TELEMETRY_EXTENSION
 
 
 class Cavity_lock_GUI(Scope_GUI):
-    def __init__(self, Parent=None, ui=None,debugging = False, simulation=True):
+    def __init__(self, Parent=None, ui=None,debugging = False, simulation=True, plotBackend = 'matplotlib', replay = None, replayMode = 'original', lockRate = 2.0):
         if Parent is not None:
             self.Parent = Parent
 
         self.listenForMouseClickCID = None
         self.pid = None
         self.lockOn = False
+        self.lockEngine = None  # runs the PID and drives the HMP4040 on its own thread while locked; see toggleLock
+        self.lockRate = lockRate  # [Hz] PID updates per second
         self.outputOffset = (_LASER_CURRENT_MAX + _LASER_CURRENT_MIN) / 2  # [mAmps]; default. should be value of laser output when lock is started.
         self.changedOutputs = False # this keeps track of changes done to outputs. if this is true, no total-redraw will happen (although usually we would update scope after any change in RP)
 
-        self.err_cnt = 0
-
         # ---------- Rb Peaks ----------
         self.selectedPeaksXY = None
         self.indx_to_freq = [0]
+        self.lorentzianFitter = MultiLorentzianFitter()  # fits the Rb lines every frame, starting from the last frame's fit
 
         # ----------- HMP4040 Control -----------
         self.HMP4040 = HMP4040Visa(port = 'ASRL6::INSTR')
+        self.HMP4040Lock = threading.Lock()  # the GUI and the lock engine both talk to the HMP4040
         self.HMP4040.setOutput(4)
         self.HMP4040.outputState(2)
 
@@ -67,7 +72,7 @@ class Cavity_lock_GUI(Scope_GUI):
             self.threadpool = QThreadPool()
             print("Multithreading with maximum %d threads" % self.threadpool.maxThreadCount())
 
-        super().__init__(Parent=Parent, ui=ui, debugging=debugging, simulation=simulation)
+        super().__init__(Parent=Parent, ui=ui, debugging=debugging, simulation=simulation, plotBackend=plotBackend, replay=replay, replayMode=replayMode)
         # up to here, nothing to change.
 
         # Add outputs control UI
@@ -80,16 +85,11 @@ class Cavity_lock_GUI(Scope_GUI):
         self.outputsFrame.doubleSpinBox_outVHalogen.setValue(_LASER_TYPICAL_VOLTAGE)
 
         # save error signal
-        self.save_error_signal()
-
-    def save_error_signal(self):
-        self.all_error_signals =[]
+        # Every PID update (time, error, output, P/I/D) is kept in a bounded ring buffer, and appended to one file per
+        # lock session by a background thread; the newest error also goes to locking_err.npy, for the sprint experiments
         all_error_sig_root = r'Z:\Lab_2021-2022\Experiment_results\Sprint\Locking_PID_Error'
-        dt_string = time.strftime('%d-%m-%y')
-        self.all_err_dated = os.path.join(all_error_sig_root, dt_string)
-        if not os.path.exists(self.all_err_dated):
-            os.makedirs(self.all_err_dated)
-        self.time_string = time.strftime("%H-%M-%S")
+        self.all_err_dated = os.path.join(all_error_sig_root, time.strftime('%d-%m-%y'))
+        self.lockTelemetry = LockTelemetry(latest_path=os.path.join(all_error_sig_root, 'locking_err.npy'))
 
 
     def connectOutputsButtonsAndSpinboxes(self):
@@ -120,12 +120,18 @@ class Cavity_lock_GUI(Scope_GUI):
 
 
     def updateHMP4040Current(self):
-        self.HMP4040.setCurrent(self.outputsFrame.doubleSpinBox_outIHalogen.value())
-        self.outputsFrame.doubleSpinBox_outVHalogen.setValue(float(self.HMP4040.getVoltage()))
+        with self.HMP4040Lock:
+            self.HMP4040.setCurrent(self.outputsFrame.doubleSpinBox_outIHalogen.value())
+            v = float(self.HMP4040.getVoltage())
+        self.outputsFrame.doubleSpinBox_outVHalogen.setValue(v)
     def updateHMP4040Voltage(self):
-        self.HMP4040.setVoltage(self.outputsFrame.doubleSpinBox_outVHalogen.value())
-        self.outputsFrame.doubleSpinBox_outIHalogen.setValue(float(self.HMP4040.getCurrent()))
-    def updateHMP4040State(self): self.HMP4040.outputState(self.outputsFrame.checkBox_halogenOuputState.checkState())
+        with self.HMP4040Lock:
+            self.HMP4040.setVoltage(self.outputsFrame.doubleSpinBox_outVHalogen.value())
+            i = float(self.HMP4040.getCurrent())
+        self.outputsFrame.doubleSpinBox_outIHalogen.setValue(i)
+    def updateHMP4040State(self):
+        with self.HMP4040Lock:
+            self.HMP4040.outputState(self.outputsFrame.checkBox_halogenOuputState.checkState())
 
 
 
@@ -139,23 +145,58 @@ class Cavity_lock_GUI(Scope_GUI):
         else:
             self.velocityWavelength = v
 
+    def pidTunings(self):
+        # P, I, D spinboxes are in units of 1e-3
+        return float(self.outputsFrame.doubleSpinBox_P.value())/1000, float(self.outputsFrame.doubleSpinBox_I.value())/1000, float(self.outputsFrame.doubleSpinBox_D.value())/1000
+
     def updatePID(self):
-        P, I, D = float(self.outputsFrame.doubleSpinBox_P.value()), float(self.outputsFrame.doubleSpinBox_I.value()), float(self.outputsFrame.doubleSpinBox_D.value())
-        if self.pid: self.pid.tunings = (P, I, D)
+        # The PID runs on the lock engine's thread; the engine applies the new gains between PID steps
+        if self.lockEngine is not None:
+            self.lockEngine.setTunings(*self.pidTunings())
 
     def toggleLock(self):
         self.lockOn = not self.lockOn
         self.outputsFrame.checkBox_ch1OuputState.setCheckState(self.lockOn)
         self.outputOffset = self.outputsFrame.doubleSpinBox_outIHalogen.value()
         # Set PID limits and values
-        P, I, D = float(self.outputsFrame.doubleSpinBox_P.value())/1000, float(self.outputsFrame.doubleSpinBox_I.value())/1000, float(self.outputsFrame.doubleSpinBox_D.value()/1000)
+        P, I, D = self.pidTunings()
+        # The lock engine calls the PID at self.lockRate, so the PID itself does not need a sample_time
         self.pid = PID(P, I, D, setpoint=0, output_limits=(_LASER_CURRENT_MIN - self.outputOffset, _LASER_CURRENT_MAX - self.outputOffset),
-                       sample_time=0.5) if self.lockOn else None # sample_time [seconds], time at which PID is updated
+                       sample_time=None) if self.lockOn else None
+        if self.lockEngine is not None:
+            self.lockEngine.stop()
+            self.print_to_dialogue(self.lockEngine.statsText())
+            self.lockEngine = None
+        if self.lockOn:
+            # save all the error signal such that it can be plotted as function of time (see LockTelemetry.lastMinutes)
+            time_string = time.strftime("%H-%M-%S")
+            self.lockTelemetry.open(os.path.join(self.all_err_dated, 'all_locking_err' + time_string + TELEMETRY_EXTENSION))
+            self.lockEngine = LockEngine(self.pid, self.HMP4040.setCurrent, self.outputOffset, (_LASER_CURRENT_MIN, _LASER_CURRENT_MAX),
+                                         rate=self.lockRate, instrumentLock=self.HMP4040Lock, telemetry=self.lockTelemetry, parent=self)
+            self.lockEngine.stateChanged.connect(self.showLockState)
+            self.updateLockParameters()
+            self.lockEngine.start()
+        else:
+            self.lockTelemetry.close()
+
+    def setLockRate(self, rate):
+        # [Hz] PID updates per second; takes effect right away if locked
+        self.lockRate = float(rate)
+        if self.lockEngine is not None:
+            self.lockEngine.setRate(rate)
 
-        # save all the error signal such that it can be plotted as function of time
-        time_string = time.strftime("%H-%M-%S")
-        all_error_signals_root = os.path.join(self.all_err_dated, 'all_locking_err' + time_string + '.npy')
-        np.save(all_error_signals_root, self.all_error_signals)
+    def updateLockParameters(self):
+        errorDirection = 1 if self.outputsFrame.checkBox_lockInverse.isChecked() else - 1
+        self.lockEngine.setLockParameters(offset=float(self.outputsFrame.doubleSpinBox_lockOffset.value()), direction=errorDirection)
+
+    def printLockStats(self):
+        if self.lockEngine is not None:
+            self.print_to_dialogue(self.lockEngine.statsText())
+        self.print_to_dialogue(self.lockTelemetry.statsText())
+
+    def lockHistory(self, minutes=10):
+        # PID updates of the last @minutes, as a LockTelemetry record array (fields time, error, output, p, i, d)
+        return self.lockTelemetry.lastMinutes(minutes)
 
     def updateOutputChannels(self):
         # TODO: add hold-update to rp
@@ -205,11 +246,18 @@ class Cavity_lock_GUI(Scope_GUI):
         # Find the closest peak to the selected one in the relevant channel; update.
         for i, curSelectedPeak in enumerate(self.selectedPeaksXY):
             if len(peaksLocation[i]) > 0:
-                nearestPeakIndex = spatial.KDTree(peaksLocation[i]).query(curSelectedPeak)[1]  # [0] would have given us distance
+                nearestPeakIndex = np.argmin(np.sum((peaksLocation[i] - curSelectedPeak) ** 2, axis=1))
                 nearestPeakLocation = peaksLocation[i][nearestPeakIndex]
                 self.selectedPeaksXY[i] = np.array(nearestPeakLocation)  # update location of selected peak to BE the nearest peak
 
-    # Never call this method. this is called by RedPitaya
+    def peaksLocation(self, x_axis, properties):
+        # (n_peaks, 2) array of [x, y] of the peaks found by findPeaks; x interpolated between the samples
+        if 'refined_positions' not in properties:
+            return np.zeros((0, 2))
+        x = np.interp(properties['refined_positions'], np.arange(len(x_axis)), x_axis)
+        return np.column_stack([x, properties['refined_heights']])
+
+    # Never call this method. this is called (on the GUI thread) by self.frameQueue, with frames from RedPitaya
     def update_scope(self, data, parameters):
         if self.rp.firstRun:
             # Set default from display...
@@ -227,36 +275,25 @@ class Cavity_lock_GUI(Scope_GUI):
         if redraw:
             self.scope_parameters = parameters  # keep all the parameters. we need them.
             self.CHsUpdated = False
-        # self.Rb_lines_Data[self.Avg_indx % self.Avg_num[0]] = np.flipud(np.array(data[0]))  # Insert new data
-        # self.Cavity_Transmission_Data[self.Avg_indx % self.Avg_num[1]] =np.flipud(np.array(data[1]))    # Insert new data
-        self.Rb_lines_Data[self.Avg_indx % self.Avg_num[0]] = data[0]  # Insert new data
-        self.Cavity_Transmission_Data[self.Avg_indx % self.Avg_num[1]] =data[1]   # Insert new data
-        self.Avg_indx = self.Avg_indx + 1
         self.changedOutputs = False
 
         # ---------------- Average data  ----------------
-        # Calculate avarage data and find peaks position (indx) and properties:
+        # Insert new data and get the updated averages; find peaks position (indx) and properties:
+        # TODO: Tal put a sqrt on the avg here - why?
+        self.Rb_lines_Avg_Data = self.Rb_lines_Data.add(data[0])
+        self.Cavity_Transmission_Avg_Data = self.Cavity_Transmission_Data.add(data[1])
         Avg_data = []
         if self.checkBox_Rb_lines.isChecked():
-            # TODO: Tal put a sqrt on the avg here - why?
-            self.Rb_lines_Avg_Data = np.average(self.Rb_lines_Data, axis=0)
             Avg_data = Avg_data + [self.Rb_lines_Avg_Data]
         if self.checkBox_Cavity_transm.isChecked():
-            self.Cavity_Transmission_Avg_Data = np.average(self.Cavity_Transmission_Data, axis=0)
             Avg_data = Avg_data + [self.Cavity_Transmission_Avg_Data]
 
         # ---------------- Handle Rb Peaks ----------------
         self.Rb_peaks, Cavity_peak, Rb_properties, Cavity_properties = [], [], {}, {} # by default, none
         if self.checkBox_Rb_lines.isChecked():
-            self.Rb_peaks, Rb_properties = find_peaks(self.Rb_lines_Avg_Data,
-                                                 distance=float(self.spinBox_distance_ch1.value()),
-                                                 prominence=float(self.doubleSpinBox_prominence_ch1.value()),
-                                                 width=float(self.spinBox_width_ch1.value()))
+            self.Rb_peaks, Rb_properties = self.findPeaks(self.Rb_peakTracker, self.Rb_lines_Avg_Data, ch=1)
         if self.checkBox_Cavity_transm.isChecked():
-            Cavity_peak, Cavity_properties = find_peaks(self.Cavity_Transmission_Avg_Data,
-                                                        distance=float(self.spinBox_distance_ch2.value()),
-                                                        prominence=float(self.doubleSpinBox_prominence_ch2.value()),
-                                                        width=float(self.spinBox_width_ch2.value()))
+            Cavity_peak, Cavity_properties = self.findPeaks(self.Cavity_peakTracker, self.Cavity_Transmission_Avg_Data, ch=2)
 
         # converting time to MHz/detuning
         numberOfDetectedPeaks = 2  # should detect exactly 3 peaks. otherwise, vortex probably moved
@@ -302,62 +339,59 @@ class Cavity_lock_GUI(Scope_GUI):
         # --------- select peak -----------
         # At this point we have the location of the selected peak, either by (1) recent mouse click or (2) the last known location of the peak
         if self.selectedPeaksXY is not None and type(self.selectedPeaksXY) == list:# and len(self.selectedPeaksXY) == 2 and type(self.selectedPeaksXY[0]) == np.ndarray and type(self.selectedPeaksXY[1]) == np.ndarray:
-            chn1_peaksLocation = np.array([[x_axis[p], Avg_data[0][p]] for p in self.Rb_peaks])  # all the peaks as coordinates
-            chn2_peaksLocation = np.array([[x_axis[p], Avg_data[1][p]] for p in Cavity_peak])  # all the peaks as coordinates
+            # all the peaks as coordinates, at their sub-sample positions (the lock error then moves smoothly)
+            chn1_peaksLocation = self.peaksLocation(x_axis, Rb_properties)
+            chn2_peaksLocation = self.peaksLocation(x_axis, Cavity_properties)
             self.updateSelectedPeak([chn1_peaksLocation, chn2_peaksLocation])
 
         # ----------- text box -----------
         # to be printed in lower right corner
-        text_box_string = None
+        text_box_string = self.updateCavityEstimate(x_axis)
 
         if self.outputsFrame.checkBox_fitLorentzian.isChecked():
-            popt = self.fitMultipleLorentzians(xData=x_axis, yData=Avg_data[0], peaks_indices=self.Rb_peaks,
-                                        peaks_init_width=(Rb_properties['widths'] * indx_to_time))  # just an attempt. this runs very slowly.
-            params_text = self.multipleLorentziansParamsToText(popt)
-            text_box_string = 'Calibration: \n' + str(self.indx_to_freq) +'\n'
-            text_box_string += 'Found %d Lorentzians: \n'%len(self.Rb_peaks) + params_text
+            popt = self.lorentzianFitter.fit(xData=x_axis, yData=Avg_data[0], peaks_indices=self.Rb_peaks,
+                                             peaks_init_width=(np.asarray(Rb_properties.get('widths', [])) * indx_to_time))
+            text_box_string = (text_box_string + '\n' if text_box_string else '') + 'Calibration: \n' + str(self.indx_to_freq) +'\n'
+            if popt is not None:
+                text_box_string += 'Found %d Lorentzians: \n'%len(self.Rb_peaks) + multiLorentzianParamsToText(popt)
+            else:
+                text_box_string += 'Lorentzian fit failed'
 
         # --------- plot ---------
         # Prepare data for display:
         labels = ["CH1 - Vortex Rb lines", "CH2 - Cavity transmission"]
-        self.widgetPlot.plot_Scope(x_axis, Avg_data, autoscale=self.checkBox_plotAutoscale.isChecked(), redraw=redraw, labels = labels, x_ticks = x_ticks, y_ticks= y_ticks,
-                                   aux_plotting_func = self.widgetPlot.plot_Scatter, scatter_y_data = np.concatenate([Avg_data[0][self.Rb_peaks], Avg_data[1][Cavity_peak]]),
-                                   scatter_x_data = np.concatenate([x_axis[self.Rb_peaks], x_axis[Cavity_peak]]),mark_peak = self.selectedPeaksXY, text_box = text_box_string)
+        self.renderScheduler.submit(x_axis, Avg_data, autoscale=self.checkBox_plotAutoscale.isChecked(), redraw=redraw, labels = labels, x_ticks = x_ticks, y_ticks= y_ticks,
+                                    aux_plotting_func = self.widgetPlot.plot_Scatter, scatter_y_data = np.concatenate([Avg_data[0][self.Rb_peaks], Avg_data[1][Cavity_peak]]),
+                                    scatter_x_data = np.concatenate([x_axis[self.Rb_peaks], x_axis[Cavity_peak]]),mark_peak = self.selectedPeaksXY, text_box = text_box_string)
 
         # --------- Lock -----------
-        if self.lockOn and self.selectedPeaksXY and len(self.selectedPeaksXY) == 2: # if, and only if, we have selected two peaks to lock on
-           self.lockPeakToPeak()
+        # The PID runs on the lock engine's thread, at its own rate; here it only gets the newest peaks
+        if self.lockEngine is not None and self.selectedPeaksXY and len(self.selectedPeaksXY) == 2: # if, and only if, we have selected two peaks to lock on
+            self.updateLockParameters()
+            self.lockEngine.setPeaks(self.selectedPeaksXY[0][0], self.selectedPeaksXY[1][0])
 
         # -------- Save Data  --------:
         if self.checkBox_saveData.isChecked():
             self.saveCurrentDataClicked()
 
-    def lockPeakToPeak(self):
-        errorDirection = 1 if self.outputsFrame.checkBox_lockInverse.isChecked() else - 1
-        errorSignal = 1e-1 * (self.selectedPeaksXY[1][0] - self.selectedPeaksXY[0][0] + float(self.outputsFrame.doubleSpinBox_lockOffset.value())) * (errorDirection) # error in [ms] on rp
-
-        # save error signal for thrshold in sprint experiments
-        error_sig_root ='Z:\Lab_2021-2022\Experiment_results\Sprint\Locking_PID_Error\locking_err.npy'
-        self.err_cnt=self.err_cnt+1
-        if self.err_cnt>50:
-            np.save(error_sig_root, errorSignal)
-            self.err_cnt=0
-            print('saved error')
-        self.all_error_signals += [errorSignal]
-
-
-        # Error signal times 1e-3 makes sense -> mili-amps. also good for de-facto units
-        output = self.pid(errorSignal)
-        output = float(self.outputOffset + output)
-        if self.debugging: print('Error Signal: ', errorSignal, 'Output: ', output)
-        # ------- set output --------------
-        # It's a problem with Red-Pitaya: to get 10V DC output, one has to set both Amp and Offset to 5V
-        # Lock using green laser
-        #if output > _HALOGEN_VOLTAGE_LIMIT: output = _HALOGEN_VOLTAGE_LIMIT
-        if output > _LASER_CURRENT_MAX: output = _LASER_CURRENT_MAX
-        if output < _LASER_CURRENT_MIN: output = _LASER_CURRENT_MIN
-        if output != self.outputsFrame.doubleSpinBox_outIHalogen.value(): # if output is different, only then send update command
-            self.outputsFrame.doubleSpinBox_outIHalogen.setValue(output)
+    def showLockState(self, state):
+        # Runs on the GUI thread, for every PID update of the lock engine (see LockEngine.stateChanged)
+        errorSignal = state['error_signal']
+        if 'failed' in state:
+            self.print_to_dialogue('Could not set HMP4040 current: %s' % state['failed'], color='red')
+        # (the error signal is saved by self.lockTelemetry, off the GUI thread)
+        if self.debugging: print('Error Signal: ', errorSignal, 'Output: ', state['output'])
+        # The engine already set the current; only show it (without the spinbox setting it again)
+        spinBox = self.outputsFrame.doubleSpinBox_outIHalogen
+        spinBox.blockSignals(True)
+        spinBox.setValue(state['output'])
+        spinBox.blockSignals(False)
+
+    def closeEvent(self, event):
+        if self.lockEngine is not None:
+            self.lockEngine.stop()
+        self.lockTelemetry.stop()
+        super().closeEvent(event)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+Cavity lock loop, off the GUI thread.
+
+update_scope only hands the newest peak positions to LockEngine.setPeaks(); the engine's own thread wakes up at a
+fixed rate, turns the peaks into an error signal, runs the PID and sets the laser current on the HMP4040 directly.
+The GUI learns about it through the stateChanged signal (queued to the GUI thread), so neither the PID rate nor the
+VISA round trip depend on the plot frame rate, and the GUI never waits for the instrument.
+"""
+
+import time
+import threading
+from collections import deque
+import numpy as np
+from PyQt5.QtCore import QObject, pyqtSignal
+
+
+class LockEngine(QObject):
+    """
+    On every tick (rate times a second):
+    - if new peaks arrived since the last tick, error = direction * 0.1 * (x2 - x1 + offset) goes through the PID, and
+      the current (outputOffset + PID output, clamped to limits) is sent to the actuator if it changed;
+    - otherwise the output is held (the PID is not fed the same measurement twice).
+    Reports loop jitter (tick time - scheduled time) and actuator latency (duration of the set-current call, and time
+    from setPeaks() to the new current being set).
+    """
+    stateChanged = pyqtSignal(dict)  # emitted from the engine thread after every tick that ran the PID
+
+    def __init__(self, pid, setCurrent, outputOffset, limits, rate=2.0, offset=0.0, direction=-1, instrumentLock=None,
+                 telemetry=None, parent=None):
+        """
+        @pid: PID object (its output is added to @outputOffset)
+        @setCurrent: called with the new current [A], on the engine thread (e.g. HMP4040Visa.setCurrent)
+        @limits: (min, max) current [A]
+        @rate: [Hz] ticks per second
+        @offset, @direction: lock offset and sign of the error signal (see setLockParameters)
+        @instrumentLock: lock shared with whoever else talks to the instrument (e.g. the GUI's spinboxes)
+        @telemetry: LockTelemetry; every PID update is recorded there
+        """
+        super(LockEngine, self).__init__(parent)
+        self.pid = pid
+        self.setCurrent = setCurrent
+        self.outputOffset = outputOffset
+        self.limits = limits
+        self.offset, self.direction = offset, direction
+        self.instrumentLock = instrumentLock if instrumentLock is not None else threading.Lock()
+        self.telemetry = telemetry
+        self.peaksLock = threading.Lock()
+        self.peaks = None  # (x1, x2, time.perf_counter() when they were set), newest
+        self.newPeaks = False
+        self.pendingTunings = None  # (P, I, D) from setTunings, applied by the engine thread before its next PID step
+        self.lastOutput = None  # last current sent, rounded the way the instrument gets it
+        self.stopEvent = threading.Event()
+        self.ticks, self.outputsSent, self.heldTicks, self.errors = 0, 0, 0, 0
+        self.lateness = deque(maxlen=1000)  # [s] tick time - scheduled time
+        self.writeTimes = deque(maxlen=1000)  # [s] duration of setCurrent
+        self.peaksToOutput = deque(maxlen=1000)  # [s] setPeaks() -> current set
+        self.setRate(rate)
+        self.thread = None
+
+    # ---- GUI side ----
+    def setRate(self, rate):
+        self.rate = float(rate)
+        self.period = 1.0 / self.rate
+
+    def setLockParameters(self, offset=None, direction=None):
+        # @offset: [ms] added to x2 - x1; @direction: +1/-1
+        if offset is not None: self.offset = float(offset)
+        if direction is not None: self.direction = direction
+
+    def setTunings(self, P, I, D):
+        """New PID gains; the PID is only ever touched on the engine thread, so they are applied on its next tick."""
+        with self.peaksLock:
+            self.pendingTunings = (P, I, D)
+
+    def setPeaks(self, x1, x2, timestamp=None):
+        """Newest positions of the two selected peaks; called (by update_scope) once per analysed frame."""
+        with self.peaksLock:
+            self.peaks = (x1, x2, time.perf_counter() if timestamp is None else timestamp)
+            self.newPeaks = True
+
+    def start(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.stopEvent.clear()
+            self.thread = threading.Thread(target=self.run, name='LockEngine', daemon=True)
+            self.thread.start()
+
+    def stop(self, timeout=2):
+        self.stopEvent.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    # ---- Engine thread ----
+    def run(self):
+        nextTick = time.perf_counter()
+        while not self.stopEvent.is_set():
+            now = time.perf_counter()
+            if nextTick > now and self.stopEvent.wait(nextTick - now):
+                return
+            now = time.perf_counter()
+            self.lateness.append(now - nextTick)
+            self.tick()
+            nextTick += self.period
+            if nextTick < time.perf_counter():  # fell behind (e.g. a slow VISA call): skip the missed ticks
+                nextTick = time.perf_counter() + self.period
+
+    def tick(self):
+        self.ticks += 1
+        with self.peaksLock:
+            peaks, newPeaks = self.peaks, self.newPeaks
+            self.newPeaks = False
+            tunings, self.pendingTunings = self.pendingTunings, None
+        if tunings is not None:
+            self.pid.tunings = tunings
+        if not newPeaks:
+            self.heldTicks += 1
+            return
+        x1, x2, peaksTime = peaks
+        errorSignal = 1e-1 * (x2 - x1 + self.offset) * self.direction  # error in [ms] on rp
+        output = float(np.clip(self.outputOffset + self.pid(errorSignal), *self.limits))
+        if self.telemetry is not None:
+            self.telemetry.append(time.time(), errorSignal, output, *self.pid.components)
+        sent = round(output, 3)  # HMP4040 gets mA resolution; do not resend the same value
+        if sent != self.lastOutput:
+            start = time.perf_counter()
+            try:
+                with self.instrumentLock:
+                    self.setCurrent(output)
+            except Exception as e:
+                self.errors += 1
+                self.stateChanged.emit({'error_signal': errorSignal, 'output': output, 'failed': str(e)})
+                return
+            end = time.perf_counter()
+            self.writeTimes.append(end - start)
+            self.peaksToOutput.append(end - peaksTime)
+            self.lastOutput = sent
+            self.outputsSent += 1
+        self.stateChanged.emit({'error_signal': errorSignal, 'output': output, 'time': time.time()})
+
+    # ---- Stats ----
+    def stats(self):
+        def ms(values, f):
+            return 1e3 * f(values) if len(values) else 0
+        lateness, writeTimes, peaksToOutput = list(self.lateness), list(self.writeTimes), list(self.peaksToOutput)
+        return {'rate': self.rate, 'ticks': self.ticks, 'outputs_sent': self.outputsSent, 'held': self.heldTicks,
+                'errors': self.errors, 'jitter_mean_ms': ms(lateness, np.mean), 'jitter_max_ms': ms(lateness, np.max),
+                'write_mean_ms': ms(writeTimes, np.mean), 'write_max_ms': ms(writeTimes, np.max),
+                'peaks_to_output_mean_ms': ms(peaksToOutput, np.mean)}
+
+    def statsText(self):
+        return ('lock: %(ticks)d ticks at %(rate).1f Hz (%(held)d held, %(outputs_sent)d outputs sent, %(errors)d failed); '
+                'jitter %(jitter_mean_ms).2f ms mean / %(jitter_max_ms).2f ms max; set-current %(write_mean_ms).1f ms mean / '
+                '%(write_max_ms).1f ms max; peaks to output %(peaks_to_output_mean_ms).1f ms' % self.stats())
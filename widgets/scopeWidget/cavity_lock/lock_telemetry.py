@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Cavity lock telemetry, in constant memory.
+
+Every PID update of the lock engine is one record (time, error, output, P, I, D terms). Records go into a preallocated
+ring buffer (the live view), and a background thread appends the new ones to a file every flush_interval seconds, so
+the lock loop itself never touches the disk (or the network share).
+The file is just the records one after the other (RECORD_DTYPE, little endian, no header): readTelemetry() memory-maps it.
+"""
+
+import os
+import time
+import threading
+import numpy as np
+
+RECORD_DTYPE = np.dtype([('time', '<f8'), ('error', '<f8'), ('output', '<f8'), ('p', '<f8'), ('i', '<f8'), ('d', '<f8')])
+EXTENSION = '.lock'
+
+
+def readTelemetry(path):
+    """All the records of a telemetry file, memory-mapped (a partly written last record is left out)."""
+    n = os.path.getsize(path) // RECORD_DTYPE.itemsize
+    if n == 0:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    return np.memmap(path, dtype=RECORD_DTYPE, mode='r', shape=(n,))
+
+
+class LockTelemetry:
+    def __init__(self, capacity=100000, flush_interval=5, latest_path=None):
+        """
+        @capacity: records kept in memory (100000 records are 4.8 MB; at 2 Hz, about 14 hours)
+        @flush_interval: [s] how often new records are appended to the file
+        @latest_path: if given, the newest error is also np.save'd there on every flush (for scripts watching the lock)
+        """
+        self.capacity = int(capacity)
+        self.flush_interval = flush_interval
+        self.latest_path = latest_path
+        self.ring = np.zeros(self.capacity, dtype=RECORD_DTYPE)
+        self.count = 0  # records appended so far; the newest is at (count - 1) % capacity
+        self.lock = threading.Lock()  # ring buffer
+        self.fileLock = threading.Lock()  # file; held while writing, so append() is never held up by the drive
+        self.path = None
+        self.f = None
+        self.flushedCount = 0  # records written to the file (counted like self.count)
+        self.lost = 0  # records overwritten in the ring before they were written to the file
+        self.lastError = None
+        self.stopEvent = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='LockTelemetry', daemon=True)
+        self.thread.start()
+
+    # ---- Producer side (lock loop) ----
+    def append(self, t, error, output, p=0.0, i=0.0, d=0.0):
+        with self.lock:
+            self.ring[self.count % self.capacity] = (t, error, output, p, i, d)
+            self.count += 1
+
+    # ---- File ----
+    def open(self, path):
+        """Start appending records to @path (records from now on; the previous file is flushed and closed)."""
+        self.close()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self.fileLock, self.lock:
+            self.f = open(path, 'ab')
+            self.path = path
+            self.flushedCount = self.count
+
+    def close(self):
+        with self.fileLock:
+            self.writePending()
+            if self.f is not None:
+                self.f.close()
+            self.f = None
+
+    def flush(self):
+        with self.fileLock:
+            self.writePending()
+
+    def writePending(self):
+        # Append the records not written yet; call with self.fileLock held
+        with self.lock:
+            if self.f is None or self.flushedCount == self.count:
+                return
+            if self.count - self.flushedCount > self.capacity:
+                self.lost += self.count - self.flushedCount - self.capacity
+                self.flushedCount = self.count - self.capacity
+            records = self.ordered(self.flushedCount, self.count)
+            self.flushedCount = self.count
+        try:
+            self.f.write(records.tobytes())
+            self.f.flush()
+            if self.latest_path is not None:
+                np.save(self.latest_path, records['error'][-1])
+        except OSError as e:
+            self.lastError = str(e)
+
+    def run(self):
+        while not self.stopEvent.wait(self.flush_interval):
+            self.flush()
+
+    def stop(self):
+        self.stopEvent.set()
+        self.thread.join(self.flush_interval + 1)
+        self.close()
+
+    # ---- Queries ----
+    def ordered(self, start, stop):
+        # Records number start..stop-1 (as counted by self.count), oldest first; they must still be in the ring
+        index = np.arange(start, stop) % self.capacity
+        return self.ring[index]
+
+    def latest(self, n=None):
+        """The newest @n records in memory (all of them by default), oldest first."""
+        with self.lock:
+            available = min(self.count, self.capacity)
+            n = available if n is None else min(int(n), available)
+            return self.ordered(self.count - n, self.count)
+
+    def lastMinutes(self, minutes):
+        """Records of the last @minutes, oldest first; from memory if they are all still there, otherwise from the file."""
+        since = time.time() - 60 * minutes
+        inMemory = self.latest()
+        if len(inMemory) == self.count or (len(inMemory) and inMemory['time'][0] <= since):
+            return inMemory[inMemory['time'] >= since]
+        self.flush()
+        if self.path is None:
+            return inMemory[inMemory['time'] >= since]
+        onDisk = readTelemetry(self.path)
+        start = int(np.searchsorted(onDisk['time'], since))
+        return np.array(onDisk[start:])
+
+    def stats(self):
+        return {'records': self.count, 'in_memory': min(self.count, self.capacity),
+                'unwritten': self.count - self.flushedCount if self.f is not None else 0, 'lost': self.lost,
+                'path': self.path, 'last_error': self.lastError}
+
+    def statsText(self):
+        return 'lock telemetry: %(records)d records (%(in_memory)d in memory, %(unwritten)d not written yet, %(lost)d lost)' % self.stats()
@@ -6,26 +6,85 @@ Created on Mon Dec 28 16:52:30 2020
 """
 
 from PyQt5 import QtWidgets
-from PyQt5.QtWidgets import QDialog, QVBoxLayout
+from PyQt5.QtWidgets import QDialog, QVBoxLayout, QLabel
+import time
 import matplotlib
 if matplotlib.get_backend() != 'Qt5Agg':
     matplotlib.use('Qt5Agg')
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import numpy as np
+try:
+    from widgets.scopeWidget.dataplot_pyqtgraph import PyqtgraphPlotWindow
+except ImportError:
+    PyqtgraphPlotWindow = None  # pyqtgraph is optional; createPlotWindow falls back to matplotlib
 
 _COLORS = ['b','g','r','c', 'm','y']
 def gaussian(x, amplitude, mean, stddev):
     return amplitude * np.exp(-((x - mean) ** 2 / 2 / stddev ** 2))
 
 
+def minMaxDecimate(x, y, n_buckets):
+    """
+    Reduce (@x, @y) to the min and max of each of @n_buckets equal buckets (2 * n_buckets points, in their original
+    order), so that peaks and glitches are still seen on screen. NaNs are ignored; all-NaN buckets stay NaN.
+    """
+    n = len(y)
+    if n <= 2 * n_buckets:
+        return x, y
+    size = int(np.ceil(n / n_buckets))
+    n_buckets = int(np.ceil(n / size))
+    pad = n_buckets * size - n
+    idx = np.arange(n_buckets * size).reshape(n_buckets, size)
+    idx[-1, size - pad:] = n - 1  # last bucket: repeat the last sample
+    buckets = y[idx]
+    if np.isnan(y).any():
+        imin = np.argmin(np.where(np.isnan(buckets), np.inf, buckets), axis=1)
+        imax = np.argmax(np.where(np.isnan(buckets), -np.inf, buckets), axis=1)
+    else:
+        imin, imax = np.argmin(buckets, axis=1), np.argmax(buckets, axis=1)
+    first, second = np.minimum(imin, imax), np.maximum(imin, imax)
+    rows = np.arange(n_buckets) * size
+    order = np.column_stack([first, second]) + rows[:, None]
+    order = np.minimum(order, n - 1).ravel()
+    return x[order], y[order]
+
+
+def createPlotWindow(backend='matplotlib', **kwargs):
+    """
+    @backend: 'matplotlib' (PlotWindow) or 'pyqtgraph' (PyqtgraphPlotWindow, faster scope traces). Both have the
+    plot_Scope/plot_Scatter/markPeaks/annotateWithArrow/addTextBox/plotVerticalLines methods used by the scope tabs.
+    """
+    if backend == 'pyqtgraph':
+        if PyqtgraphPlotWindow is not None:
+            return PyqtgraphPlotWindow(**kwargs)
+        print('pyqtgraph is not installed; using the matplotlib plot window')
+    elif backend != 'matplotlib':
+        raise ValueError('Unknown plot backend %s' % str(backend))
+    return PlotWindow(**kwargs)
+
+
 class PlotWindow(QDialog):
-    def __init__(self, parent=None):
+    """
+    blit - in plot_Scope, only the data (lines, scatters, arrows, text box) is redrawn on every frame, on top of a cached
+           background (axes, grid, ticks, legend). A full draw happens only on redraw, or when the axis limits change
+           (autoscale, zoom/pan, resize).
+    decimate - traces longer than 2 points per pixel are shown as the min and max of each pixel wide bucket of
+               samples (see minMaxDecimate); recomputed when the x range changes (e.g. zoom). Only the display is
+               decimated; whoever calls plot_Scope keeps the full data.
+    """
+    def __init__(self, parent=None, blit=True, decimate=True):
         super(PlotWindow, self).__init__(parent)
 
-        plt.ion()
-        self.figure = plt.figure(1)
+        self.blit = blit
+        # Display decimation: traces are reduced to min/max pairs, about 2 points per pixel of the visible x range
+        self.decimate = decimate
+        self.xData, self.yData = None, [None, None]  # full resolution data of self.lines
+        self.background = None  # cached canvas without the animated artists; see on_draw
+        # Each window has its own figure (not pyplot's current one), so tabs don't draw over each other
+        self.figure = Figure()
         self.axes = []
         self.axes.append(self.figure.add_subplot(111))
         self.arrows = [None] * 2 #len(kwargs['mark_peak'])  # Create placeholder for 2 arrows
@@ -40,16 +99,20 @@ class PlotWindow(QDialog):
             self.axes.append(self.axes[0].twinx())
         for i in range(2): # in principle, hold 2 places for lines. With good coding, this is not neccessary
             line1, = self.axes[i].plot([1], [1], 'r-')  # Returns a tuple of line objects, thus the comma
-            self.lines.append(line1)
+            self.lines.append(self.animate(line1))
 
         # this is the Canvas Widget that displays the `figure`
         # it takes the `figure` instance as a parameter to __init__
         self.canvas = FigureCanvas(self.figure)
+        self.canvas.mpl_connect('draw_event', self.on_draw)
 
 
         # this is the Navigation widget
         # it takes the Canvas widget and a parent
         self.toolbar = NavigationToolbar(self.canvas, self)
+        self.fpsLabel = QLabel('')
+        self.toolbar.addWidget(self.fpsLabel)
+        self.framesRendered, self.fpsTime = 0, time.perf_counter()
 
         # set the layout
         layout = QVBoxLayout()
@@ -60,10 +123,84 @@ class PlotWindow(QDialog):
         widget.setContentsMargins(0, 0, 0, 0)
         self.widgetPlot = widget
 
+    def addToolbarWidget(self, widget):
+        # Controls of the tab that owns the plot (e.g. the scope's max fps), next to the fps label
+        self.toolbar.addWidget(widget)
+
+    def setLineData(self, i, y=None):
+        """Show (@y or the stored y of) line @i, decimated to the visible x range."""
+        if y is not None:
+            self.yData[i] = np.asarray(y)
+        y, x = self.yData[i], self.xData
+        if y is None or x is None or len(x) != len(y):
+            self.lines[i].set_ydata(y)
+            return
+        if self.decimate:
+            xmin, xmax = sorted(self.axes[0].get_xlim())
+            start = max(0, np.searchsorted(x, xmin) - 1)
+            end = min(len(x), np.searchsorted(x, xmax) + 1)
+            x, y = minMaxDecimate(x[start:end], y[start:end], max(1, int(self.axes[0].bbox.width)))
+        self.lines[i].set_data(x, y)
+
+    def on_xlim_changed(self, ax):
+        for i in range(len(self.lines)):
+            self.setLineData(i)
+
+    def animate(self, artist):
+        # Artists that change on every frame are left out of the cached background, and blitted on top of it
+        if self.blit:
+            artist.set_animated(True)
+        return artist
+
+    def animatedArtists(self):
+        artists = list(self.lines) + [self.scatter, self.markedPeaks, self.textBox] + list(self.arrows) + list(self.annotations or [])
+        return [a for a in artists if a is not None and a.get_animated() and a.axes in self.figure.axes]
+
+    def on_draw(self, event):
+        # A full draw (redraw, new limits, zoom, resize...): cache it as the background, then add the animated artists
+        if not self.blit:
+            return
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        for artist in self.animatedArtists():
+            self.figure.draw_artist(artist)
+
+    def render(self):
+        """Show the current data: blit it over the cached background, or (no background yet) draw everything."""
+        if self.background is None:
+            self.canvas.draw()
+        else:
+            self.canvas.restore_region(self.background)
+            for artist in self.animatedArtists():
+                self.figure.draw_artist(artist)
+            self.canvas.blit(self.figure.bbox)
+        self.countFrame()
+
+    def countFrame(self):
+        self.framesRendered += 1
+        elapsed = time.perf_counter() - self.fpsTime
+        if elapsed >= 1:
+            self.fpsLabel.setText('%.1f fps' % (self.framesRendered / elapsed))
+            self.framesRendered, self.fpsTime = 0, time.perf_counter()
+
+    def autoscaleLimits(self, ax, y):
+        """
+        New y-limits for @y, or None if the current ones are still good: with blitting, limits (and so the background)
+        only change when the data leaves them or fills less than half of them.
+        """
+        miny, maxy = np.nanmin(y), np.nanmax(y)
+        headroom = np.abs(maxy - miny) * 0.05  # leaving some room atop and below data in graph
+        low, high = ax.get_ylim()
+        if self.blit and low <= miny and maxy <= high and (maxy - miny) > 0.5 * (high - low):
+            return None
+        return miny - headroom, maxy + headroom
+
     def plot_Scope(self, x_data,y_data, autoscale = False, redraw = False, **kwargs):
+        if not redraw and self.blit:
+            self.updateScope(y_data, autoscale, **kwargs)
+            return
         if not redraw:  # meaning - merely update data, without redrawing all.
             for i, line in enumerate(y_data):
-                self.lines[i].set_ydata(y_data[i])
+                self.setLineData(i, y_data[i])
                 if autoscale:
                     miny, maxy = min(y_data[i]), max(y_data[i])
                     headroom = np.abs(maxy - miny) * 0.05 # leaving some room atop and below data in graph
@@ -82,8 +219,39 @@ class PlotWindow(QDialog):
             if 'text_box' in kwargs and kwargs['text_box'] is not None:
                 if self.textBox is None: self.addTextBox(textstr=kwargs['text_box'])
                 self.textBox.set_text(str(kwargs['text_box']))
+            self.canvas.draw_idle()
+            self.countFrame()
             return
 
+        self.redrawScope(x_data, y_data, autoscale, redraw, **kwargs)
+
+    def updateScope(self, y_data, autoscale=False, **kwargs):
+        """Blitting version of the fast path of plot_Scope."""
+        limitsChanged = False
+        for i, line in enumerate(y_data):
+            self.setLineData(i, y_data[i])
+            limits = self.autoscaleLimits(self.axes[i], y_data[i]) if autoscale else None
+            if limits is not None:
+                self.axes[i].set_ylim(*limits)
+                limitsChanged = True
+        if 'aux_plotting_func' in kwargs:
+            kwargs['aux_plotting_func'](redraw=False, **kwargs)
+        if 'mark_peak' in kwargs and kwargs['mark_peak'] is not None:
+            self.markPeaks(kwargs['mark_peak'])
+            for i, pk in enumerate(kwargs['mark_peak']):
+                if self.arrows[i] is None:
+                    self.arrows[i] = self.annotateWithArrow(pk[0], pk[1])
+                self.arrows[i].xy = (pk[0], pk[1])
+        if 'text_box' in kwargs and kwargs['text_box'] is not None:
+            if self.textBox is None: self.addTextBox(textstr=kwargs['text_box'])
+            self.textBox.set_text(str(kwargs['text_box']))
+        if limitsChanged:
+            self.canvas.draw()  # new ticks; on_draw caches the new background
+            self.countFrame()
+        else:
+            self.render()
+
+    def redrawScope(self, x_data, y_data, autoscale=False, redraw=True, **kwargs):
         print('Redrawing all')
         self.arrows = [None] * 2 # reset arrow
         self.textBox = None # reset textbox
@@ -92,18 +260,23 @@ class PlotWindow(QDialog):
             kwargs['labels'] = [''] * 10 # to prevent glitches
 
         self.figure.clear()
+        self.background = None
         self.scatter = None
         self.markedPeaks = None
+        self.annotations = None
         for ax in self.axes:
             ax = None
         self.axes[0] = self.figure.add_subplot(111)
 
         for i in range(1,2):
             self.axes[i] = self.axes[0].twinx()
+        self.axes[0].callbacks.connect('xlim_changed', self.on_xlim_changed)
 
+        self.xData = np.asarray(x_data)
         for i, el in enumerate(np.array(y_data)):
             line1, = self.axes[i].plot(x_data, el, label=kwargs['labels'][i], color = _COLORS[i])  # Returns a tuple of line objects, thus the comma
-            self.lines[i] = line1
+            self.lines[i] = self.animate(line1)
+            self.yData[i] = el
 
         # ------ legend ----------------
         if 'legend' in kwargs and kwargs['legend'] or 'legend' not in kwargs: # by default, legend on
@@ -137,9 +310,10 @@ class PlotWindow(QDialog):
         self.axes[0].set_xlabel('Time [ms]')
         if 'aux_plotting_func' in kwargs:
             kwargs['aux_plotting_func'](redraw = redraw, **kwargs) # This is a general way of calling this function
-        plt.tight_layout()
+        self.figure.tight_layout()
 
         self.canvas.draw()
+        self.countFrame()
 
     def plot_Scatter(self,ax_index = 0, **kwargs):
         # first - check we have what we need
@@ -152,7 +326,7 @@ class PlotWindow(QDialog):
                 # draw scatter + define style
                 # for i in range(len(x_data)):
                 #     self.scatter[i] = self.axes[i].scatter(x_data[i], y_data[i], marker="x", color="b")
-                self.scatter = self.axes[ax_index].scatter(x_data, y_data, marker="x", color="b")
+                self.scatter = self.animate(self.axes[ax_index].scatter(x_data, y_data, marker="x", color="b"))
             else:  # merely update location
                 # for i in range(len(x_data)):
                 #     self.scatter[i].set_offsets(np.c_[x_data[i], y_data[i]])
@@ -166,7 +340,7 @@ class PlotWindow(QDialog):
                     self.annotations = []
                     for i, x in enumerate(x_data):
                         # annotate scatter + define style
-                        self.annotations.append(self.axes[ax_index].annotate(kwargs['scatter_tags'][i], xy = (x, y_data[i]), weight='bold' ))
+                        self.annotations.append(self.animate(self.axes[ax_index].annotate(kwargs['scatter_tags'][i], xy = (x, y_data[i]), weight='bold' )))
                 # If they exist - update location
                 else:
                     if self.annotations:
@@ -183,20 +357,20 @@ class PlotWindow(QDialog):
         # if scatter don't exist - scatter for the first time
         if not self.markedPeaks:
             # draw scatter + define style
-            self.markedPeaks = self.axes[ax_index].scatter(x_data, y_data, marker="o", color="r")
+            self.markedPeaks = self.animate(self.axes[ax_index].scatter(x_data, y_data, marker="o", color="r"))
         else:  # merely update location
             self.markedPeaks.set_offsets(np.c_[x_data, y_data])  # this seems to work.
 
     def annotateWithArrow(self, x,y, ax_index = 0):
-        return(self.axes[ax_index].annotate('', xy=(x, y),  xycoords='data',
+        return(self.animate(self.axes[ax_index].annotate('', xy=(x, y),  xycoords='data',
             xytext=(0.8, 0.95), textcoords='axes fraction',
             arrowprops=dict(facecolor='black', shrink=0.05),
-            horizontalalignment='right', verticalalignment='top'))
+            horizontalalignment='right', verticalalignment='top')))
 
     def addTextBox(self, textstr):
         props = dict(boxstyle='round', facecolor='grey', alpha=0.1)
-        self.textBox = self.axes[0].text(0.05, 0.95, textstr, transform=self.axes[0].transAxes, fontsize=32,
-        verticalalignment='top', bbox=props)
+        self.textBox = self.animate(self.axes[0].text(0.05, 0.95, textstr, transform=self.axes[0].transAxes, fontsize=32,
+        verticalalignment='top', bbox=props))
 
     def plotVerticalLines(self, **kwargs):
         if 'redraw' in kwargs and kwargs['redraw'] and 'verticalXs' in kwargs and type(kwargs['verticalXs']) is list:
@@ -211,10 +385,10 @@ class PlotWindow(QDialog):
         self.figure.clear()
 
         # create an axis
-        ax1 = plt.subplot2grid((2, 2), (1, 1), colspan=2, rowspan=2)
-        ax2 = plt.subplot2grid((2, 2), (0, 1), colspan=2, rowspan=1)
-        ax3 = plt.subplot2grid((2, 2), (1, 0), colspan=1, rowspan=2)
-        ax4 = plt.subplot2grid((2, 2), (0, 0), colspan=1, rowspan=1)
+        ax1 = plt.subplot2grid((2, 2), (1, 1), colspan=2, rowspan=2, fig=self.figure)
+        ax2 = plt.subplot2grid((2, 2), (0, 1), colspan=2, rowspan=1, fig=self.figure)
+        ax3 = plt.subplot2grid((2, 2), (1, 0), colspan=1, rowspan=2, fig=self.figure)
+        ax4 = plt.subplot2grid((2, 2), (0, 0), colspan=1, rowspan=1, fig=self.figure)
 
         # discards the old graph
         # ax.hold(False) # deprecated, see above
@@ -243,7 +417,7 @@ class PlotWindow(QDialog):
             ax4.plot(self.sigmax, '-o', label="$\sigma_x$")
             ax4.plot(self.sigmay, '-o', label="$\sigma_y$")
             ax4.legend(loc="upper right")
-        plt.tight_layout()
+        self.figure.tight_layout()
 
         # refresh canvas
         self.canvas.draw()
@@ -253,10 +427,10 @@ class PlotWindow(QDialog):
         self.figure.clear()
 
         # create an axis
-        ax1 = plt.subplot2grid((2, 2), (1, 1), colspan=2, rowspan=2)
-        ax2 = plt.subplot2grid((2, 2), (0, 1), colspan=2, rowspan=1)
-        ax3 = plt.subplot2grid((2, 2), (1, 0), colspan=1, rowspan=2)
-        ax4 = plt.subplot2grid((2, 2), (0, 0), colspan=1, rowspan=1)
+        ax1 = plt.subplot2grid((2, 2), (1, 1), colspan=2, rowspan=2, fig=self.figure)
+        ax2 = plt.subplot2grid((2, 2), (0, 1), colspan=2, rowspan=1, fig=self.figure)
+        ax3 = plt.subplot2grid((2, 2), (1, 0), colspan=1, rowspan=2, fig=self.figure)
+        ax4 = plt.subplot2grid((2, 2), (0, 0), colspan=1, rowspan=1, fig=self.figure)
 
         # discards the old graph
         # ax.hold(False) # deprecated, see above
@@ -285,7 +459,7 @@ class PlotWindow(QDialog):
             ax4.plot(self.sigmax, '-o', label="$\sigma_x$")
             ax4.plot(self.sigmay, '-o', label="$\sigma_y$")
             ax4.legend(loc="upper right")
-        plt.tight_layout()
+        self.figure.tight_layout()
 
         # refresh canvas
         self.canvas.draw()
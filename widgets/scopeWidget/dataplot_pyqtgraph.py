@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+PlotWindow with the same interface as dataplot.PlotWindow (plot_Scope, plot_Scatter, markPeaks, annotateWithArrow,
+addTextBox, plotVerticalLines), drawn with pyqtgraph instead of matplotlib. pyqtgraph paints with QPainter (no OpenGL
+needed) and only repaints what changed, so it keeps up with the scope frame rate much better.
+
+Select it with dataplot.createPlotWindow('pyqtgraph') (the tabs take plotBackend='pyqtgraph').
+The tabs also use widgetPlot.canvas.mpl_connect for mouse clicks/moves; PlotCanvas provides that for the pyqtgraph scene.
+"""
+
+import time
+import numpy as np
+import pyqtgraph as pg
+from PyQt5.QtCore import Qt
+from PyQt5.QtWidgets import QDialog, QVBoxLayout, QHBoxLayout, QLabel, QWidget
+
+_COLORS = ['b', 'g', 'r', 'c', 'm', 'y']
+_LINE_STYLES = {'-': Qt.SolidLine, '--': Qt.DashLine, ':': Qt.DotLine, '-.': Qt.DashDotLine}
+
+
+class Arrow:
+    """Stands for a matplotlib annotation arrow: plot_Scope moves it by setting .xy"""
+
+    def __init__(self, viewBox, x, y):
+        self.item = pg.ArrowItem(angle=-60, headLen=20, brush='k')
+        viewBox.addItem(self.item)
+        self.xy = (x, y)
+
+    @property
+    def xy(self):
+        return self._xy
+
+    @xy.setter
+    def xy(self, xy):
+        self._xy = xy
+        self.item.setPos(*xy)
+
+
+class TextBox:
+    """Stands for a matplotlib text box in the upper left corner of the plot (set_text)."""
+
+    def __init__(self, plotItem, textstr):
+        self.item = pg.TextItem(str(textstr), color='k', fill=pg.mkBrush(128, 128, 128, 25))
+        font = self.item.textItem.font()
+        font.setPointSize(24)
+        self.item.setFont(font)
+        self.item.setParentItem(plotItem.vb)  # in pixels of the plot area, so it stays put when the axes change
+        self.item.setPos(10, 10)
+
+    def set_text(self, textstr):
+        self.item.setText(str(textstr))
+
+
+class VerticalLine:
+    """Stands for matplotlib's axvline (set_xdata)."""
+
+    def __init__(self, viewBox, x, linestyle='-', alpha=1):
+        self.item = pg.InfiniteLine(pos=x, angle=90, pen=pg.mkPen('b', style=_LINE_STYLES.get(linestyle, Qt.SolidLine)))
+        self.item.setOpacity(alpha)
+        viewBox.addItem(self.item)
+
+    def set_xdata(self, x):
+        self.item.setValue(x[0] if np.iterable(x) else x)
+
+
+class Axes:
+    """What mouse events hand over as event.inaxes: enough of matplotlib's Axes for the scope tabs."""
+
+    def __init__(self, viewBox):
+        self.viewBox = viewBox
+
+    def axvline(self, x, linestyle='-', alpha=1, **kwargs):
+        return VerticalLine(self.viewBox, x, linestyle, alpha)
+
+
+class MouseEvent:
+    def __init__(self, xdata, ydata, inaxes, button=None):
+        self.xdata, self.ydata, self.inaxes, self.button = xdata, ydata, inaxes, button
+
+
+class PlotCanvas:
+    """mpl_connect/mpl_disconnect for 'button_press_event' and 'motion_notify_event', on the pyqtgraph scene."""
+
+    def __init__(self, plotWidget, plotItem):
+        self.plotWidget, self.plotItem = plotWidget, plotItem
+        self.axes = Axes(plotItem.vb)
+        self.callbacks = {}
+        self.nextId = 1
+        plotWidget.scene().sigMouseClicked.connect(self.onClick)
+        plotWidget.scene().sigMouseMoved.connect(self.onMove)
+
+    def mpl_connect(self, name, func):
+        cid, self.nextId = self.nextId, self.nextId + 1
+        self.callbacks[cid] = (name, func)
+        return cid
+
+    def mpl_disconnect(self, cid):
+        self.callbacks.pop(cid, None)
+
+    def event(self, scenePos, button=None):
+        inside = self.plotItem.vb.sceneBoundingRect().contains(scenePos)
+        point = self.plotItem.vb.mapSceneToView(scenePos)
+        return MouseEvent(point.x() if inside else None, point.y() if inside else None, self.axes if inside else None, button)
+
+    def dispatch(self, name, event):
+        for cid, (n, func) in list(self.callbacks.items()):
+            if n == name:
+                func(event)
+
+    def onClick(self, ev):
+        self.dispatch('button_press_event', self.event(ev.scenePos(), ev.button()))
+
+    def onMove(self, scenePos):
+        self.dispatch('motion_notify_event', self.event(scenePos))
+
+    def draw(self):
+        pass  # pyqtgraph repaints by itself
+
+    def draw_idle(self):
+        pass
+
+
+class PyqtgraphPlotWindow(QDialog):
+    def __init__(self, parent=None):
+        super(PyqtgraphPlotWindow, self).__init__(parent)
+        pg.setConfigOptions(antialias=False, background='w', foreground='k')
+        self.plotWidget = pg.PlotWidget()  # each window has its own scene
+        self.plotItem = self.plotWidget.getPlotItem()
+        # Second y axis (right) for CH2, sharing the x axis, like matplotlib's twinx
+        self.viewBoxes = [self.plotItem.vb, pg.ViewBox()]
+        self.plotItem.showAxis('right')
+        self.plotItem.scene().addItem(self.viewBoxes[1])
+        self.plotItem.getAxis('right').linkToView(self.viewBoxes[1])
+        self.viewBoxes[1].setXLink(self.plotItem)
+        self.plotItem.vb.sigResized.connect(self.updateViews)
+
+        self.lines = []
+        for i, vb in enumerate(self.viewBoxes):
+            line = pg.PlotDataItem(pen=pg.mkPen(_COLORS[i]))
+            # Peak preserving downsampling to the screen resolution; analysis still gets the full data
+            line.setDownsampling(auto=True, method='peak')
+            line.setClipToView(True)
+            vb.addItem(line)
+            self.lines.append(line)
+        self.legend = None
+        self.arrows = [None] * 2
+        self.markedPeaks = None
+        self.scatter = None
+        self.annotations = None
+        self.textBox = None
+        self.verticalLines = []
+        self.canvas = PlotCanvas(self.plotWidget, self.plotItem)
+
+        self.fpsLabel = QLabel('')
+        self.framesRendered, self.fpsTime = 0, time.perf_counter()
+        self.topBar = QHBoxLayout()
+        self.topBar.addStretch()
+        self.topBar.addWidget(self.fpsLabel)
+        layout = QVBoxLayout()
+        layout.addLayout(self.topBar)
+        layout.addWidget(self.plotWidget)
+        widget = QWidget()
+        widget.setLayout(layout)
+        widget.setContentsMargins(0, 0, 0, 0)
+        self.widgetPlot = widget
+
+    def addToolbarWidget(self, widget):
+        # Controls of the tab that owns the plot (e.g. the scope's max fps), next to the fps label
+        self.topBar.addWidget(widget)
+
+    def updateViews(self):
+        self.viewBoxes[1].setGeometry(self.plotItem.vb.sceneBoundingRect())
+        self.viewBoxes[1].linkedViewChanged(self.plotItem.vb, self.viewBoxes[1].XAxis)
+
+    def countFrame(self):
+        self.framesRendered += 1
+        elapsed = time.perf_counter() - self.fpsTime
+        if elapsed >= 1:
+            self.fpsLabel.setText('%.1f fps' % (self.framesRendered / elapsed))
+            self.framesRendered, self.fpsTime = 0, time.perf_counter()
+
+    def plot_Scope(self, x_data, y_data, autoscale=False, redraw=False, **kwargs):
+        if redraw:
+            self.redrawScope(x_data, y_data, **kwargs)
+        for i, y in enumerate(y_data):
+            self.lines[i].setData(x_data, y)
+            self.viewBoxes[i].enableAutoRange(axis=pg.ViewBox.YAxis, enable=autoscale)
+        if 'aux_plotting_func' in kwargs:
+            kwargs['aux_plotting_func'](redraw=redraw, **kwargs)  # This is a general way of calling this function
+        if 'mark_peak' in kwargs and kwargs['mark_peak'] is not None:
+            self.markPeaks(kwargs['mark_peak'])
+            for i, pk in enumerate(kwargs['mark_peak']):
+                if self.arrows[i] is None:
+                    self.arrows[i] = self.annotateWithArrow(pk[0], pk[1])
+                self.arrows[i].xy = (pk[0], pk[1])
+        if 'text_box' in kwargs and kwargs['text_box'] is not None:
+            if self.textBox is None: self.addTextBox(textstr=kwargs['text_box'])
+            self.textBox.set_text(str(kwargs['text_box']))
+        self.countFrame()
+
+    def redrawScope(self, x_data, y_data, **kwargs):
+        # Everything but the lines is rebuilt: legend, markers, arrows, text box, vertical lines, ticks and limits
+        for vb in self.viewBoxes:
+            for item in list(vb.addedItems):
+                if item not in self.lines:
+                    vb.removeItem(item)
+        if self.textBox is not None:
+            self.textBox.item.setParentItem(None)
+        self.arrows = [None] * 2
+        self.textBox = None
+        self.scatter = None
+        self.markedPeaks = None
+        self.annotations = None
+        self.verticalLines = []
+        labels = kwargs.get('labels', [''] * 10)
+        for i, line in enumerate(self.lines):
+            line.setVisible(i < len(y_data))
+            line.opts['name'] = labels[i] if i < len(labels) else ''
+        if self.legend is not None:
+            self.legend.scene().removeItem(self.legend)
+            self.legend = None
+        if kwargs.get('legend', True) and 'labels' in kwargs:
+            self.legend = self.plotItem.addLegend(offset=(-10, 10))
+            for i in range(len(y_data)):
+                self.legend.addItem(self.lines[i], labels[i])
+        grid = kwargs.get('grid', True)
+        self.plotItem.showGrid(x=grid, y=grid, alpha=0.3)
+        if 'x_ticks' in kwargs:
+            self.plotItem.getAxis('bottom').setTicks([[(t, '%g' % t) for t in kwargs['x_ticks']]])
+        if 'y_ticks' in kwargs:
+            for i, ticks in enumerate(kwargs['y_ticks'][:len(y_data)]):
+                self.plotItem.getAxis('left' if i == 0 else 'right').setTicks([[(t, '%.3g' % t) for t in ticks]])
+                self.viewBoxes[i].setYRange(ticks[0], ticks[-1], padding=0)
+        self.plotItem.setXRange(x_data[0], x_data[-1], padding=0)
+        self.plotItem.setLabel('left', 'Voltage [V]')
+        self.plotItem.setLabel('bottom', 'Time [ms]')
+
+    def plot_Scatter(self, ax_index=0, **kwargs):
+        x_data, y_data = kwargs.get('scatter_x_data', []), kwargs.get('scatter_y_data', [])
+        if len(x_data) == 0 or len(y_data) == 0:
+            return
+        if self.scatter is None:
+            self.scatter = pg.ScatterPlotItem(symbol='x', pen=pg.mkPen('b'), brush=pg.mkBrush('b'), size=10)
+            self.viewBoxes[ax_index].addItem(self.scatter)
+        self.scatter.setData(x_data, y_data)
+        tags = kwargs.get('scatter_tags', [])
+        if len(tags) == len(x_data) and len(tags) > 0:
+            if self.annotations is None or len(self.annotations) != len(tags):
+                for ann in self.annotations or []:
+                    self.viewBoxes[ax_index].removeItem(ann)
+                self.annotations = [pg.TextItem(str(tag), color='k') for tag in tags]
+                for ann in self.annotations:
+                    self.viewBoxes[ax_index].addItem(ann)
+            for ann, x, y in zip(self.annotations, x_data, y_data):
+                ann.setPos(x, y)
+
+    def markPeaks(self, peaksCoordinates, ax_index=0):
+        x_data, y_data = zip(*peaksCoordinates)  # turns [(x0,y0),(x1,y1)] into [(x0,x1),(y0,y1)]
+        if self.markedPeaks is None:
+            self.markedPeaks = pg.ScatterPlotItem(symbol='o', pen=pg.mkPen('r'), brush=pg.mkBrush('r'), size=8)
+            self.viewBoxes[ax_index].addItem(self.markedPeaks)
+        self.markedPeaks.setData(x_data, y_data)
+
+    def annotateWithArrow(self, x, y, ax_index=0):
+        return Arrow(self.viewBoxes[ax_index], x, y)
+
+    def addTextBox(self, textstr):
+        self.textBox = TextBox(self.plotItem, textstr)
+
+    def plotVerticalLines(self, **kwargs):
+        if 'redraw' in kwargs and kwargs['redraw'] and 'verticalXs' in kwargs and type(kwargs['verticalXs']) is list:
+            style = kwargs['vLineStyle'] if 'vLineStyle' in kwargs else '-'
+            for x in kwargs['verticalXs']:
+                self.verticalLines.append(VerticalLine(self.viewBoxes[0], x, style))
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded hand-off of Red Pitaya frames between the websocket thread and the GUI thread.
+
+The websocket thread only calls put(), which never blocks; averaging, peak finding, plotting and saving all happen
+in the slot connected to frameReady, which Qt runs on the GUI thread. This way the receive loop does not depend on
+how long rendering takes.
+"""
+
+import threading
+from collections import deque
+import numpy as np
+from PyQt5.QtCore import QObject, pyqtSignal, Qt
+
+DROP_POLICIES = ('keep-latest', 'keep-all', 'every-Nth')
+
+
+class FrameQueue(QObject):
+    """
+    Drop policies:
+    keep-latest - only the newest frame is kept; the GUI always sees the most recent data.
+    keep-all    - frames are kept in order, up to maxsize; when full, the oldest frame is dropped.
+    every-Nth   - only every N-th received frame is queued (then as in keep-all). The queued frames are copies: the
+                  skipped frames are decoded too, so a queue of maxsize frames spans about maxsize * N of RedPitaya's
+                  rotating decoder buffers, more than it has.
+    Under the other policies, frames are copied too if the queue can hold more of them than the producer's rotating
+    buffers keep intact (see setSourceBuffers), e.g. after switching from keep-latest to keep-all while connected.
+    """
+    frameReady = pyqtSignal(object, object)  # data, parameters. Emitted on the GUI thread.
+    framesPending = pyqtSignal()  # internal; emitted from the producer thread, queued to the GUI thread
+
+    def __init__(self, policy='keep-latest', maxsize=8, every_n=2, parent=None):
+        super(FrameQueue, self).__init__(parent)
+        self.lock = threading.Lock()
+        self.frames = deque()
+        self.received, self.delivered, self.dropped = 0, 0, 0
+        self.newParametersPending = False  # keep the 'new_parameters' flag of dropped frames, so that no redraw is lost
+        self.sourceBuffers = None  # buffers the producer decodes into in rotation; None - frames are never reused
+        self.setPolicy(policy, maxsize, every_n)
+        self.framesPending.connect(self.deliver, Qt.QueuedConnection)
+
+    def setPolicy(self, policy, maxsize=None, every_n=None):
+        if policy not in DROP_POLICIES:
+            raise ValueError('Drop policy must be one of %s' % str(DROP_POLICIES))
+        with self.lock:
+            self.policy = policy
+            self.maxsize = int(maxsize) if maxsize is not None else self.maxsize
+            self.every_n = max(1, int(every_n)) if every_n is not None else self.every_n
+            self.frames = deque(self.frames, maxlen=1 if policy == 'keep-latest' else self.maxsize)
+            self.copyQueued()
+
+    def setSourceBuffers(self, n):
+        """@n: number of buffers the producer (RedPitaya's decoder) reuses in rotation for the frames it puts"""
+        with self.lock:
+            self.sourceBuffers = n
+            self.copyQueued()
+
+    @property
+    def capacity(self):
+        # Max number of frames held by the queue at once (RedPitaya's decoder should have capacity + 2 buffers; with
+        # fewer, or under every-Nth, the queued frames are copies and hold none of them)
+        return self.frames.maxlen
+
+    def mustCopy(self):
+        # Call with self.lock held. Besides the queued frames, the GUI handles one and the producer decodes another
+        if self.policy == 'every-Nth':
+            return True
+        return self.sourceBuffers is not None and self.sourceBuffers < self.frames.maxlen + 2
+
+    def copyQueued(self):
+        # Call with self.lock held, when the policy or the buffers change. The queued frames are still intact (they
+        # were queued under the previous settings), but might not stay so under the new ones
+        if self.mustCopy():
+            self.frames = deque([([np.array(channel) for channel in data], parameters) for data, parameters in self.frames],
+                                maxlen=self.frames.maxlen)
+
+    def full(self):
+        # True while the next put() would drop a frame (a replay in 'max' mode waits on this)
+        return len(self.frames) == self.frames.maxlen
+
+    def put(self, data, parameters):
+        """Producer side; called by RedPitaya (on the websocket thread). Never blocks."""
+        with self.lock:
+            self.received += 1
+            if self.policy == 'every-Nth' and (self.received - 1) % self.every_n != 0:
+                self.dropped += 1
+                self.newParametersPending |= bool(parameters.get('new_parameters', False))
+                return
+            wasEmpty = not self.frames
+            if len(self.frames) == self.frames.maxlen:
+                _, old_parameters = self.frames.popleft()
+                self.newParametersPending |= bool(old_parameters.get('new_parameters', False))
+                self.dropped += 1
+            if self.mustCopy():
+                data = [np.array(channel) for channel in data]
+            # RedPitaya resets 'new_parameters' right after the callback returns, so keep a (shallow) copy
+            self.frames.append((data, dict(parameters)))
+        if wasEmpty:
+            self.framesPending.emit()
+
+    def deliver(self):
+        """Consumer side; runs on the GUI thread. Hands one frame to frameReady and reschedules if more are waiting."""
+        with self.lock:
+            if not self.frames:
+                return
+            data, parameters = self.frames.popleft()
+            if self.newParametersPending:
+                parameters['new_parameters'] = True
+                self.newParametersPending = False
+            moreWaiting = len(self.frames) > 0
+        self.delivered += 1
+        self.frameReady.emit(data, parameters)
+        if moreWaiting:
+            self.framesPending.emit()  # let other GUI events in between frames
+
+    def clear(self):
+        with self.lock:
+            self.dropped += len(self.frames)
+            self.frames.clear()
+
+    def stats(self):
+        return {'received': self.received, 'delivered': self.delivered, 'dropped': self.dropped, 'queued': len(self.frames)}
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+Frame-rate governor for the scope plots.
+
+update_scope analyses every frame it gets (averaging, peaks, lock, saving) and then submit()s the plot call here
+instead of plotting right away. A QTimer running at maxFps renders only the newest submitted plot; the ones submitted
+in between are skipped. Rendering is by far the slowest step, so this keeps the analysis up with the frames.
+"""
+
+import time
+from PyQt5.QtCore import QObject, QTimer
+
+MAX_FPS_CHOICES = (10, 25, 60)
+
+
+class RenderScheduler(QObject):
+    def __init__(self, render, maxFps=25, parent=None):
+        """
+        @render: called (on the GUI thread) as render(*args, **kwargs) with the arguments of the newest submit()
+        @maxFps: renders per second, at most
+        """
+        super(RenderScheduler, self).__init__(parent)
+        self.render = render
+        self.pending = None  # (args, kwargs) of the newest frame not rendered yet
+        self.redrawPending = False  # keep the 'redraw' flag of skipped frames, so that no full redraw is lost
+        self.analysed, self.rendered, self.skipped = 0, 0, 0
+        self.renderTime = 0  # total seconds spent in render
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.renderNewest)
+        self.setMaxFps(maxFps)
+
+    def setMaxFps(self, maxFps):
+        self.maxFps = float(maxFps)
+        self.timer.start(max(1, int(round(1000 / self.maxFps))))
+
+    def submit(self, *args, **kwargs):
+        """Called once per analysed frame. Replaces any frame still waiting to be rendered."""
+        self.analysed += 1
+        if self.pending is not None:
+            self.skipped += 1
+        self.redrawPending |= bool(kwargs.get('redraw', False))
+        self.pending = (args, kwargs)
+
+    def renderNewest(self):
+        if self.pending is None:
+            return
+        args, kwargs = self.pending
+        self.pending = None
+        if self.redrawPending:
+            kwargs['redraw'] = True
+            self.redrawPending = False
+        start = time.perf_counter()
+        self.render(*args, **kwargs)
+        self.renderTime += time.perf_counter() - start
+        self.rendered += 1
+
+    def stop(self):
+        self.timer.stop()
+        self.pending = None
+
+    def stats(self):
+        return {'analysed': self.analysed, 'rendered': self.rendered, 'skipped': self.skipped,
+                'mean_render_ms': 1e3 * self.renderTime / self.rendered if self.rendered else 0}
@@ -1,20 +1,26 @@
 
 from PyQt5 import uic
 import time
-from functions import RedPitayaWebsocket
+from functions import RedPitayaWebsocket, RedPitayaReplay
 from scipy import optimize,spatial
 from scipy.signal import find_peaks
 # import vxi11 # https://github.com/python-ivi/python-vxi11
 import os
 import sys
 import numpy as np
-from PyQt5.QtWidgets import QApplication
+from PyQt5.QtWidgets import QApplication, QComboBox, QLabel
 import matplotlib
-from PyQt5.QtCore import QThreadPool
+from PyQt5.QtCore import QThreadPool, QTimer
 from datetime import date, datetime
 from widgets.worker import Worker
+from widgets.scopeWidget.frame_queue import FrameQueue
+from widgets.scopeWidget.render_scheduler import RenderScheduler, MAX_FPS_CHOICES
 import matplotlib.pyplot as plt
 from functions.stirap.calculate_Nat_stirap import NAtoms
+from functions.analysis.running_average import RunningAverage
+from functions.analysis.peak_tracker import PeakTracker
+from functions.analysis.cavity_estimator import StreamingCavityEstimator, cavityTransmission, paramsToText as cavityParamsToText
+from functions.data_writer import AsyncWriter
 _CONNECTION_ATTMPTS = 2
 
 try:
@@ -28,13 +34,15 @@ from widgets.quantumWidget import QuantumWidget
 
 
 class Scope_GUI(QuantumWidget):
-    def __init__(self, Parent=None, ui=None, simulation=True, RedPitayaHost = None, debugging = False):
+    def __init__(self, Parent=None, ui=None, simulation=True, RedPitayaHost = None, debugging = False, dropPolicy = 'keep-all', plotBackend = 'matplotlib', maxFps = 25, replay = None, replayMode = 'original'):
         if Parent is not None:
             self.Parent = Parent
         ui = os.path.join(os.path.dirname(__file__), "scopeWidgetGUI.ui") if ui is None else ui
         self.host = RedPitayaHost
         self.debugging = debugging
-        super().__init__(ui, simulation)
+        self.replay = replay  # path of a RedPitayaReplay recording, played instead of connecting to a RedPitaya
+        self.replayMode = replayMode  # 'original', 'max' or 'step'; see RedPitayaReplay
+        super().__init__(ui, simulation, plotBackend=plotBackend)
         # up to here, nothing to change.
 
         if __name__ == "__main__":
@@ -45,9 +53,41 @@ class Scope_GUI(QuantumWidget):
         self.scope_parameters = {'new_parameters': False, 'OSC_TIME_SCALE': {'value':'1'}, 'OSC_CH1_SCALE': {'value':'1'},'OSC_CH1_SCALE': {'value':'1'}, 'OSC_DATA_SIZE':{'value':1024}}
         self.CHsUpdated = False
         self.rp = None  # Place holder
+        self.rawRecorder = None  # RedPitayaReplay.WebsocketRecorder; see startRawRecording
         self.isSavingNDataFiles = False
         self.signalLength = self.scope_parameters['OSC_DATA_SIZE']['value'] # 1024 by default
+        self.exponentialAveraging = False  # if True, averaging is an exponential moving average instead of the last N frames
         self.indx_to_freq = [0]
+        # Peaks are tracked from frame to frame; a full find_peaks only when one is lost (see PeakTracker)
+        self.Rb_peakTracker, self.Cavity_peakTracker = PeakTracker(), PeakTracker()
+        self.cavityEstimator = None  # fits the cavity parameters in a worker process; see startCavityEstimation
+        self.timeScale, self.timeScaleKey = None, None  # time axis of saved data; recomputed only when the scope parameters change
+        self.recordingName = None  # continuous saving goes to one recording per session; see recordCurrentData
+
+        # -- saving --
+        # Data files are written by a background thread; if the network drive is slow or missing, they go to local disk first
+        self.dataWriter = AsyncWriter(primary_dir=os.path.join("U:\\", "Lab_2021-2022", "Experiment_results", "Python Data"),
+                                      spill_dir=os.path.join("C:\\", "Pycharm", "Expriements", "DATA", "Spill"))
+
+        # -- frames queue --
+        # RedPitaya puts frames here (on the websocket thread); update_scope gets them on the GUI thread.
+        self.frameQueue = FrameQueue(policy=dropPolicy)
+        self.frameQueue.frameReady.connect(self.update_scope)
+        # update_scope analyses every frame, but plots through here: only the newest frame is rendered, at most maxFps times a second
+        self.renderScheduler = RenderScheduler(self.widgetPlot.plot_Scope, maxFps=maxFps, parent=self)
+        # Max fps choice and the frame counters (received / analysed / rendered), on the plot's toolbar
+        self.comboBox_maxFps = QComboBox()
+        self.comboBox_maxFps.setToolTip('Plot at most this many frames per second')
+        for fps in sorted(set(MAX_FPS_CHOICES) | {int(maxFps)}):
+            self.comboBox_maxFps.addItem('%d fps max' % fps, fps)
+        self.comboBox_maxFps.setCurrentIndex(self.comboBox_maxFps.findData(int(maxFps)))
+        self.comboBox_maxFps.currentIndexChanged.connect(lambda i: self.setMaxFps(self.comboBox_maxFps.itemData(i)))
+        self.label_frameStats = QLabel('')
+        self.widgetPlot.addToolbarWidget(self.comboBox_maxFps)
+        self.widgetPlot.addToolbarWidget(self.label_frameStats)
+        self.frameStatsTimer = QTimer(self)
+        self.frameStatsTimer.timeout.connect(self.showFrameStats)
+        self.frameStatsTimer.start(1000)
 
         # -- connect --
         self.connectButtonsAndSpinboxes()
@@ -65,19 +105,89 @@ class Scope_GUI(QuantumWidget):
         self.checkBox_Rb_lines.clicked.connect(self.chns_update)
         self.checkBox_Cavity_transm.clicked.connect(self.chns_update)
 
+        self.checkBox_saveData.clicked.connect(self.newRecording)
         self.checkBox_CH1Inverse.clicked.connect(self.setInverseChns)
         self.checkBox_CH2Inverse.clicked.connect(self.setInverseChns)
 
 
+    def setDropPolicy(self, policy, every_n=None):
+        # policy is one of 'keep-latest', 'keep-all' or 'every-Nth'
+        # If the queue gets longer than RedPitaya's decoder buffers allow (they are allocated on connect), it copies the frames
+        self.frameQueue.setPolicy(policy, every_n=every_n)
+        self.print_to_dialogue('Frames drop policy set to %s' % policy)
+
+    def setMaxFps(self, maxFps):
+        # e.g. one of render_scheduler.MAX_FPS_CHOICES (comboBox_maxFps)
+        self.renderScheduler.setMaxFps(maxFps)
+        i = self.comboBox_maxFps.findData(int(maxFps))
+        if i != -1 and i != self.comboBox_maxFps.currentIndex():
+            self.comboBox_maxFps.blockSignals(True)
+            self.comboBox_maxFps.setCurrentIndex(i)
+            self.comboBox_maxFps.blockSignals(False)
+        self.print_to_dialogue('Plotting at most %d frames per second' % maxFps)
+
+    def frameStats(self):
+        # Frames received from RedPitaya, analysed by update_scope and rendered on screen (see where frames are lost)
+        stats = self.frameQueue.stats()
+        stats.update(self.renderScheduler.stats())
+        return stats
+
+    def showFrameStats(self):
+        self.label_frameStats.setText('received %(received)d / analysed %(analysed)d / rendered %(rendered)d, '
+                                      'dropped %(dropped)d' % self.frameStats())
+
+    def printFrameStats(self):
+        self.print_to_dialogue('received %(received)d, dropped %(dropped)d, analysed %(analysed)d, rendered %(rendered)d '
+                               '(%(mean_render_ms).1f ms per render)' % self.frameStats())
+        self.print_to_dialogue(self.dataWriter.statsText())
+
+    def startRawRecording(self, path):
+        # Record the websocket messages of this session, to be replayed later (replay=path)
+        self.stopRawRecording()
+        self.rawRecorder = RedPitayaReplay.WebsocketRecorder(path)
+        if self.rp is not None:
+            self.rp.recorder = self.rawRecorder
+        self.print_to_dialogue('Recording RedPitaya frames to %s' % path)
+
+    def stopRawRecording(self):
+        if self.rawRecorder is None:
+            return
+        if self.rp is not None:
+            self.rp.recorder = None
+        self.rawRecorder.close()
+        self.print_to_dialogue('Recorded %d messages (%d bytes) to %s' % (self.rawRecorder.messages, self.rawRecorder.bytes, self.rawRecorder.path))
+        self.rawRecorder = None
+
+    def startCavityEstimation(self, every_n=10, amp=1.0):
+        # Fit the cavity model (see functions.analysis.cavity_estimator) to every n-th averaged CH2 trace, in a worker process
+        # @amp: [V] transmission signal for T = 1; results are in the units of the x axis (ms)
+        self.stopCavityEstimation()
+        self.cavityEstimator = StreamingCavityEstimator(every_n=every_n, amp=amp)
+        self.print_to_dialogue('Estimating cavity parameters every %d frames' % every_n)
+
+    def stopCavityEstimation(self):
+        if self.cavityEstimator is not None:
+            self.cavityEstimator.stop()
+            self.cavityEstimator = None
+
+    def updateCavityEstimate(self, x_axis):
+        # Called by update_scope; submits the averaged cavity transmission and returns the newest estimate as text (or None)
+        if self.cavityEstimator is None:
+            return None
+        self.cavityEstimator.submit(x_axis, self.Cavity_Transmission_Avg_Data)
+        latest = self.cavityEstimator.poll()
+        return None if latest is None else 'Cavity: \n' + cavityParamsToText(latest)
+
+    def cavityEstimateSeries(self):
+        # Time series of the estimates so far (fields time, f0, k_ex, k_i, k_tot, h and s_<name> uncertainties), for plotting/saving
+        return self.cavityEstimator.series() if self.cavityEstimator is not None else None
+
     def setInverseChns(self):
         self.rp.set_inverseChannel(ch=1, value = self.checkBox_CH1Inverse.isChecked())
         self.rp.set_inverseChannel(ch=2, value =  self.checkBox_CH2Inverse.isChecked())
 
     def update_plot_params(self):
-        self.Avg_num = [int(self.spinBox_averaging_ch1.value()), int(self.spinBox_averaging_ch2.value())]
-        self.Rb_lines_Data = np.zeros((self.Avg_num[0], self.signalLength))  # Place holder
-        self.Cavity_Transmission_Data = np.zeros((self.Avg_num[1], self.signalLength))  # Place holder
-        self.Avg_indx = 0
+        self.updateAveraging()
 
     def updateTriggerDelay(self):
         t = float(self.doubleSpinBox_triggerDelay.value())  # ms
@@ -95,9 +205,9 @@ class Scope_GUI(QuantumWidget):
 
     def updateAveraging(self):
         self.Avg_num = [int(self.spinBox_averaging_ch1.value()),int(self.spinBox_averaging_ch2.value())]
-        self.Rb_lines_Data = np.zeros((self.Avg_num[0], self.signalLength))  # Place holder
-        self.Cavity_Transmission_Data = np.zeros((self.Avg_num[1], self.signalLength))  # Place holder
-        self.Avg_indx = 0
+        # Running averages of the last Avg_num frames of each channel (adding a frame does not depend on Avg_num)
+        self.Rb_lines_Data = RunningAverage(self.Avg_num[0], self.signalLength, exponential=self.exponentialAveraging)
+        self.Cavity_Transmission_Data = RunningAverage(self.Avg_num[1], self.signalLength, exponential=self.exponentialAveraging)
         # self.print_to_dialogue("Data averaging changed to %i" % self.Avg_num)
 
     def updatePlotDisplay(self):
@@ -134,44 +244,91 @@ class Scope_GUI(QuantumWidget):
     def saveCurrentDataClicked(self):
         self.isSavingNDataFiles = True
 
+    def newRecording(self):
+        self.recordingName = None  # the next recorded frame starts a new session file
+
+    def updateSavedTimeScale(self):
+        # Returns True if the time axis changed
+        key = (self.scope_parameters['OSC_TIME_SCALE']['value'], self.scope_parameters['OSC_DATA_SIZE']['value'])
+        if key == self.timeScaleKey:
+            return False
+        self.timeScale = np.linspace(0, float(key[0]) * 10, num=int(key[1]))
+        self.timeScaleKey = key
+        return True
+
+    def recordCurrentData(self, extra_text = ''):
+        # Append the current (averaged) traces to this session's recording, <today>/<start time> session.rec
+        if self.updateSavedTimeScale() or self.recordingName is None:
+            now = datetime.now()
+            self.recordingName = os.path.join(now.strftime("%B-%d-%Y"), now.strftime("%H-%M-%S") + " session")
+            self.print_to_dialogue("Recording to Lab_2021-2022/Experiment_results/Python Data/%s.rec" % self.recordingName)
+        parameters = {'OSC_TIME_SCALE': self.scope_parameters['OSC_TIME_SCALE']['value'],
+                      'trigger_source': self.comboBox_triggerSource.currentText(),
+                      'trigger_delay': self.doubleSpinBox_triggerDelay.value(),
+                      'trigger_level': self.doubleSpinBox_triggerLevel.value(),
+                      'comment': self.lineEdit_fileComment.text(), 'extra_text': extra_text}
+        if self.cavityEstimator is not None and self.cavityEstimator.latest is not None:
+            parameters['cavity'] = self.cavityEstimator.latest  # newest cavity parameters estimate (with uncertainties)
+        frame = np.array([self.Rb_lines_Avg_Data, self.Cavity_Transmission_Avg_Data], dtype=np.float32)
+        if not self.dataWriter.record(self.recordingName, frame, parameters=parameters, channels=['CH1', 'CH2'], metadata={'time': self.timeScale}):
+            self.print_to_dialogue("Saving queue is full, frame dropped (%s)" % self.dataWriter.statsText(), color='red')
+
     def saveCurrentData(self, extra_text = ''):
         extra_text = str(extra_text)
+        if self.checkBox_saveData.isChecked():
+            self.recordCurrentData(extra_text)
+            if not self.isSavingNDataFiles:
+                return
         if self.isSavingNDataFiles: # if we are saving N files
             if self.spinBox_saveNFiles.value() > 1:
                 self.spinBox_saveNFiles.setValue(self.spinBox_saveNFiles.value() - 1)  # decrease files to save by 1
             elif self.spinBox_saveNFiles.value() == 1:
                 self.isSavingNDataFiles = False
 
-        timeScale = np.linspace(0, float(self.scope_parameters['OSC_TIME_SCALE']['value']) * 10, num=int(self.scope_parameters['OSC_DATA_SIZE']['value']))
+        if self.updateSavedTimeScale():
+            self.recordingName = None
         now = datetime.now()
-        today = date.today()
-        # datadir = os.path.join("C:\\", "Pycharm", "Expriements", "DATA", "CavityLock")
-        datadir = os.path.join("U:\\", "Lab_2021-2022", "Experiment_results", "Python Data")
-        todayformated = today.strftime("%B-%d-%Y")
-        todaydatadir = os.path.join(datadir, todayformated)
+        todayformated = now.strftime("%B-%d-%Y")
         nowformated = now.strftime("%H-%M-%S_%f")
-        try:
-            os.makedirs(todaydatadir)
-            if not self.checkBox_saveData.isChecked():
-                self.print_to_dialogue("Created folder Lab_2021-2022/Experiment_results/Python Data/%s" % (todayformated))
-                self.print_to_dialogue("Data Saved")
-        except FileExistsError:
-            if not self.checkBox_saveData.isChecked():
-                self.print_to_dialogue("Data Saved")
-
-        self.datafile = os.path.join(todaydatadir, nowformated + ".txt")
         meta = "Traces from the RedPitaya, obtained on %s at %s.\n" % (todayformated, nowformated)
         cmnt = self.lineEdit_fileComment.text()
-        # np.savez_compressed(os.path.join(todaydatadir, nowformated), CH1=self.Rb_lines_Avg_Data, CH2=self.Cavity_Transmission_Data, time=timeScale, meta=meta)
-        np.savez_compressed(os.path.join(todaydatadir, nowformated), CH1=self.Rb_lines_Avg_Data,CH2=self.Cavity_Transmission_Avg_Data, time=timeScale, meta=meta, comment = cmnt, extra_text = extra_text)
+        # Queued; written to Lab_2021-2022/Experiment_results/Python Data/<today>/<now>.npz by self.dataWriter
+        cavity = {}
+        if self.cavityEstimator is not None and self.cavityEstimator.latest is not None:
+            cavity = {'cavity_' + k: v for k, v in self.cavityEstimator.latest.items()}
+        saved = self.dataWriter.save(os.path.join(todayformated, nowformated), CH1=self.Rb_lines_Avg_Data, CH2=self.Cavity_Transmission_Avg_Data,
+                                     time=self.timeScale, meta=meta, comment=cmnt, extra_text=extra_text, **cavity)
+        if not saved:
+            self.print_to_dialogue("Saving queue is full, frame dropped (%s)" % self.dataWriter.statsText(), color='red')
+        else:
+            self.print_to_dialogue("Data Saved")
+
+    def closeEvent(self, event):
+        self.stopCavityEstimation()
+        if self.rp is not None:
+            self.rp.close()  # also ends a replay
+        self.stopRawRecording()
+        self.renderScheduler.stop()
+        self.frameStatsTimer.stop()
+        self.dataWriter.close()  # write whatever is still queued
+        super().closeEvent(event)
 
     def redPitayaConnect(self, progress_callback):
         RpHost = ["rp-ffffb4.local","rp-f08c22.local", "rp-f08c36.local"]
-        if self.host == None:
-            self.rp = RedPitayaWebsocket.Redpitaya(host="rp-ffffb4.local", got_data_callback=self.update_scope,dialogue_print_callback=self.print_to_dialogue, debugging= self.debugging)
+        # Data goes through self.frameQueue, so decoder must have enough buffers for the queued frames + the one being processed
+        decoder_buffers = self.frameQueue.capacity + 2
+        self.frameQueue.setSourceBuffers(decoder_buffers)
+        if self.replay is not None:
+            # In 'max' mode, frames are replayed as fast as update_scope takes them (none dropped by the queue)
+            self.rp = RedPitayaReplay.ReplaySource(self.replay, got_data_callback=self.frameQueue.put, mode=self.replayMode,
+                                                   ready=lambda: not self.frameQueue.full(),
+                                                   dialogue_print_callback=self.print_to_dialogue, debugging=self.debugging,
+                                                   decoder_buffers=decoder_buffers)
+        elif self.host == None:
+            self.rp = RedPitayaWebsocket.Redpitaya(host="rp-ffffb4.local", got_data_callback=self.frameQueue.put,dialogue_print_callback=self.print_to_dialogue, debugging= self.debugging, decoder_buffers=decoder_buffers, recorder=self.rawRecorder)
         else:
-            self.rp = RedPitayaWebsocket.Redpitaya(host=self.host, got_data_callback=self.update_scope,
-                                                   dialogue_print_callback=self.print_to_dialogue, debugging= self.debugging)
+            self.rp = RedPitayaWebsocket.Redpitaya(host=self.host, got_data_callback=self.frameQueue.put,
+                                                   dialogue_print_callback=self.print_to_dialogue, debugging= self.debugging, decoder_buffers=decoder_buffers, recorder=self.rawRecorder)
 
         if self.rp.connected:
             self.connection_attempt = 0 # connection
@@ -188,7 +345,7 @@ class Scope_GUI(QuantumWidget):
 
 
 
-    # Never call this method. this is called by RedPitaya
+    # Never call this method. this is called (on the GUI thread) by self.frameQueue, with frames from RedPitaya
     def update_scope(self, data, parameters):
         if self.rp.firstRun:
             # Set default from display...
@@ -199,45 +356,30 @@ class Scope_GUI(QuantumWidget):
             self.chns_update()
             self.rp.firstRun = False
 
-        # ---------------- Handle duplicate data ----------------
-        # It seems RedPitaya tends to send the same data more than once. That is, although it has not been triggered,
-        # scope will send current data as fast as it can.
-        # Following lines aim to prevent unnecessary work
-        previousDataIndex = self.Avg_indx - 1
-        if np.array_equal(self.Rb_lines_Data[previousDataIndex % self.Avg_num[0]], data[0]) or np.array_equal(
-                self.Cavity_Transmission_Data[previousDataIndex % self.Avg_num[1]], data[1]):
-            return
+        # Note: RedPitaya tends to send the same data more than once (although it has not been triggered, scope will send
+        # current data as fast as it can). These duplicates are dropped by RedPitaya itself; see self.rp.duplicates_dropped
         # ---------------- Handle Redraws and data reading ----------------
         # This is true only when some parameters were changed on RP, prompting a total redraw of the plot (in other cases, updating the data suffices)
         redraw = (parameters['new_parameters'] or self.CHsUpdated)
         if redraw:
             self.scope_parameters.update(parameters)  # keep all the parameters. we need them.
             self.CHsUpdated = False
-        self.Rb_lines_Data[self.Avg_indx % self.Avg_num[0]] = data[0]  # Insert new data
-        self.Cavity_Transmission_Data[self.Avg_indx % self.Avg_num[1]] = data[1]  # Insert new data
-        self.Avg_indx = self.Avg_indx + 1
         # ---------------- Average data  ----------------
-        # Calculate avarage data and find peaks position (indx) and properties:
+        # Insert new data and get the updated averages; find peaks position (indx) and properties:
+        self.Rb_lines_Avg_Data = self.Rb_lines_Data.add(data[0])
+        self.Cavity_Transmission_Avg_Data = self.Cavity_Transmission_Data.add(data[1])
         Avg_data = []
         if self.checkBox_Rb_lines.isChecked():
-            self.Rb_lines_Avg_Data = np.average(self.Rb_lines_Data, axis=0)
             Avg_data = Avg_data + [self.Rb_lines_Avg_Data]
         if self.checkBox_Cavity_transm.isChecked():
-            self.Cavity_Transmission_Avg_Data = np.average(self.Cavity_Transmission_Data, axis=0)
             Avg_data = Avg_data + [self.Cavity_Transmission_Avg_Data]
 
         # ---------------- Handle Rb Peaks ----------------
         Rb_peaks,Cavity_peak, Rb_properties, Cavity_properties = [], [],{},{} # by default, none
         if self.checkBox_Rb_lines.isChecked():
-            Rb_peaks, Rb_properties = find_peaks(self.Rb_lines_Avg_Data,
-                                                 distance=float(self.spinBox_distance_ch1.value()),
-                                                 prominence=float(self.doubleSpinBox_prominence_ch1.value()),
-                                                 width=float(self.spinBox_width_ch1.value()))
+            Rb_peaks, Rb_properties = self.findPeaks(self.Rb_peakTracker, self.Rb_lines_Avg_Data, ch=1)
         if self.checkBox_Cavity_transm.isChecked():
-            Cavity_peak, Cavity_properties = find_peaks(self.Cavity_Transmission_Avg_Data,
-                                                        distance=float(self.spinBox_distance_ch2.value()),
-                                                        prominence=float(self.doubleSpinBox_prominence_ch2.value()),
-                                                        width=float(self.spinBox_width_ch2.value()))
+            Cavity_peak, Cavity_properties = self.findPeaks(self.Cavity_peakTracker, self.Cavity_Transmission_Avg_Data, ch=2)
 
         # ------- Scales -------
         # At this point we assume we have a corrcet calibration polynomial in @self.index_to_freq
@@ -267,20 +409,27 @@ class Scope_GUI(QuantumWidget):
 
         # ----------- text box -----------
         # to be printed in lower right corner
-        text_box_string = None
+        text_box_string = self.updateCavityEstimate(x_axis)
 
         # --------- plot ---------
         # Prepare data for display:
         labels = ["CH1 - Vortex Rb lines", "CH2 - Cavity transmission"]
-        self.widgetPlot.plot_Scope(x_axis, Avg_data, autoscale=self.checkBox_plotAutoscale.isChecked(), redraw=redraw, labels = labels, x_ticks = x_ticks, y_ticks= y_ticks,
-                                   aux_plotting_func = self.widgetPlot.plot_Scatter, scatter_y_data = np.concatenate([Avg_data[0][Rb_peaks], Avg_data[1][Cavity_peak]]),
-                                   scatter_x_data = np.concatenate([x_axis[Rb_peaks], x_axis[Cavity_peak]]),text_box = text_box_string)
+        self.renderScheduler.submit(x_axis, Avg_data, autoscale=self.checkBox_plotAutoscale.isChecked(), redraw=redraw, labels = labels, x_ticks = x_ticks, y_ticks= y_ticks,
+                                    aux_plotting_func = self.widgetPlot.plot_Scatter, scatter_y_data = np.concatenate([Avg_data[0][Rb_peaks], Avg_data[1][Cavity_peak]]),
+                                    scatter_x_data = np.concatenate([x_axis[Rb_peaks], x_axis[Cavity_peak]]),text_box = text_box_string)
 
         # -------- Save Data  --------:
         if self.checkBox_saveData.isChecked() or self.isSavingNDataFiles:
             self.saveCurrentData()
 
 
+    def findPeaks(self, tracker, avgData, ch):
+        # find_peaks with the channel's distance/prominence/width spinboxes, through the channel's PeakTracker
+        spinBoxes = {1: (self.spinBox_distance_ch1, self.doubleSpinBox_prominence_ch1, self.spinBox_width_ch1),
+                     2: (self.spinBox_distance_ch2, self.doubleSpinBox_prominence_ch2, self.spinBox_width_ch2)}[ch]
+        tracker.setParameters(*[float(s.value()) for s in spinBoxes])
+        return tracker.update(avgData)
+
     def printPeaksInformation(self):
         print('printPeaksInformation', str(self.indx_to_freq))
 
@@ -289,9 +438,7 @@ class Scope_GUI(QuantumWidget):
         k_ex,k_tot,h,f,f_offset - Hz
         amp,offset - [V]
         '''
-        delta = f - f_offset
-        z = offset + amp * np.power(np.abs(2 * k_ex * h / (1j * delta + k_tot) ** 2 + h ** 2), 2)
-        return z
+        return cavityTransmission(f, k_ex, k_tot, h, f_offset, offset, amp)
 
     def fitMultipleLorentzians(self, xData, yData,params_0):
         # -- fit functions ---
@@ -310,7 +457,7 @@ class Scope_GUI(QuantumWidget):
         # upper_bounds = [20] + [v * pub[1] for v in startValues]
         # bounds = [lower_bounds, upper_bounds]
         # startValues = [min(yData)] + startValues  # This is the constant from which we start the Lorentzian fits - ideally, 0
-        popt, pcov = optimize.curve_fit(self.lorentzian, xData, yData, p0=params_0, maxfev=50000)
+        popt, pcov = optimize.curve_fit(lambda f, *params: self.lorentzian(*params, f), xData, yData, p0=params_0, maxfev=50000)
         #ys = [multi_lorentz_curve_fit(x, popt) for x in xData]
         return (popt)
 
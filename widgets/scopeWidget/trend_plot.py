@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Trend panel of a MeasurementStream: each quantity against time (every shot, and its rolling mean +- std), and the
+relative Allan deviation of all of them. Redrawn at most every @min_interval seconds, with at most about @n_points
+points per line (min/max decimated, see dataplot.minMaxDecimate), so it stays cheap over hours of shots.
+"""
+
+import time
+import numpy as np
+import matplotlib
+if matplotlib.get_backend() != 'Qt5Agg':
+    matplotlib.use('Qt5Agg')
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.backends.backend_qt5agg import NavigationToolbar2QT as NavigationToolbar
+from matplotlib.figure import Figure
+from PyQt5.QtWidgets import QDialog, QVBoxLayout, QHBoxLayout, QPushButton, QLabel, QFileDialog
+
+from widgets.scopeWidget.dataplot import minMaxDecimate
+
+_LABELS = {'od': 'OD', 'n_atoms': '$N_{\\mathrm{at}}$', 'transmission': 'Transmission'}
+
+
+class TrendWindow(QDialog):
+    def __init__(self, stream, fields=('od', 'n_atoms'), title='Measurements', parent=None, min_interval=0.5,
+                 n_points=2000):
+        """
+        @stream: MeasurementStream
+        @fields: quantities to show (of measurement_stream.FIELDS)
+        """
+        super(TrendWindow, self).__init__(parent)
+        self.setWindowTitle(title)
+        self.stream = stream
+        self.fields = tuple(fields)
+        self.min_interval = min_interval
+        self.n_points = n_points
+        self.lastRefresh = 0
+
+        self.figure = Figure()
+        n = len(self.fields)
+        self.axes, self.lines = {}, {}
+        for i, f in enumerate(self.fields):
+            ax = self.figure.add_subplot(n + 1, 1, i + 1, sharex=self.axes[self.fields[0]] if i else None)
+            ax.set_ylabel(_LABELS.get(f, f))
+            ax.grid(True, alpha=0.3)
+            self.axes[f] = ax
+            self.lines[f] = (ax.plot([], [], '.', markersize=2, alpha=0.5)[0],  # every shot
+                             ax.plot([], [], 'r-')[0],  # rolling mean
+                             ax.plot([], [], 'r--', alpha=0.5)[0], ax.plot([], [], 'r--', alpha=0.5)[0])  # +- std
+        self.axes[self.fields[-1]].set_xlabel('Time [min] (0 - newest shot)')
+        self.allanAxis = self.figure.add_subplot(n + 1, 1, n + 1)
+        self.allanAxis.set_xscale('log')
+        self.allanAxis.set_yscale('log')
+        self.allanAxis.set_xlabel('$\\tau$ [s]')
+        self.allanAxis.set_ylabel('Relative Allan dev.')
+        self.allanAxis.grid(True, which='both', alpha=0.3)
+        self.allanLines = {f: self.allanAxis.plot([], [], 'o-', markersize=3, label=_LABELS.get(f, f))[0] for f in self.fields}
+        self.allanAxis.legend(loc='upper right')
+        self.figure.tight_layout()
+
+        self.canvas = FigureCanvas(self.figure)
+        self.toolbar = NavigationToolbar(self.canvas, self)
+        self.statsLabel = QLabel('')
+        self.pushButton_export = QPushButton('Export...')
+        self.pushButton_export.clicked.connect(self.exportClicked)
+        self.pushButton_reset = QPushButton('Reset')
+        self.pushButton_reset.clicked.connect(self.resetClicked)
+        buttons = QHBoxLayout()
+        buttons.addWidget(self.statsLabel, 1)
+        buttons.addWidget(self.pushButton_reset)
+        buttons.addWidget(self.pushButton_export)
+        layout = QVBoxLayout()
+        layout.addWidget(self.toolbar)
+        layout.addWidget(self.canvas)
+        layout.addLayout(buttons)
+        self.setLayout(layout)
+        self.resize(700, 200 * (n + 1))
+
+    def refresh(self, force=False):
+        """Redraw with the newest shots; call after every append (does nothing if hidden or redrawn too recently)."""
+        now = time.perf_counter()
+        if not force and (not self.isVisible() or now - self.lastRefresh < self.min_interval):
+            return
+        self.lastRefresh = now
+        series = self.stream.series()
+        self.statsLabel.setText(self.stream.statsText())
+        if len(series) == 0:
+            self.canvas.draw_idle()
+            return
+        x = (series['time'] - series['time'][-1]) / 60
+        for f in self.fields:
+            shots, mean, upper, lower = self.lines[f]
+            measured = np.isfinite(series[f])
+            xs, ys = x[measured], series[f][measured]
+            shots.set_data(*minMaxDecimate(xs, ys, self.n_points // 2))
+            step = max(1, len(xs) // self.n_points)
+            m, s = series['mean_' + f][measured][::step], series['std_' + f][measured][::step]
+            mean.set_data(xs[::step], m)
+            upper.set_data(xs[::step], m + s)
+            lower.set_data(xs[::step], m - s)
+            self.axes[f].relim()
+            self.axes[f].autoscale_view()
+            allan = self.stream.allan(f, relative=True)
+            self.allanLines[f].set_data(allan['tau_s'], allan['adev'])
+        self.allanAxis.relim()
+        self.allanAxis.autoscale_view()
+        self.canvas.draw_idle()
+
+    def showEvent(self, event):
+        super(TrendWindow, self).showEvent(event)
+        self.refresh(force=True)
+
+    def exportClicked(self):
+        path, _ = QFileDialog.getSaveFileName(self, 'Export measurements', '', 'NumPy (*.npz);;CSV (*.csv)')
+        if path:
+            self.stream.export(path)
+
+    def resetClicked(self):
+        self.stream.reset()
+        self.refresh(force=True)